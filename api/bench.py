@@ -0,0 +1,174 @@
+"""
+Measures what one API process pays per websocket client: the memory of a
+registered connection (its record, outbox, writer task and reaper
+entry) and the cost of heartbeats, reaper ticks and broadcasts, at 10k and
+100k simulated connections unless other counts are given. Then runs a flood
+of heartbeat frames through the gateway handler with every available codec:
+
+    python bench.py [connections ...]
+
+The sockets are in-memory stand-ins, so this measures the manager and not
+the network or the ASGI server.
+"""
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+
+from loguru import logger
+
+from codec import CODECS, JSON, JSON_LIBRARY
+from manager import OPCODES, Connection, ConnectionManager
+
+COUNTS = [int(n) for n in sys.argv[1:]] or [10_000, 100_000]
+FLOOD = 100_000
+
+
+class FakeClient:
+    host = "127.0.0.1"
+
+
+class FakeSocket:
+    client = FakeClient()
+    frames = 0
+
+    def __init__(self, client_id: int):
+        self.id = client_id
+
+    async def send_text(self, frame: str):
+        FakeSocket.frames += 1
+
+    async def send_bytes(self, frame: bytes):
+        FakeSocket.frames += 1
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def drain(expected: int):
+    """Lets the writers run until `expected` frames went out in total"""
+    while FakeSocket.frames < expected:
+        await asyncio.sleep(0)
+
+
+def per_connection(elapsed: float, count: int) -> str:
+    return f"{elapsed / count * 1e9:>7.0f} ns/conn"
+
+
+async def bench(count: int):
+    manager = ConnectionManager()
+    manager.loop = asyncio.get_running_loop()
+    sockets = [FakeSocket(i) for i in range(count)]
+    FakeSocket.frames = 0
+
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    frames = manager._frames(JSON)
+    records = [Connection(ws, 0.0, JSON, frames) for ws in sockets[:1000]]
+    record_size = (tracemalloc.get_traced_memory()[0] - start) / len(records)
+    del records
+    gc.collect()
+
+    start = tracemalloc.get_traced_memory()[0]
+    for ws in sockets:
+        await manager._register(ws)
+    # the writers send INITIALIZE and then wait for their outbox to fill
+    await drain(count)
+    total_size = (tracemalloc.get_traced_memory()[0] - start) / count
+    tracemalloc.stop()
+    # every reaper entry is due by then, every heartbeat below moves past it
+    registered = time.monotonic() + manager.heartbeat_timeout
+
+    conns = list(manager.connected.values())
+    rows = [
+        f"record {record_size:>5.0f} B/conn",
+        f"registered {total_size:>6.0f} B/conn",
+    ]
+
+    start = time.perf_counter()
+    for conn in conns:
+        manager._handle_heartbeat(conn)
+    rows.append(f"heartbeat {per_connection(time.perf_counter() - start, count)}")
+
+    confirm = frames["heartbeat_confirm"]
+    sent = FakeSocket.frames
+    start = time.perf_counter()
+    for conn in conns:
+        manager._enqueue(conn, confirm, control=True)
+        manager._handle_heartbeat(conn)
+    await drain(sent + count)
+    rows.append(
+        f"heartbeat+confirm {per_connection(time.perf_counter() - start, count)}"
+    )
+
+    # nothing due: the reaper only peeks at the heap
+    now = time.monotonic()
+    start = time.perf_counter()
+    manager._expired(now)
+    rows.append(f"idle tick {(time.perf_counter() - start) * 1e6:>5.1f} us")
+
+    # every entry due, but every connection beat since: all rescheduled
+    start = time.perf_counter()
+    manager._expired(registered)
+    rows.append(f"reschedule {per_connection(time.perf_counter() - start, count)}")
+
+    sent = FakeSocket.frames
+    start = time.perf_counter()
+    await manager.send("x" * 100)
+    await drain(sent + count)
+    rows.append(f"broadcast {per_connection(time.perf_counter() - start, count)}")
+
+    await manager.stop()
+    print(f"{count:>7} conns  " + "  ".join(rows))
+
+
+class FloodSocket(FakeSocket):
+    """Sends `count` heartbeats encoded with `codec`, then disconnects"""
+
+    headers = {"Authorization": "bench"}
+
+    def __init__(self, codec, count: int):
+        super().__init__(0)
+        self.query_params = {"encoding": codec.name}
+        frame = codec.encode({"op": OPCODES.HEARTBEAT})
+        key = "bytes" if codec.binary else "text"
+        self.message = {"type": "websocket.receive", key: frame}
+        self.count = count
+
+    async def receive(self) -> dict:
+        if self.count == 0:
+            return {"type": "websocket.disconnect", "code": 1000}
+        self.count -= 1
+        # a real socket waits for the next frame, which lets the writer run
+        await asyncio.sleep(0)
+        return self.message
+
+
+async def bench_flood(codec):
+    manager = ConnectionManager()
+    manager.loop = asyncio.get_running_loop()
+    manager._active_keys = {"bench"}
+    ws = FloodSocket(codec, FLOOD)
+
+    start = time.perf_counter()
+    await manager._handler(ws)
+    elapsed = time.perf_counter() - start
+    await manager.stop()
+    print(
+        f"{codec.name:>7} heartbeat flood  {elapsed / FLOOD * 1e9:>7.0f} ns/frame"
+        f"  (json through {JSON_LIBRARY})"
+    )
+
+
+async def main():
+    # registering logs every connection
+    logger.remove()
+    for count in COUNTS:
+        await bench(count)
+    for codec in CODECS.values():
+        await bench_flood(codec)
+
+
+asyncio.run(main())
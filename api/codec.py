@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import json
+from typing import Any, Callable, Optional, Union
+
+"""
+Frame encodings of the websocket gateway.
+JSON goes out as text frames through the fastest codec installed (orjson,
+then ujson, then the standard library). Clients connecting with
+`?encoding=msgpack` get bytes frames instead when msgpack is installed.
+Frames a client sends are decoded by their type: text frames as JSON,
+bytes frames with the connection's codec.
+"""
+
+try:
+    import orjson
+
+    def _encode_json(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    _decode_json = orjson.loads
+    JSON_LIBRARY = "orjson"
+except ImportError:
+    try:
+        import ujson
+
+        _encode_json = ujson.dumps
+        _decode_json = ujson.loads
+        JSON_LIBRARY = "ujson"
+    except ImportError:
+
+        def _encode_json(obj: Any) -> str:
+            return json.dumps(obj, separators=(",", ":"))
+
+        _decode_json = json.loads
+        JSON_LIBRARY = "json"
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+Frame = Union[str, bytes]
+
+
+class Codec:
+    __slots__ = ("name", "binary", "encode", "decode")
+
+    def __init__(
+        self,
+        name: str,
+        binary: bool,
+        encode: Callable[[Any], Frame],
+        decode: Callable[[Frame], Any],
+    ):
+        self.name = name
+        # bytes frames instead of text frames
+        self.binary = binary
+        self.encode = encode
+        self.decode = decode
+
+
+JSON = Codec("json", False, _encode_json, _decode_json)
+
+CODECS = {"json": JSON}
+if msgpack is not None:
+    CODECS["msgpack"] = Codec(
+        "msgpack",
+        True,
+        msgpack.packb,
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+
+
+def get_codec(name: Optional[str]) -> Optional[Codec]:
+    """
+    Returns:
+     - The codec a client asked for, JSON if it did not ask, None if it is
+       not available
+    """
+    return CODECS.get(name or "json")
@@ -0,0 +1,357 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from contextlib import suppress
+from typing import TYPE_CHECKING, Optional
+
+from loguru import logger
+
+from codec import JSON
+
+if TYPE_CHECKING:
+    from manager import ConnectionManager
+
+"""
+Which worker holds which websocket client.
+`Directory` is the single process default: every client is local, nothing
+is routed. `UnixBrokerDirectory` lets several uvicorn workers share their
+clients through a broker on a UNIX socket. The first worker to lock
+`{path}.lock` serves the broker; every worker, that one included, connects
+to it. Workers report the clients they register, the broker passes that on
+to all workers, so each one keeps a full id -> worker table and can answer
+`get_ws` without a round trip. Messages for a client held elsewhere and
+broadcasts go through the broker to the worker holding the socket. When the
+broker's worker exits, the lock is released, another worker takes over and
+everybody reconnects and registers their clients again.
+
+The protocol is one JSON object per line, "t" naming the message:
+ - worker -> broker: hello, register, unregister, send, broadcast
+ - broker -> worker: snapshot, register, unregister, gone, deliver, broadcast
+"""
+
+# longest line a broker connection accepts
+LINE_LIMIT = 16 * 1024 * 1024
+# clients per snapshot line sent to a worker that (re)connects
+SNAPSHOT_CHUNK = 1000
+# unsent bytes a broker connection may buffer before lines to it are held back
+WRITE_BUFFER_LIMIT = 4 * LINE_LIMIT
+# lines that only carry a message, dropped for a peer that does not keep up.
+# The others keep the client tables in sync, a peer too slow for them is
+# disconnected and gets everything again when it reconnects
+DROPPABLE = {"send", "deliver", "broadcast"}
+
+
+class RemoteSocket:
+    """Stands in for a websocket held by another worker"""
+
+    __slots__ = ("directory", "id", "worker")
+
+    def __init__(self, directory: Directory, client_id: int, worker: str):
+        self.directory = directory
+        self.id = client_id
+        self.worker = worker
+
+    async def send_json(self, data: dict):
+        if not self.directory.forward(self.id, data):
+            raise ConnectionError(f"Client {self.id} is no longer connected")
+
+
+class Directory:
+    def __init__(self):
+        self.manager: Optional[ConnectionManager] = None
+
+    async def start(self, manager: ConnectionManager):
+        self.manager = manager
+
+    async def stop(self):
+        pass
+
+    def register(self, client_id: int):
+        """Called once a client connected to this worker"""
+
+    def unregister(self, client_id: int):
+        """Called once a client of this worker went away"""
+
+    def locate(self, client_id: int) -> Optional[str]:
+        """
+        Returns:
+         - The worker holding a client that is not connected here, or None
+        """
+        return None
+
+    def proxy(self, client_id: int) -> Optional[RemoteSocket]:
+        if (worker := self.locate(client_id)) is not None:
+            return RemoteSocket(self, client_id, worker)
+        return None
+
+    def forward(self, client_id: int, payload: dict) -> bool:
+        """
+        Routes `payload` to a client of another worker
+        Returns:
+         - False if no other worker holds the client
+        """
+        return False
+
+    def broadcast(self, message: str):
+        """Hands a broadcast to the other workers"""
+
+    def remote_clients(self) -> int:
+        return 0
+
+
+class UnixBrokerDirectory(Directory):
+    """
+    Params:
+     - path (str) : The broker's UNIX socket, shared by the workers
+     - retry (float) : Seconds between attempts to reach the broker
+    """
+
+    logger = logger.bind(module="Directory")
+
+    def __init__(self, path: str, *, retry: float = 1.0):
+        super().__init__()
+        self.path = path
+        self.retry = retry
+        self.worker = str(os.getpid())
+        # clients held by other workers, id -> worker
+        self.remote: dict[int, str] = {}
+
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._broker: Optional[_Broker] = None
+        self._lock_fd: Optional[int] = None
+
+    async def start(self, manager: ConnectionManager):
+        await super().start(manager)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._broker is not None:
+            await self._broker.close()
+            self._broker = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def register(self, client_id: int):
+        self.remote.pop(client_id, None)
+        self._send({"t": "register", "client": client_id})
+
+    def unregister(self, client_id: int):
+        self._send({"t": "unregister", "client": client_id})
+
+    def locate(self, client_id: int) -> Optional[str]:
+        return self.remote.get(client_id)
+
+    def forward(self, client_id: int, payload: dict) -> bool:
+        if client_id not in self.remote:
+            return False
+        return self._send({"t": "send", "client": client_id, "payload": payload})
+
+    def broadcast(self, message: str):
+        self._send({"t": "broadcast", "message": message})
+
+    def remote_clients(self) -> int:
+        return len(self.remote)
+
+    def _send(self, message: dict) -> bool:
+        if self._writer is None:
+            return False
+        return _write(self._writer, message)
+
+    async def _run(self):
+        while True:
+            await self._claim_broker()
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.path, limit=LINE_LIMIT
+                )
+            except OSError as e:
+                self.logger.debug(f"Broker at {self.path} not reachable: {e}")
+                await asyncio.sleep(self.retry)
+                continue
+
+            self._writer = writer
+            self._send({"t": "hello", "worker": self.worker})
+            for client_id in self.manager.connected:
+                self._send({"t": "register", "client": client_id})
+            self.logger.info(f"Worker {self.worker} joined the broker at {self.path}")
+
+            try:
+                async for line in reader:
+                    try:
+                        self._handle(JSON.decode(line))
+                    except Exception as e:
+                        self.logger.error(
+                            f"Dropping a bad line from the broker: {e!r}"
+                        )
+            except (ConnectionError, ValueError) as e:
+                self.logger.warning(f"Lost the broker at {self.path}: {e}")
+            finally:
+                self._writer = None
+                self.remote.clear()
+                writer.close()
+            await asyncio.sleep(self.retry)
+
+    def _handle(self, message: dict):
+        kind = message["t"]
+        if kind == "deliver":
+            self.manager._deliver(message["client"], message["payload"])
+        elif kind == "broadcast":
+            self.manager._broadcast_local(message["message"])
+        elif kind == "register":
+            if message["worker"] != self.worker:
+                self.remote[message["client"]] = message["worker"]
+        elif kind == "unregister":
+            if self.remote.get(message["client"]) == message["worker"]:
+                del self.remote[message["client"]]
+        elif kind == "snapshot":
+            for client_id, worker in message["clients"]:
+                if worker != self.worker:
+                    self.remote[client_id] = worker
+        elif kind == "gone":
+            worker = message["worker"]
+            self.remote = {c: w for c, w in self.remote.items() if w != worker}
+
+    async def _claim_broker(self):
+        """Serves the broker if no other worker does"""
+        if self._broker is not None:
+            return
+        import fcntl
+
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return
+
+        broker = _Broker()
+        try:
+            await broker.serve(self.path)
+        except OSError as e:
+            self.logger.error(f"Could not serve the broker at {self.path}: {e}")
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        self._broker = broker
+        self.logger.info(f"Worker {self.worker} serves the broker at {self.path}")
+
+
+class _Broker:
+    logger = logger.bind(module="Broker")
+
+    def __init__(self):
+        # client id -> worker holding it
+        self.clients: dict[int, str] = {}
+        self.workers: dict[str, asyncio.StreamWriter] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def serve(self, path: str):
+        # left behind by a broker that died, the lock says nobody uses it
+        with suppress(FileNotFoundError):
+            os.remove(path)
+        self._server = await asyncio.start_unix_server(
+            self._session, path, limit=LINE_LIMIT
+        )
+        # workers are trusted with every client's messages, other users are not
+        os.chmod(path, 0o600)
+
+    async def close(self):
+        self._server.close()
+        for writer in self.workers.values():
+            writer.close()
+        await self._server.wait_closed()
+
+    def _publish(self, message: dict, skip: Optional[str] = None):
+        for worker, writer in self.workers.items():
+            if worker != skip:
+                _write(writer, message)
+
+    async def _session(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        worker = None
+        try:
+            async for line in reader:
+                try:
+                    message = JSON.decode(line)
+                    if message["t"] == "hello":
+                        worker = message["worker"]
+                        self.workers[worker] = writer
+                        self._snapshot(writer)
+                    elif worker is not None:
+                        self._route(worker, message)
+                except Exception as e:
+                    self.logger.error(
+                        f"Dropping a bad line from worker {worker}: {e!r}"
+                    )
+        except (ConnectionError, ValueError) as e:
+            self.logger.warning(f"Dropping worker {worker}: {e}")
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                del self.workers[worker]
+                self.clients = {c: w for c, w in self.clients.items() if w != worker}
+                self._publish({"t": "gone", "worker": worker})
+            writer.close()
+
+    def _route(self, worker: str, message: dict):
+        kind = message["t"]
+        if kind == "send":
+            owner = self.clients.get(message["client"])
+            if owner in self.workers:
+                _write(
+                    self.workers[owner],
+                    {
+                        "t": "deliver",
+                        "client": message["client"],
+                        "payload": message["payload"],
+                    },
+                )
+        elif kind == "register":
+            self.clients[message["client"]] = worker
+            self._publish(
+                {"t": "register", "client": message["client"], "worker": worker},
+                skip=worker,
+            )
+        elif kind == "unregister":
+            # a reconnect to another worker may have moved the client
+            if self.clients.get(message["client"]) == worker:
+                del self.clients[message["client"]]
+                self._publish(
+                    {"t": "unregister", "client": message["client"], "worker": worker},
+                    skip=worker,
+                )
+        elif kind == "broadcast":
+            self._publish(
+                {"t": "broadcast", "message": message["message"]}, skip=worker
+            )
+
+    def _snapshot(self, writer: asyncio.StreamWriter):
+        clients = list(self.clients.items())
+        for i in range(0, len(clients), SNAPSHOT_CHUNK):
+            chunk = clients[i : i + SNAPSHOT_CHUNK]
+            _write(writer, {"t": "snapshot", "clients": chunk})
+
+
+def _write(writer: asyncio.StreamWriter, message: dict) -> bool:
+    """
+    Fire and forget, the transport buffers whatever the peer did not read
+    yet, up to WRITE_BUFFER_LIMIT
+    Returns:
+     - False if the line was not sent
+    """
+    if writer.is_closing():
+        return False
+    if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+        if message["t"] not in DROPPABLE:
+            logger.warning("Closing a broker connection that stopped reading")
+            writer.close()
+        return False
+    writer.write(JSON.encode(message).encode() + b"\n")
+    return True
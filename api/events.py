@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+from typing import Callable, Hashable, Optional
+
+from loguru import logger
+
+"""
+Listeners for websocket events.
+Listeners are kept per (event, client id) key, a client id of None meaning
+every client, so an emit looks up two keys however many listeners exist
+for other events or clients. `on` returns a handle that removes its
+listener in O(1). Coroutines started by listeners are kept in a set until
+they finish, their errors get logged and `close` cancels what is left.
+"""
+
+
+class Handle:
+    __slots__ = ("bus", "key", "func", "once")
+
+    def __init__(self, bus: EventBus, key: tuple, func: Callable, once: bool):
+        self.bus = bus
+        self.key = key
+        self.func = func
+        self.once = once
+
+    @property
+    def active(self) -> bool:
+        return self in self.bus._listeners.get(self.key, ())
+
+    def remove(self):
+        self.bus.off(self)
+
+
+class EventBus:
+    logger = logger.bind(module="Events")
+
+    def __init__(self):
+        # (event, client id) -> handles, a dict being an insertion ordered set
+        self._listeners: dict[tuple[Hashable, Optional[int]], dict[Handle, None]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.failures = 0
+
+    def on(
+        self,
+        event: Hashable,
+        func: Callable,
+        *,
+        client_id: Optional[int] = None,
+        once: bool = False,
+    ) -> Handle:
+        """
+        Calls `func(*args)` for every `emit(event, *args)`. Coroutine
+        functions are run as tasks
+        Params:
+         - client_id (int) : Only listen to this client, None for all of them
+         - once (bool) : Remove the listener after its first call
+        Returns:
+         - The handle to remove the listener with
+        """
+        handle = Handle(self, (event, client_id), func, once)
+        self._listeners.setdefault(handle.key, {})[handle] = None
+        return handle
+
+    def off(self, handle: Handle):
+        if listeners := self._listeners.get(handle.key):
+            listeners.pop(handle, None)
+            if not listeners:
+                del self._listeners[handle.key]
+
+    def off_func(
+        self, event: Hashable, func: Callable, *, client_id: Optional[int] = None
+    ) -> bool:
+        """
+        Removes the listeners calling `func`, for callers without a handle
+        Returns:
+         - Whether there was one
+        """
+        key = (event, client_id)
+        handles = [h for h in self._listeners.get(key, ()) if h.func == func]
+        for handle in handles:
+            self.off(handle)
+        return bool(handles)
+
+    def emit(self, event: Hashable, *args, client_id: Optional[int] = None) -> int:
+        """
+        Calls the listeners of `event` for every client and then those for
+        `client_id`
+        Returns:
+         - The number of listeners called
+        """
+        handles = list(self._listeners.get((event, None), ()))
+        if client_id is not None:
+            handles += self._listeners.get((event, client_id), ())
+
+        for handle in handles:
+            if handle.once:
+                self.off(handle)
+            try:
+                result = handle.func(*args)
+            except Exception as e:
+                self.failures += 1
+                self.logger.exception(
+                    f"Listener {handle.func!r} of {event} failed: {e}"
+                )
+                continue
+            if inspect.isawaitable(result):
+                self._track(asyncio.ensure_future(result), handle, event)
+        return len(handles)
+
+    async def wait_for(
+        self,
+        event: Hashable,
+        check: Optional[Callable[..., bool]] = None,
+        *,
+        client_id: Optional[int] = None,
+        timeout: Optional[float] = 60,
+    ) -> tuple:
+        """
+        Waits for the next emit of `event` that passes `check(*args)`
+        Returns:
+         - The emitted args
+        Raises:
+         - asyncio.TimeoutError
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        def listener(*args):
+            if not future.done() and (check is None or check(*args)):
+                future.set_result(args)
+
+        handle = self.on(event, listener, client_id=client_id)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            handle.remove()
+
+    def listeners(self, event: Hashable, client_id: Optional[int] = None) -> int:
+        return len(self._listeners.get((event, client_id), ()))
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def close(self):
+        """Cancels the listener tasks that are still running"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _track(self, task: asyncio.Task, handle: Handle, event: Hashable):
+        self._tasks.add(task)
+
+        def done(task: asyncio.Task):
+            self._tasks.discard(task)
+            if not task.cancelled() and (e := task.exception()):
+                self.failures += 1
+                self.logger.opt(exception=e).error(
+                    f"Listener {handle.func!r} of {event} failed: {e}"
+                )
+
+        task.add_done_callback(done)
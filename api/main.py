@@ -1,9 +1,12 @@
 from __future__ import annotations
 
 import asyncio
+import hmac
 import os
-from base64 import b64encode
-from typing import Any
+import sys
+import time
+from base64 import b64encode, urlsafe_b64decode, urlsafe_b64encode
+from typing import Any, Optional
 
 import aiohttp
 from dotenv import load_dotenv, set_key
@@ -16,6 +19,12 @@ from loguru import logger
 from manager import ConnectionManager
 from uvicorn import Config, Server
 
+# the apps share the modules in ../shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from directory import UnixBrokerDirectory
+from shared.metrics import Metrics
+
 load_dotenv()
 init_logging()
 
@@ -48,6 +57,8 @@ _MASTER_API_KEY = os.getenv("master_api_key")
 _HOST = os.getenv("api_host")
 _PORT = os.getenv("api_port")
 
+_METRICS_TOKEN = os.getenv("metrics_token")
+
 _CREDS = b64encode(f"{_CLIENT_ID}:{_CLIENT_SECRET}".encode()).decode()
 _HEADERS = {
     "Authorization": f"Basic {_CREDS}",
@@ -114,6 +125,51 @@ _SCOPES = " ".join(_SCOPES)
 
 manager = ConnectionManager()
 manager._active_keys = set(_ACTIVE_API_TOKENS)
+manager.send_queue_size = int(os.getenv("ws_send_queue_size", 256))
+manager.slow_client_policy = os.getenv("ws_slow_client_policy", "drop")
+if manager.slow_client_policy not in ("drop", "disconnect"):
+    raise ValueError("ws_slow_client_policy must be drop or disconnect")
+# set it to run several workers, they reach each other's clients through it
+if _BROKER_SOCKET := os.getenv("ws_broker_socket"):
+    manager.directory = UnixBrokerDirectory(_BROKER_SOCKET)
+
+# the spotify state parameter carries the request itself, signed, so that
+# whichever worker gets the callback can finish the login
+_STATE_SECRET = (os.getenv("state_secret") or _MASTER_API_KEY).encode()
+_STATE_TTL = 60 * 60
+
+
+def _sign_state(body: str) -> str:
+    return hmac.new(_STATE_SECRET, body.encode(), "sha256").hexdigest()[:32]
+
+
+def encode_state(state: int, client_id: int, playlist_name: str) -> str:
+    payload = JSON_ENCODER([state, client_id, playlist_name, int(time.time())])
+    body = urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+    return f"{body}.{_sign_state(body)}"
+
+
+def decode_state(token: str) -> Optional[tuple[int, int, str]]:
+    """
+    Returns:
+     - (state, client_id, playlist_name) of a token made by `encode_state`,
+       None if it was tampered with or expired
+    """
+    body, _, signature = token.rpartition(".")
+    # compare bytes, compare_digest raises TypeError on non-ASCII strings
+    if not body or not hmac.compare_digest(
+        signature.encode(), _sign_state(body).encode()
+    ):
+        return None
+    try:
+        payload = urlsafe_b64decode(body + "=" * (-len(body) % 4)).decode()
+        state, client_id, playlist_name, issued = JSON_DECODER(payload)
+    except (ValueError, TypeError):
+        return None
+    if time.time() - issued > _STATE_TTL:
+        return None
+    return state, client_id, playlist_name
+
 
 app: APIWrapper = APIWrapper(
     manager,
@@ -122,10 +178,61 @@ app: APIWrapper = APIWrapper(
     redoc_url=f"{BASE_API_URL}/docs",
 )
 
+metrics = Metrics("api")
+metrics.add_collector(
+    "websocket_clients",
+    "gauge",
+    "Registered websocket clients",
+    lambda: len(manager.connected),
+)
+metrics.add_collector(
+    "websocket_remote_clients",
+    "gauge",
+    "Websocket clients connected to other workers",
+    lambda: manager.directory.remote_clients(),
+)
+metrics.add_collector(
+    "websocket_reaped_total",
+    "counter",
+    "Websocket clients closed for missing their heartbeat",
+    lambda: manager.reaped,
+)
+metrics.add_collector(
+    "websocket_callback_tasks",
+    "gauge",
+    "Websocket callbacks still running",
+    lambda: manager.events.pending(),
+)
+metrics.add_collector(
+    "websocket_callback_failures_total",
+    "counter",
+    "Websocket callbacks that raised",
+    lambda: manager.events.failures,
+)
+metrics.add_collector(
+    "websocket_send_queue_depth",
+    "gauge",
+    "Messages waiting to be sent, by client",
+    lambda: [
+        ({"client": client_id}, len(conn.outbox))
+        for client_id, conn in manager.connected.items()
+    ],
+)
+metrics.add_collector(
+    "websocket_dropped_messages_total",
+    "counter",
+    "Messages not sent because the client fell behind, by client",
+    lambda: [
+        ({"client": client_id}, conn.dropped)
+        for client_id, conn in manager.connected.items()
+    ],
+)
+
 
 @app.on_event("startup")
 async def app_startup():
     app.session = aiohttp.ClientSession()
+    await app.manager.start()
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -138,6 +245,7 @@ async def app_startup():
 @app.on_event("shutdown")
 async def app_shutdown():
     await app.session.close()
+    await app.manager.stop()
 
 
 @app.get("/")
@@ -151,16 +259,12 @@ async def index():
     tags=["Spotify"],
 )
 async def spotify(state: int, playlist_name: str, client_id: int):
-    existing_tokens = app.fetch("access_tokens")
-    existing_tokens[state] = {"playlist_name": playlist_name, "client_id": client_id}
-    app.store("access_tokens", existing_tokens)
-
     if not app.manager.get_ws(client_id):
         return PlainTextResponse(
             "Client is not connected to the websocket server. Please try again in 5 minutes! If the issue persists, contact a server administrator.",
             status_code=400,
         )
-    url = f"https://accounts.spotify.com/authorize?client_id={_CLIENT_ID}&response_type=code&redirect_uri={_REDIRECT_URI}&scope={_SCOPES}&state={state}"
+    url = f"https://accounts.spotify.com/authorize?client_id={_CLIENT_ID}&response_type=code&redirect_uri={_REDIRECT_URI}&scope={_SCOPES}&state={encode_state(state, client_id, playlist_name)}"
     return RedirectResponse(
         url=url,
         status_code=303,
@@ -222,12 +326,10 @@ async def handshake(request: Request):
 @app.get(f"{BASE_API_URL}/spotify/authorized")
 async def authorized(request: Request):
     code = request.query_params.get("code")
-    state = request.query_params.get("state")
-
-    try:
-        state = int(state)
-    except ValueError:
+    decoded = decode_state(request.query_params.get("state", ""))
+    if decoded is None:
         return PlainTextResponse("Invalid state", status_code=400)
+    state, destination_client_id, playlist_name = decoded
 
     async with app.session.post(
         "https://accounts.spotify.com/api/token",
@@ -247,17 +349,11 @@ async def authorized(request: Request):
         data["state"] = state
         data["op"] = 6
 
-    tokens = app.fetch("access_tokens")
-
-    destination_client_id = tokens.get(state, {}).get("client_id", None)
-
-    tokens[state] = data | tokens[state]
-
-    app.store("access_tokens", tokens)
-
-    json_data = tokens.pop(state, {})
-    if client := app.manager.get_ws(destination_client_id):
-        await client.send_json(json_data)
+    json_data = data | {
+        "playlist_name": playlist_name,
+        "client_id": destination_client_id,
+    }
+    if app.manager.send_to(destination_client_id, json_data):
         return PlainTextResponse(
             f"Authorized, you can close this tab now.\nPlease wait about 10 seconds before running '/playlist load {json_data['playlist_name']}'.\n\nNOTE: Some songs may not be available in the UK, and will be skipped."
         )
@@ -296,6 +392,20 @@ async def upload_file(file: UploadFile):
     return PlainTextResponse(f"File uploaded to {_CDN_URL}/{file_name}")
 
 
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    auth = request.headers.get("Authorization", "")
+    if not _METRICS_TOKEN or not hmac.compare_digest(
+        auth.encode("utf-8"), f"Bearer {_METRICS_TOKEN}".encode("utf-8")
+    ):
+        return PlainTextResponse("Invalid metrics token", status_code=401)
+
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+metrics.instrument(app)
+
+
 if __name__ == "__main__":
 
     async def main():
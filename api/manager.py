@@ -1,11 +1,16 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
 import os
 import sys
 import time
-from typing import Optional
+from collections import deque
+from typing import Optional, Union
 
+from codec import JSON, Codec, Frame, get_codec
+from directory import Directory, RemoteSocket
+from events import EventBus, Handle
 from fastapi import WebSocket, WebSocketDisconnect
 from loguru import logger
 
@@ -38,18 +43,6 @@ logger.add(logs_file_path, level="DEBUG")
 # logger.addHandler(fh)  # Exporting logs to a file
 
 
-try:
-    import ujson
-
-    JSON_ENCODER = ujson.dumps
-    JSON_DECODER = ujson.loads
-except ImportError:
-    import json
-
-    JSON_ENCODER = json.dumps
-    JSON_DECODER = json.loads
-
-
 class OPCODES:
     INITIALIZE = 1
     HEARTBEAT = 2
@@ -59,88 +52,334 @@ class OPCODES:
     SEND_MESSAGE = 7
 
 
+INVALID_MESSAGE = {
+    "op": OPCODES.MESSAGE,
+    "error": "Invalid JSON",
+    "description": "An invalid json was sent to the server",
+}
+
+# callback types of add_callback and the events they listen to
+CALLBACK_EVENTS = {
+    "on_message": OPCODES.MESSAGE,
+    "on_disconnect": OPCODES.CLOSE_CONNECTION,
+}
+
+
+class Connection:
+    """
+    One registered websocket. Slotted, so that a process holding a hundred
+    thousand of them pays for the fields and not for a dict each
+    """
+
+    __slots__ = (
+        "id",
+        "ws",
+        "codec",
+        "frames",
+        "name",
+        "last_heartbeat",
+        "deadline",
+        "outbox",
+        "wakeup",
+        "writer",
+        "closing",
+        "received",
+        "heartbeats",
+        "sent",
+        "dropped",
+        "confirm_queued",
+    )
+
+    def __init__(
+        self, ws: WebSocket, deadline: float, codec: Codec, frames: dict[str, Frame]
+    ):
+        self.id: int = ws.id
+        self.ws = ws
+        self.codec = codec
+        # the constant frames, encoded with `codec`
+        self.frames = frames
+        self.name: Optional[str] = None
+        self.last_heartbeat = time.time()
+        # time.monotonic() after which the reaper closes the connection
+        self.deadline = deadline
+        # encoded frames waiting for the writer, None closes the socket. A
+        # bare deque and future instead of an asyncio.Queue, which carries
+        # three more deques and an Event per connection
+        self.outbox: deque[Optional[Frame]] = deque()
+        # set while the writer waits for the outbox to fill
+        self.wakeup: Optional[asyncio.Future] = None
+        self.writer: Optional[asyncio.Task] = None
+        self.closing = False
+        self.received = 0
+        self.heartbeats = 0
+        self.sent = 0
+        self.dropped = 0
+        # a heartbeat confirmation is waiting in the outbox
+        self.confirm_queued = False
+
+
+class LocalSocket:
+    """
+    Stands in for the websocket of a client of this worker, so that sends
+    go through the connection's queue and codec like every other message
+    """
+
+    __slots__ = ("manager", "id")
+
+    def __init__(self, manager: ConnectionManager, client_id: int):
+        self.manager = manager
+        self.id = client_id
+
+    async def send_json(self, data: dict):
+        if not self.manager._deliver(self.id, data):
+            raise ConnectionError(f"Client {self.id} is gone or too far behind")
+
+
 class ConnectionManager:
 
     logger = logger.bind(module="Manager")
-    _callbacks = {}
+    # shared by every manager so callbacks can be added before one exists
+    events = EventBus()
 
     def __init__(self):
-        self.connected = {}
+        self.connected: dict[int, Connection] = {}
         self.loop = asyncio.get_event_loop()
+        # where clients of other workers are, replace before `start`
+        self.directory: Directory = Directory()
 
         self.heartbeat_interval = 30
         self.heartbeat_timeout = 120
+        # how often the reaper looks for connections that stopped beating
+        self.reap_interval = 1
+        self.reaped = 0
         self._active_keys = set()
 
-    async def _register(self, ws: WebSocket):
+        # messages a client may have waiting before it counts as slow
+        self.send_queue_size = 256
+        # what happens to a slow client's next message, "drop" discards the
+        # message, "disconnect" closes the connection
+        self.slow_client_policy = "drop"
+        # control frames a client may have waiting on top of send_queue_size,
+        # one that has more keeps sending without reading and is disconnected
+        self.control_queue_size = 16
+        # longest a forced close of a slow client may take
+        self.close_timeout = 5
+
+        # (deadline, id, connection), one entry per connection. Heartbeats
+        # only move conn.deadline, the reaper pushes the entry back with the
+        # new deadline when it pops an entry that is not due yet
+        self._deadlines: list[tuple[float, int, Connection]] = []
+        self._reaper: Optional[asyncio.Task] = None
+        self._closing: set[asyncio.Task] = set()
+        # codec name -> constant frames, encoded once
+        self._constant_frames: dict[str, dict[str, Frame]] = {}
+
+    def _frames(self, codec: Codec) -> dict[str, Frame]:
+        if (frames := self._constant_frames.get(codec.name)) is None:
+            frames = {
+                "initialize": codec.encode(
+                    {
+                        "op": OPCODES.INITIALIZE,
+                        "heartbeat_interval": self.heartbeat_interval,
+                    }
+                ),
+                "heartbeat_confirm": codec.encode({"op": OPCODES.HEARTBEAT_CONFIRM}),
+                "close": codec.encode({"op": OPCODES.CLOSE_CONNECTION}),
+                "invalid": codec.encode(INVALID_MESSAGE),
+            }
+            self._constant_frames[codec.name] = frames
+        return frames
+
+    async def _register(self, ws: WebSocket, codec: Codec = JSON) -> Connection:
         self.logger.info(
-            f"New connection from {str(ws.id)} has been registered successfully!",
+            f"New connection from {ws.id} has been registered successfully!",
         )
-        if str(ws.id) not in self.connected:
-            self.logger.debug(f"Creating timeout task. ID 1")
-            self.connected[str(ws.id)] = {
-                "last_heartbeat": time.time(),
-                "timeout_task": self.loop.create_task(self._timeout_task(ws)),
-                "ws": ws,
-                "name": None,
-            }
-        else:
-            self.connected[str(ws.id)]["last_heartbeat"] = time.time()
-            self.logger.debug(f"Cancelling timeout task. ID 1")
-            self.connected[str(ws.id)]["timeout_task"].cancel()
-            await asyncio.sleep(0.1)
-            self.logger.debug(
-                f"Task is cancelled: {self.connected[str(ws.id)]['timeout_task'].cancelled()}"
-            )
-            self.logger.debug(f"Creating timeout task. ID 2")
-            self.connected[str(ws.id)]["timeout_task"] = self.loop.create_task(
-                self._timeout_task(ws)
-            )
+        if old := self.connected.get(ws.id):
+            # reconnected under the same id, the old socket gets nothing more
+            # and is closed, which ends its handler. _unregister then leaves
+            # the new connection alone
+            self._abort(old)
+
+        conn = Connection(
+            ws, time.monotonic() + self.heartbeat_timeout, codec, self._frames(codec)
+        )
+        conn.writer = self.loop.create_task(self._writer(conn))
+        self.connected[conn.id] = conn
+        heapq.heappush(self._deadlines, (conn.deadline, conn.id, conn))
+        self.directory.register(conn.id)
 
-        payload = {
-            "op": OPCODES.INITIALIZE,
-            "heartbeat_interval": self.heartbeat_interval,
-        }
-        await ws.send_json(payload)
+        if self._reaper is None or self._reaper.done():
+            self._reaper = self.loop.create_task(self._reap_forever())
+
+        self._enqueue(conn, conn.frames["initialize"], control=True)
+        return conn
 
     async def _unregister(self, ws: WebSocket):
-        self.logger.info(
-            f"Unregistering {ws.id}| Is registered: {str(ws.id) in self.connected}"
-        )
-        if d := self.connected.pop(str(ws.id), None):
-            self.logger.debug(f"Cancelling timeout task. ID 2")
-            d["timeout_task"].cancel()
-            await asyncio.sleep(0)
-            self.logger.debug(f"Task is cancelled: {d['timeout_task'].cancelled()}")
-            if d["name"]:
-                self.logger.info(f"Disconnected {d['name']} from {ws.client.host}")
+        conn = self.connected.get(ws.id)
+        self.logger.info(f"Unregistering {ws.id}| Is registered: {conn is not None}")
+        # a reconnect under the same id replaced the connection's socket
+        if conn is not None and conn.ws is ws:
+            del self.connected[conn.id]
+            conn.writer.cancel()
+            self.directory.unregister(conn.id)
+            self.events.emit(OPCODES.CLOSE_CONNECTION, conn.name, client_id=conn.id)
+            if conn.name:
+                self.logger.info(f"Disconnected {conn.name} from {ws.client.host}")
         else:
             self.logger.info(f"Disconnected {ws.client.host}")
 
-    async def _handle_heartbeat(self, ws):
-        ws_id = str(ws.id)
-        self.connected[ws_id]["last_heartbeat"] = time.time()
+    def _confirm_heartbeat(self, conn: Connection):
+        # a confirmation that was not sent yet answers this heartbeat too
+        if not conn.confirm_queued:
+            conn.confirm_queued = self._enqueue(
+                conn, conn.frames["heartbeat_confirm"], control=True
+            )
+
+    def _handle_heartbeat(self, conn: Connection):
+        conn.heartbeats += 1
+        conn.last_heartbeat = time.time()
+        conn.deadline = time.monotonic() + self.heartbeat_timeout
 
     async def _close_ws(self, ws: WebSocket):
         await ws.send_json({"op": OPCODES.CLOSE_CONNECTION})
         await ws.close()
 
-    async def _timeout_task(self, ws: WebSocket):
-        while True:
-            if not self.connected.get(str(ws.id)):
-                self.logger.debug(f"Task is cancelled: {ws.id}")
-                return
-            try:
-                await asyncio.sleep(self.heartbeat_timeout)
-                if (
-                    time.time() - self.connected[str(ws.id)]["last_heartbeat"]
-                    > self.heartbeat_timeout
-                ):
-                    await self._close_ws(ws)
+    async def start(self):
+        await self.directory.start(self)
+
+    async def stop(self):
+        """Stops the heartbeat reaper, every writer and the callback tasks"""
+        await self.directory.stop()
+        tasks = [conn.writer for conn in self.connected.values()]
+        tasks += self._closing
+        if self._reaper is not None:
+            tasks.append(self._reaper)
+            self._reaper = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.events.close()
+
+    def _enqueue(self, conn: Connection, frame: Frame, control: bool = False) -> bool:
+        """
+        Hands an encoded frame to the connection's writer without waiting.
+        Control frames (handshake, heartbeat confirmations, close) get
+        `control_queue_size` more room than messages, running out of it
+        disconnects the client
+        Returns:
+         - Whether the frame was queued
+        """
+        if conn.closing:
+            return False
+        limit = self.send_queue_size
+        if control:
+            limit += self.control_queue_size
+        if len(conn.outbox) >= limit:
+            conn.dropped += 1
+            if control:
+                self.logger.warning(
+                    f"Disconnecting {conn.id}, it does not read its control frames"
+                )
+                self._abort(conn)
+            elif self.slow_client_policy == "disconnect":
+                self.logger.warning(
+                    f"Disconnecting {conn.id}, {len(conn.outbox)} messages behind"
+                )
+                self._abort(conn)
+            return False
+        self._push(conn, frame)
+        return True
+
+    def _push(self, conn: Connection, frame: Optional[Frame]):
+        conn.outbox.append(frame)
+        if conn.wakeup is not None and not conn.wakeup.done():
+            conn.wakeup.set_result(None)
+
+    async def _writer(self, conn: Connection):
+        ws, outbox = conn.ws, conn.outbox
+        send = ws.send_bytes if conn.codec.binary else ws.send_text
+        confirm = conn.frames["heartbeat_confirm"]
+        try:
+            while True:
+                if not outbox:
+                    conn.wakeup = self.loop.create_future()
+                    await conn.wakeup
+                    conn.wakeup = None
+                    continue
+                frame = outbox.popleft()
+                if frame is None:
+                    await ws.close()
                     return
-            except asyncio.CancelledError:
-                logger.debug("Cancelled timeout task")
-                raise
+                if frame is confirm:
+                    conn.confirm_queued = False
+                await send(frame)
+                conn.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the handler notices the disconnect and unregisters the socket
+            self.logger.debug(f"Writer of {conn.id} stopped: {e}")
+
+    def _close(self, conn: Connection):
+        """
+        Sends CLOSE_CONNECTION once everything queued before it went out. A
+        client that is not gone one heartbeat timeout later is aborted
+        """
+        if conn.closing:
+            self._abort(conn)
+            return
+        self._enqueue(conn, conn.frames["close"], control=True)
+        conn.closing = True
+        self._push(conn, None)
+
+    def _abort(self, conn: Connection):
+        """Closes the connection right away, dropping whatever is queued"""
+        conn.closing = True
+        conn.writer.cancel()
+        task = self.loop.create_task(self._force_close(conn.ws))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _force_close(self, ws: WebSocket):
+        try:
+            await asyncio.wait_for(ws.close(code=1008), self.close_timeout)
+        except Exception as e:
+            self.logger.debug(f"Closing {ws.id} failed: {e}")
+
+    def _expired(self, now: float) -> list[Connection]:
+        """
+        Pops every connection whose deadline passed. Entries of connections
+        that beat since they were pushed go back with their new deadline, so
+        a tick costs O(log n) per expired or rescheduled connection and
+        nothing for the rest
+        """
+        expired = []
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, conn_id, conn = heapq.heappop(deadlines)
+            if self.connected.get(conn_id) is not conn:
+                # unregistered since
+                continue
+            if conn.deadline > now:
+                heapq.heappush(deadlines, (conn.deadline, conn_id, conn))
+                continue
+            expired.append(conn)
+            # should closing it fail, try again one timeout later
+            conn.deadline = now + self.heartbeat_timeout
+            heapq.heappush(deadlines, (conn.deadline, conn_id, conn))
+        return expired
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            expired = self._expired(time.monotonic())
+            if not expired:
+                continue
+            self.reaped += len(expired)
+            self.logger.info(f"Closing {len(expired)} connections without a heartbeat")
+            # the handlers unregister them once the sockets are closed
+            for conn in expired:
+                self._close(conn)
 
     async def _handler(self, ws: WebSocket):
         auth = ws.headers.get("Authorization")
@@ -148,96 +387,163 @@ class ConnectionManager:
             await self._close_ws(ws)
             return
 
-        await self._register(ws)
-        ws_id = str(ws.id)
+        codec = get_codec(ws.query_params.get("encoding"))
+        if codec is None:
+            await ws.close(1003, "Unsupported encoding")
+            return
+
+        conn = await self._register(ws, codec)
         try:
             while True:
-                json_msg = await ws.receive_json()
-                self.logger.debug(f"Received from {ws_id}: {json_msg}")
-
-                if isinstance(json_msg, str):
-                    await ws.send_json(
-                        {
-                            "op": OPCODES.MESSAGE,
-                            "error": "Invalid JSON",
-                            "description": "An invalid json was sent to the server",
-                        },
+                message = await ws.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                conn.received += 1
+
+                payload = self._decode(conn, message)
+                if payload is None:
+                    self._enqueue(conn, conn.frames["invalid"], control=True)
+                    continue
+
+                op = payload.get("op")
+                if op == OPCODES.HEARTBEAT:
+                    # no logging here, heartbeats are most of the traffic
+                    self._confirm_heartbeat(conn)
+                    self._handle_heartbeat(conn)
+
+                elif op == OPCODES.MESSAGE:
+                    self.logger.debug("Received from {}: {}", conn.id, payload)
+                    self.events.emit(
+                        OPCODES.MESSAGE,
+                        payload.get("message"),
+                        conn.name,
+                        client_id=conn.id,
                     )
 
-                if json_msg["op"] == OPCODES.HEARTBEAT:
-                    self.logger.info(f"{ws_id} > Heart beat received")
-                    await ws.send_json({"op": OPCODES.HEARTBEAT_CONFIRM})
-                    await self._handle_heartbeat(ws)
-
-                elif json_msg["op"] == OPCODES.MESSAGE:
-                    for callback in self._callbacks.get("on_message", []):
-                        args = [json_msg["message"], self.connected[ws_id]["name"]]
-                        func = callback["func"]
-                        self.loop.create_task(func(*args))
-
         except WebSocketDisconnect:
             await self._unregister(ws)
             self.logger.info(f"Client {ws.client} with ID #{ws.id} disconnected")
 
         finally:
-            if ws_id in self.connected:
+            if ws.id in self.connected:
                 await self._unregister(ws)
 
+    @staticmethod
+    def _decode(conn: Connection, message: dict) -> Optional[dict]:
+        """
+        Decodes a received frame, text frames as JSON and bytes frames with
+        the connection's codec
+        Returns:
+         - The payload, None if it is not an object
+        """
+        try:
+            if (text := message.get("text")) is not None:
+                payload = JSON.decode(text)
+            else:
+                payload = conn.codec.decode(message.get("bytes") or b"")
+        except Exception:
+            return None
+        return payload if isinstance(payload, dict) else None
+
     async def send(self, message: str):
-        for i in self.connected.values():
-            await i["ws"].send_json({"op": OPCODES.SEND_MESSAGE, "message": message})
+        """
+        Broadcasts `message` to every client, those of other workers included.
+        The frame is encoded once per codec and queued for each connection,
+        so a slow client only holds up itself
+        """
+        self._broadcast_local(message)
+        self.directory.broadcast(message)
+
+    def _broadcast_local(self, message: str):
+        payload = {"op": OPCODES.SEND_MESSAGE, "message": message}
+        frames: dict[str, Frame] = {}
+        for conn in list(self.connected.values()):
+            if (frame := frames.get(conn.codec.name)) is None:
+                frame = frames[conn.codec.name] = conn.codec.encode(payload)
+            self._enqueue(conn, frame)
+
+    def send_to(self, socket_id: int, payload: dict) -> bool:
+        """
+        Queues `payload` for a single client. Clients of other workers are
+        handed to their worker, which may still drop the message should the
+        client be too far behind
+        Returns:
+         - False if the client is not connected or too far behind
+        """
+        if socket_id in self.connected:
+            return self._deliver(socket_id, payload)
+        return self.directory.forward(socket_id, payload)
+
+    def _deliver(self, socket_id: int, payload: dict) -> bool:
+        if conn := self.connected.get(socket_id):
+            return self._enqueue(conn, conn.codec.encode(payload))
+        return False
 
     async def wait_for(
-        self, wait_type: str, check=None, timeout: int = 60
+        self,
+        wait_type: str = "on_message",
+        check=None,
+        timeout: int = 60,
+        client_id: Optional[int] = None,
     ) -> Optional[dict]:
-        wait_event = asyncio.Future()
-
-        async def wrapped(message):
-            if check(message):
-                self.remove_callback(wrapped, callback_type="on_message")
-                print(f"{wait_type} > {message}")
-                wait_event.set_result(message)
-
-        kwargs = {"func": wrapped, "callback_type": wait_type}
-
-        self.add_callback(**kwargs)
+        """
+        Waits for the next message (or disconnect) that passes `check(message)`
+        Params:
+         - client_id (int) : Only wait for this client
+        Returns:
+         - The message
+        Raises:
+         - asyncio.TimeoutError
+        """
         try:
-            return await asyncio.wait_for(wait_event, timeout=timeout)
+            args = await self.events.wait_for(
+                CALLBACK_EVENTS[wait_type],
+                None if check is None else lambda message, *_: check(message),
+                client_id=client_id,
+                timeout=timeout,
+            )
         except asyncio.TimeoutError:
-            self.remove_callback(**kwargs)
             raise asyncio.TimeoutError(f"Timed out waiting for a response")
+        return args[0]
 
-    def get_ws(self, socket_id: int):
-        if socket := self.connected.get(str(socket_id)):
-            return socket["ws"]
+    def get_ws(self, socket_id: int) -> Optional[Union[LocalSocket, RemoteSocket]]:
+        """
+        Returns:
+         - A LocalSocket whose `send_json` queues like `send_to`, a
+           RemoteSocket with the same `send_json` if another worker holds
+           the client, None if it is not connected
+        """
+        if socket_id in self.connected:
+            return LocalSocket(self, socket_id)
+        return self.directory.proxy(socket_id)
 
     @classmethod
-    def add_callback(cls, func, callback_type: str = "on_message"):
-        cls.logger.info(f"Adding callback {func.__name__}.")
+    def add_callback(
+        cls,
+        func,
+        callback_type: str = "on_message",
+        client_id: Optional[int] = None,
+    ) -> Handle:
         """
         callback_types:
-        - on_message
-        - on_disconnect
+        - on_message, called with (message, name)
+        - on_disconnect, called with (name)
+
+        Returns:
+         - The handle, `handle.remove()` is cheaper than `remove_callback`
         """
-        try:
-            for i in cls.name_to_guild.values():
-                cls._callbacks[i][callback_type] = cls._callbacks[i].get(
-                    callback_type, []
-                )
-                cls._callbacks[i][callback_type].append({"func": func})
-        except Exception as e:
-            cls.logger.error(
-                f"Error adding callback {func.__name__} for {callback_type} {e}"
-            )
+        cls.logger.info(f"Adding callback {func.__name__}.")
+        return cls.events.on(CALLBACK_EVENTS[callback_type], func, client_id=client_id)
 
     @classmethod
-    def remove_callback(cls, func, callback_type: str = "on_message"):
+    def remove_callback(
+        cls,
+        func,
+        callback_type: str = "on_message",
+        client_id: Optional[int] = None,
+    ):
         cls.logger.info(f"Remove callback {func.__name__}")
-
-        for guild_name, data in cls._callbacks.items():
-            for i in data[callback_type]:
-                if i["func"] == func:
-                    cls._callbacks[guild_name][callback_type].remove(i)
+        cls.events.off_func(CALLBACK_EVENTS[callback_type], func, client_id=client_id)
 
     # def main(self):
     #     self.logger.info("Starting websocket server manager...")
@@ -0,0 +1,128 @@
+"""
+Compares the storage backends on the same workload: upload FILES files of
+SIZE bytes with CONCURRENCY uploads in flight, list the folder, read every
+file back and delete them all. Runs without any network:
+
+    python bench.py [files] [size] [concurrency]
+
+"memory" is S3Storage on top of an in-process fake bucket, so it measures
+our S3 code path, "memory+5ms" adds a 5ms delay per call to mimic a nearby
+bucket. Set S3_ENDPOINT_URL (and the AWS_* variables) to add a real bucket
+or a local stand-in like moto_server or minio.
+"""
+import asyncio
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# the apps share the modules in ../shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.storage import FakeS3Client, LocalStorage, S3Storage
+from utils.blobstore import BlobStore
+
+FILES = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024
+CONCURRENCY = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+FOLDER = "bench"
+
+
+class Upload:
+    def __init__(self, data: bytes):
+        self.file = io.BytesIO(data)
+        self.content_type = "application/octet-stream"
+
+    async def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+
+async def limited(jobs):
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def run(job):
+        async with semaphore:
+            await job
+
+    await asyncio.gather(*(run(job) for job in jobs))
+
+
+async def put_all(storage, payload):
+    await limited(
+        storage.put(FOLDER, f"file-{i:06}", Upload(payload)) for i in range(FILES)
+    )
+
+
+async def list_all(storage):
+    cursor, count = None, 0
+    while True:
+        entries, cursor = await storage.list(FOLDER, cursor=cursor, limit=1000)
+        count += len(entries)
+        if cursor is None:
+            break
+    assert count == FILES, f"listed {count} of {FILES} files"
+
+
+async def read_all(storage):
+    async def read(name):
+        _, chunks = await storage.open(FOLDER, name)
+        async for _ in chunks:
+            pass
+
+    await limited(read(f"file-{i:06}") for i in range(FILES))
+
+
+async def delete_all(storage):
+    results = await storage.delete_many(FOLDER, prefix="file-")
+    assert len(results) == FILES and not any(results.values())
+
+
+async def bench(name, storage):
+    payload = os.urandom(SIZE)
+    row = [f"{name:>12}"]
+    for step in (put_all, list_all, read_all, delete_all):
+        start = time.perf_counter()
+        if step is put_all:
+            await step(storage, payload)
+        else:
+            await step(storage)
+        elapsed = time.perf_counter() - start
+        row.append(f"{step.__name__} {FILES / elapsed:>8.0f}/s")
+    print("  ".join(row))
+
+
+async def main():
+    print(f"{FILES} files of {SIZE} bytes, {CONCURRENCY} concurrent")
+    root = tempfile.mkdtemp(prefix="storage-bench-")
+    try:
+        await bench("local", LocalStorage(os.path.join(root, "local")))
+        blobs = BlobStore(
+            os.path.join(root, "blobs"),
+            os.path.join(root, "content"),
+            chunk_size=1024 * 1024,
+            max_size=0,
+        )
+        await blobs.load()
+        await bench("blobs", blobs)
+        await bench("memory", S3Storage(FakeS3Client(), "bench"))
+        await bench("memory+5ms", S3Storage(FakeS3Client(latency=0.005), "bench"))
+
+        if os.getenv("S3_ENDPOINT_URL"):
+            from aiobotocore.session import get_session
+
+            from shared.r2 import BUCKET_NAME, create_s3_client
+
+            async with create_s3_client(get_session()) as client:
+                try:
+                    await client.create_bucket(Bucket=BUCKET_NAME)
+                except Exception:
+                    pass
+                await bench("s3", S3Storage(client, BUCKET_NAME))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+asyncio.run(main())
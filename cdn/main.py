@@ -1,28 +1,61 @@
+import hmac
+import math
 import os
-from base64 import b64encode
+import sys
+from contextlib import AsyncExitStack
 from json import dumps as JSON_ENCODER
 from typing import Optional
 
-import aiofiles
 import uvicorn
-from aiohttp import ClientSession
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, UploadFile
+from fastapi import FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from loguru import logger
 
-from utils.checks import isMooshi, isUserAuthorized, parse_user_form_cookie
+# the apps share the modules in ../shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.discord import DiscordClient, DiscordRateLimited
+from shared.metrics import Metrics
+from shared.sessions import SESSION_TTL, issue_token, revoke_token
+from shared.storage import (
+    SORT_FIELDS,
+    FakeS3Client,
+    InvalidCursor,
+    LocalStorage,
+    S3Storage,
+    Storage,
+    is_plain_name,
+)
+from shared.uploads import MultipartFile, UploadTooLarge
+from utils.blobstore import BlobStore
+from utils.checks import (
+    ADMIN_ID,
+    get_cached_user,
+    invalidate_user,
+    isMooshi,
+    isUserAuthorized,
+    parse_user_form_cookie,
+    user_cache,
+)
 from utils.database import db
+from utils.responses import ContentFileResponse
+from utils.uploads import UploadLimitMiddleware
 
 load_dotenv()
 
 _PORT = int(os.getenv("PORT"))
 _HOST = os.getenv("HOST")
 
-API_ENDPOINT = "https://discord.com/api/v10"
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
@@ -33,6 +66,19 @@ ACCOUNT_ID = os.getenv("AWS_ACCOUNT_ID")
 
 BASE_URL = f"https://cdn.mooshi.ml"
 
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 100 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "storage")
+CONTENT_CACHE_CONTROL = os.getenv(
+    "CONTENT_CACHE_CONTROL", "public, max-age=31536000, immutable"
+)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+MAX_BATCH_DELETE = int(os.getenv("MAX_BATCH_DELETE", 1000))
+
+# blobs (deduplicating store, the default), local (plain files), s3 (the R2
+# bucket) or memory (an in-process fake of S3, for load tests)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "blobs")
+
 if os.name == "nt":
     _HOST = "192.168.0.11"
     REDIRECT_URI = f"http://{_HOST}:{_PORT}/auth/handshake"
@@ -51,10 +97,13 @@ class APIWrapper(FastAPI):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.session: ClientSession = None
+        self.discord: DiscordClient = None
+        self.storage: Storage = None
+        self._exit_stack = AsyncExitStack()
 
 
 app = APIWrapper()
+app.add_middleware(UploadLimitMiddleware, max_size=MAX_UPLOAD_SIZE)
 
 # app.add_middleware(
 #     CORSMiddleware,
@@ -66,51 +115,129 @@ app = APIWrapper()
 
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/content", StaticFiles(directory="content"), name="content")
 templates = Jinja2Templates(directory="static/templates")
 
+metrics = Metrics("cdn")
+metrics.add_collector(
+    "auth_cache_lookups_total",
+    "counter",
+    "Authorization cache lookups by result",
+    lambda: [
+        ({"result": "hit"}, user_cache.hits),
+        ({"result": "miss"}, user_cache.misses),
+    ],
+)
+metrics.add_collector(
+    "auth_cache_entries", "gauge", "Authorization cache entries", lambda: len(user_cache)
+)
+metrics.add_collector(
+    "discord_profile_cache_lookups_total",
+    "counter",
+    "Discord profile cache lookups by result",
+    lambda: [
+        ({"result": "hit"}, app.discord.profiles.hits),
+        ({"result": "miss"}, app.discord.profiles.misses),
+    ],
+)
+metrics.add_collector(
+    "discord_coalesced_requests_total",
+    "counter",
+    "Discord requests that joined one already in flight",
+    lambda: app.discord.coalesced,
+)
+metrics.add_collector(
+    "discord_rate_limit_waits_total",
+    "counter",
+    "Discord requests held back to stay inside a rate limit",
+    lambda: app.discord.rate_limits.waits,
+)
+metrics.add_collector(
+    "discord_rate_limited_total",
+    "counter",
+    "429 responses from Discord",
+    lambda: app.discord.rate_limits.limited,
+)
+
 
 @app.on_event("startup")
 async def app_startup():
-    app.session = ClientSession()
+    app.discord = DiscordClient(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
     logger.info("Started session")
+    app.storage = await open_storage()
+    logger.info(f"Using {type(app.storage).__name__} for {STORAGE_BACKEND} storage")
 
 
 @app.on_event("shutdown")
 async def app_shutdown():
-    await app.session.close()
+    await app.discord.close()
     logger.info("Closed session")
+    await app._exit_stack.aclose()
 
 
-async def exchange_code(code: str) -> Optional[str]:
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type": "authorization_code",
-        "code": code,
-        "redirect_uri": REDIRECT_URI,
-        "scope": "identify",
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+async def open_storage() -> Storage:
+    if STORAGE_BACKEND == "blobs":
+        storage = BlobStore(
+            BLOB_STORE_DIR,
+            "content",
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            max_size=MAX_UPLOAD_SIZE,
+        )
+        await storage.load()
+        return storage
+    if STORAGE_BACKEND == "local":
+        return LocalStorage("content", chunk_size=UPLOAD_CHUNK_SIZE)
+    if STORAGE_BACKEND == "memory":
+        return S3Storage(FakeS3Client(), BUCKET_NAME or "memory")
+    if STORAGE_BACKEND != "s3":
+        raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+
+    # only the s3 backend needs aiobotocore
+    from aiobotocore.session import get_session
+
+    from shared.r2 import S3_PART_SIZE, S3_UPLOAD_CONCURRENCY, create_s3_client
+
+    client = await app._exit_stack.enter_async_context(
+        create_s3_client(get_session())
+    )
+    return S3Storage(
+        client,
+        BUCKET_NAME,
+        part_size=S3_PART_SIZE,
+        concurrency=S3_UPLOAD_CONCURRENCY,
+    )
 
-    async with app.session.post(
-        "https://discord.com/api/oauth2/token", data=data, headers=headers
-    ) as response:
-        data = await response.json()
-        # logger.debug(f"Got response from discord: {data}")
-        if data.get("error") or data.get("message"):
-            logger.error(data)
-            return None
-        return data.get("access_token", data)
 
+@app.api_route("/content/{folder}/{filename}", methods=["GET", "HEAD"])
+async def content(request: Request, folder: str, filename: str):
+    if not is_plain_name(folder) or not is_plain_name(filename):
+        return JSONResponse({"error": "File does not exist"}, 404)
+
+    if path := app.storage.path(folder, filename):
+        entry = await app.storage.get(folder, filename)
+        if entry is None:
+            return JSONResponse({"error": "File does not exist"}, 404)
+        return ContentFileResponse(
+            path,
+            entry["etag"],
+            entry["content_type"],
+            request.headers,
+            cache_control=CONTENT_CACHE_CONTROL,
+            method=request.method,
+        )
 
-async def get_user(access_token):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with app.session.get(
-        f"{API_ENDPOINT}/users/@me", headers=headers
-    ) as response:
-        data = await response.json()
-        return data
+    opened = await app.storage.open(folder, filename)
+    if opened is None:
+        return JSONResponse({"error": "File does not exist"}, 404)
+    entry, chunks = opened
+    return StreamingResponse(
+        chunks,
+        media_type=entry["content_type"],
+        headers={
+            "Content-Length": str(entry["size"]),
+            "ETag": f'"{entry["etag"]}"',
+            "Cache-Control": CONTENT_CACHE_CONTROL,
+        },
+    )
 
 
 @app.get("/auth/login")
@@ -125,6 +252,7 @@ async def login(request: Request) -> None:
 async def logout(request: Request) -> None:
     if not await isUserAuthorized(request.cookies):
         return JSONResponse({"error": "You do not have access to this page"}, 403)
+    revoke_token(request.cookies.get("user"))
     response = RedirectResponse("/", 303)
     response.delete_cookie("user")
     return response
@@ -132,35 +260,41 @@ async def logout(request: Request) -> None:
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request) -> None:
-    logger.debug(f"Authorized: {await isUserAuthorized(request.cookies)}")
-    if not await isUserAuthorized(request.cookies):
+    authorized = await isUserAuthorized(request.cookies)
+    logger.debug(f"Authorized: {authorized}")
+    if not authorized:
         return templates.TemplateResponse("login.html", {"request": request})
     else:
         if isMooshi(request.cookies):
             response = templates.TemplateResponse("admin.html", {"request": request})
         else:
             response = templates.TemplateResponse("index.html", {"request": request})
-        response.set_cookie("user", request.cookies.get("user"))
-        cookie_user = parse_user_form_cookie(request.cookies)
-        cookie_user["_id"] = cookie_user.get("id", "0")
-        db_user = await db.users.get_by_id(cookie_user.get("id", None))
-        # print(db_user)
-        if db_user and (db_user.get("username") is None):
-            await db.users.upsert(cookie_user)
         return response
 
 
 @app.get("/clear_cookies")
 async def cookie_clear(request: Request):
+    revoke_token(request.cookies.get("user"))
     response = RedirectResponse("/", 303)
     response.delete_cookie("user")
     return response
 
 
+def rate_limited_login(error: DiscordRateLimited) -> JSONResponse:
+    return JSONResponse(
+        {"error": "Discord is busy, try logging in again in a moment"},
+        503,
+        headers={"Retry-After": str(math.ceil(error.retry_after))},
+    )
+
+
 @app.get("/auth/handshake")
 async def handshake(request: Request):
     if code := request.query_params.get("code"):
-        access_token = await exchange_code(code)
+        try:
+            access_token = await app.discord.exchange_code(code)
+        except DiscordRateLimited as e:
+            return rate_limited_login(e)
         print(access_token)
     else:  # gon be evil and keep redirecting them to discord's oauth2 page until they approve ;)
         return RedirectResponse(
@@ -168,22 +302,29 @@ async def handshake(request: Request):
             303,
         )
 
-    user = await get_user(access_token)
+    try:
+        user = await app.discord.get_user(access_token)
+    except DiscordRateLimited as e:
+        return rate_limited_login(e)
+    user_id = user.get("id", "girthychode69420")
+    db_user = await get_cached_user(user_id)
+    if db_user:
+        user["_id"] = user_id
+        await db.users.upsert(user)
+        invalidate_user(user_id)
+
     response = RedirectResponse("/", 303)
     response.set_cookie(
         "user",
-        b64encode(JSON_ENCODER(user).encode("utf-8")).decode("utf-8"),
+        issue_token(user, role="admin" if user_id == ADMIN_ID else "user"),
+        max_age=SESSION_TTL,
         httponly=True,
     )
-    db_user = await db.users.get_by_id(user.get("id", "girthychode69420"))
-    if db_user:
-        user["_id"] = user.get("id", "0")
-        await db.users.upsert(user)
     return response
 
 
 @app.post("/upload")
-async def upload(request: Request, file: UploadFile) -> None:
+async def upload(request: Request) -> None:
 
     if not request.cookies.get("user"):
         return JSONResponse(
@@ -197,23 +338,40 @@ async def upload(request: Request, file: UploadFile) -> None:
     if not folder:
         return JSONResponse({"error": "You do not have access to this page"}, 401)
 
+    # the body is streamed to storage as it arrives instead of being spooled
+    try:
+        file = await MultipartFile.open(request, max_size=MAX_UPLOAD_SIZE)
+    except UploadTooLarge as e:
+        return JSONResponse({"error": str(e)}, 413)
+    except ValueError:
+        return JSONResponse({"error": "Invalid multipart body"}, 400)
     if not file:
         return JSONResponse({"error": "No file param was provided"}, 400)
 
-    if not os.path.exists(f"content/{folder}"):
-        os.makedirs(f"content/{folder}")
+    filename = os.path.basename(file.filename or "")
+    if not filename:
+        return JSONResponse({"error": "No file param was provided"}, 400)
+    if not is_plain_name(filename):
+        return JSONResponse({"error": "Invalid filename"}, 400)
 
-    async with aiofiles.open(f"content/{folder}/{file.filename}", "wb+") as f:
-        await f.write(file.file.read())
+    try:
+        await app.storage.put(folder, filename, file, content_type=file.content_type)
+    except UploadTooLarge as e:
+        return JSONResponse({"error": str(e)}, 413)
+    except ValueError:
+        return JSONResponse({"error": "Invalid multipart body"}, 400)
 
-    return {"message": f"https://cdn.mooshi.ml/content/{folder}/{file.filename}"}
+    return {"message": f"https://cdn.mooshi.ml/content/{folder}/{filename}"}
 
 
 @app.delete("/delete")
 async def delete(
-    request: Request, filename: Optional[str] = None, user_id: Optional[str] = None
+    request: Request,
+    filename: Optional[list[str]] = Query(None),
+    prefix: Optional[str] = None,
+    user_id: Optional[str] = None,
 ) -> None:
-    logger.info(f"Filename: {filename} User: {user_id}")
+    logger.info(f"Filename: {filename} Prefix: {prefix} User: {user_id}")
     if not request.cookies.get("user"):
         return JSONResponse(
             {"error": "This endpoint requires valid authentication"}, 401
@@ -226,32 +384,46 @@ async def delete(
     if not folder:
         return JSONResponse({"error": "You do not have access to this page"}, 401)
 
-    if not filename and not user_id:
-        return JSONResponse({"error": "No filename or user_id param was provided"}, 400)
-
-    if filename:
-        if not os.path.exists(f"content/{folder}"):
-            os.makedirs(f"content/{folder}")
-
-        if not os.path.exists(f"content/{folder}/{filename}"):
-            return {"error": "File does not exist"}
-
-        os.remove(f"content/{folder}/{filename}")
+    if not filename and prefix is None and not user_id:
+        return JSONResponse(
+            {"error": "No filename, prefix or user_id param was provided"}, 400
+        )
 
-        return {"message": "File deleted successfully"}
+    if filename or prefix is not None:
+        if user_id:
+            return JSONResponse(
+                {"error": "Files and users can not be deleted together"}, 400
+            )
+        if len(filename or ()) > MAX_BATCH_DELETE:
+            return JSONResponse(
+                {"error": f"At most {MAX_BATCH_DELETE} filenames per request"}, 400
+            )
+
+        errors = await app.storage.delete_many(
+            folder, (os.path.basename(name) for name in filename or ()), prefix=prefix
+        )
+        deleted = sum(error is None for error in errors.values())
+        results = {name: error or "deleted" for name, error in errors.items()}
+        if not deleted:
+            if len(results) == 1:
+                return {"error": "File does not exist", "results": results}
+            return {"error": "No files were deleted", "results": results}
+
+        if len(results) == 1:
+            return {"message": "File deleted successfully", "results": results}
+        return {
+            "message": f"Deleted {deleted} of {len(results)} files",
+            "results": results,
+        }
 
     elif user_id:
-        user_data = await db.users.get_by_id(user_id)
+        user_data = await db.users.find_and_delete(user_id)
         if not user_data:
             return {"error": "User does not have access to the database."}
         else:
-            user_data = await db.users.delete_by_id(user_id)
+            invalidate_user(user_id)
             return {"message": "User deleted successfully", "data": user_data}
 
-    else:
-        # can only provide one param at a time
-        return JSONResponse({"error": "You can only provide one param at a time"}, 400)
-
 
 @app.get("/users")
 async def get_users(request: Request) -> None:
@@ -262,9 +434,17 @@ async def get_users(request: Request) -> None:
     if not isMooshi(request.cookies):
         return JSONResponse({"error": "You do not have access to this page"}, 401)
 
-    users = await db.users.get_all()
-    # logger.debug(f"Returning: {users}")
-    return JSONResponse({"users": users}, 200)
+    async def stream_users():
+        yield '{"users": ['
+        separator = ""
+        async for user in db.users.iter_all(
+            batch_size=500, projection=["username", "discriminator"]
+        ):
+            yield separator + JSON_ENCODER(user)
+            separator = ","
+        yield "]}"
+
+    return StreamingResponse(stream_users(), 200, media_type="application/json")
 
 
 @app.post("/add_user")
@@ -279,16 +459,33 @@ async def add_user(request: Request, user_id: Optional[str]) -> None:
     if not user_id:
         return JSONResponse({"error": "No user_id param was provided"}, 400)
 
-    user_data = await db.users.get_by_id(user_id)
-    if not user_data:
-        await db.users.upsert({"_id": user_id})
+    if await db.users.insert_if_absent({"_id": user_id}):
+        invalidate_user(user_id)
         return {"message": "User added successfully"}
     else:
         return {"error": "User is already in the database."}
 
 
+@app.get("/stats/auth_cache")
+async def auth_cache_stats(request: Request) -> None:
+    if not request.cookies.get("user"):
+        return JSONResponse(
+            {"error": "This endpoint requires valid authentication"}, 401
+        )
+    if not isMooshi(request.cookies):
+        return JSONResponse({"error": "You do not have access to this page"}, 401)
+
+    return user_cache.stats()
+
+
 @app.get("/files")
-async def get_files(request: Request) -> None:
+async def get_files(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    sort: str = "mtime",
+    order: str = "desc",
+) -> None:
     if not request.cookies.get("user"):
         return JSONResponse(
             {"error": "This endpoint requires valid authentication"}, 401
@@ -301,22 +498,70 @@ async def get_files(request: Request) -> None:
     if not folder:
         return JSONResponse({"error": "You do not have access to this page"}, 401)
 
-    folder_url = f"{BASE_URL}/{folder}"
+    if sort not in SORT_FIELDS:
+        return JSONResponse(
+            {"error": f"sort must be one of: {', '.join(SORT_FIELDS)}"}, 400
+        )
+    if order not in ("asc", "desc"):
+        return JSONResponse({"error": "order must be asc or desc"}, 400)
+    if not 1 <= limit <= 1000:
+        return JSONResponse({"error": "limit must be between 1 and 1000"}, 400)
 
-    if not os.path.exists(f"content/{folder}"):
-        os.makedirs(f"content/{folder}")
+    folder_url = f"{BASE_URL}/{folder}"
 
     try:
-        return {
-            "message": folder_url,
-            "files": [
-                f"{BASE_URL}/content/{folder}/{x}"
-                for x in os.listdir(f"content/{folder}")
-            ],
-        }
+        entries, next_cursor = await app.storage.list(
+            folder, sort=sort, reverse=order == "desc", cursor=cursor, limit=limit
+        )
+    except InvalidCursor:
+        return JSONResponse({"error": "Invalid cursor"}, 400)
     except Exception as e:
         return {"message": f"Something went wrong!: {e}"}
 
+    return {
+        "message": folder_url,
+        "files": [
+            entry | {"url": f"{BASE_URL}/content/{folder}/{entry['name']}"}
+            for entry in entries
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+@app.post("/files/rebuild")
+async def rebuild_files(request: Request) -> None:
+    if not request.cookies.get("user"):
+        return JSONResponse(
+            {"error": "This endpoint requires valid authentication"}, 401
+        )
+    if not await isUserAuthorized(request.cookies):
+        return JSONResponse({"error": "You do not have access to this page"}, 401)
+
+    user = parse_user_form_cookie(request.cookies)
+    folder = user.get("id")
+    if not folder:
+        return JSONResponse({"error": "You do not have access to this page"}, 401)
+
+    if not isinstance(app.storage, BlobStore):
+        return JSONResponse({"error": "Only the blob store keeps a file index"}, 400)
+
+    index = await app.storage.rebuild(folder)
+    return {"message": "File index rebuilt successfully", "files": len(index)}
+
+
+@app.get("/metrics")
+async def get_metrics(request: Request) -> None:
+    auth = request.headers.get("Authorization", "")
+    if not METRICS_TOKEN or not hmac.compare_digest(
+        auth.encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8")
+    ):
+        return JSONResponse({"error": "You do not have access to this page"}, 401)
+
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+metrics.instrument(app)
+
 
 if __name__ == "__main__":
     logger.info("Starting server")
@@ -2,17 +2,6 @@ const base_url = "https://cdn.mooshi.ml";
 
 // const base_url = "http://192.168.0.11:8080";
 
-function getCookie(name) {
-  var nameEQ = name + "=";
-  var ca = document.cookie.split(";");
-  for (var i = 0; i < ca.length; i++) {
-    var c = ca[i];
-    while (c.charAt(0) == " ") c = c.substring(1, c.length);
-    if (c.indexOf(nameEQ) == 0) return c.substring(nameEQ.length, c.length);
-  }
-  return null;
-}
-
 const btn_upload = document.getElementById("btn_upload");
 btn_upload.addEventListener("click", () => {
   // console.log("Upload");
@@ -52,18 +41,9 @@ file_input.onchange = function () {
 };
 
 function fetch_users() {
-  try {
-    let cookie = getCookie("user");
-    let decoded_cookie = atob(cookie.substring(1, cookie.length - 1));
-    let json_cookie = JSON.parse(decoded_cookie);
-    if (json_cookie.id != "383287544336613385") {
-      // console.log(json_cookie.id);
-      // console.log("383287544336613385");
-      // console.log("Not admin");
-      return;
-    }
-  } catch (err) {
-    console.log(err);
+  // only the admin page has a users list
+  if (document.getElementById("users_ul") == null) {
+    return;
   }
 
   // console.log("Sending fetch request...");
@@ -136,8 +116,12 @@ function fetch_users() {
     });
 }
 
-function fetch_files() {
-  fetch(`${base_url}/files`)
+function fetch_files(cursor = null) {
+  let url = `${base_url}/files`;
+  if (cursor != null) {
+    url += `?cursor=${encodeURIComponent(cursor)}`;
+  }
+  fetch(url)
     .then((res) => res.json())
     .then((data) => {
       // console.log(data);
@@ -150,8 +134,9 @@ function fetch_files() {
       const files_ul = document.getElementById("files_ul");
 
       if (data.files != null) {
-        data.files.forEach((file_url) => {
-          const filename = file_url.split("/").slice(-1)[0];
+        data.files.forEach((file) => {
+          const file_url = file.url;
+          const filename = file.name;
 
           const li = document.createElement("li");
           const a = document.createElement("a");
@@ -199,6 +184,10 @@ function fetch_files() {
           files_ul.appendChild(li);
         });
       }
+
+      if (data.next_cursor != null) {
+        fetch_files(data.next_cursor);
+      }
     })
     .catch((err) => console.log(err));
 }
@@ -0,0 +1,382 @@
+import asyncio
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import defaultdict
+from contextlib import suppress
+from json import dumps as JSON_ENCODER
+from json import loads as JSON_DECODER
+from typing import AsyncIterator, Iterable, Optional
+
+import aiofiles
+from loguru import logger
+
+from shared.storage import Storage, is_plain_name, make_entry, paginate
+
+from .uploads import spool_upload
+
+# journals are compacted once they have this many more lines than entries
+COMPACT_SLACK = 1000
+
+
+class BlobStore(Storage):
+    """
+    Content addressed, deduplicating storage for the cdn.
+
+    Every unique file is written once to `{root}/blobs` under its sha256
+    digest. A user's `{content_dir}/{folder}/{name}` is a hard link to that
+    blob, so the public /content urls keep resolving unchanged, and the
+    link count of a blob doubles as its reference count: once only the
+    copy in `blobs` is left nothing references it and it gets removed.
+
+    Each folder's index maps every name to its size, mtime, content type
+    and etag (the blob digest). It is kept in memory and journaled to
+    `{root}/refs/{folder}.log`, one JSON line per put or delete, so a write
+    appends a line instead of rewriting the folder's index. A journal is
+    compacted to one line per entry once it grew COMPACT_SLACK lines past
+    that. `load` reads the journals at startup, so listing a folder never
+    touches the filesystem; only `rebuild` scans the folder again.
+    """
+
+    def __init__(self, root: str, content_dir: str, *, chunk_size: int, max_size: int):
+        self.root = root
+        self.content_dir = content_dir
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.refs_dir = os.path.join(root, "refs")
+        self.temp_dir = os.path.join(root, "tmp")
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+
+        for path in (self.content_dir, self.blobs_dir, self.refs_dir, self.temp_dir):
+            os.makedirs(path, exist_ok=True)
+
+        self._index: dict[str, dict[str, dict]] = {}
+        # lines in each folder's journal, to know when to compact it
+        self._journal_lines: dict[str, int] = {}
+        # blob placement and collection touch files shared between folders
+        self._lock = threading.Lock()
+        self._folder_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def load(self):
+        """
+        Reads every folder's journal into memory. Folders from before the
+        journal are indexed by scanning them, once. Call it at startup,
+        before any request is served
+        """
+        self._index = await asyncio.to_thread(self._load_all)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blobs_dir, digest[:2], digest[2:4], digest)
+
+    def path(self, folder: str, name: str) -> str:
+        """
+        Raises:
+         - ValueError if either part could escape the content dir
+        """
+        if not is_plain_name(folder) or not is_plain_name(name):
+            raise ValueError(f"Invalid file name: {folder}/{name}")
+        return os.path.join(self.content_dir, folder, name)
+
+    async def put(
+        self, folder: str, name: str, file, *, content_type: Optional[str] = None
+    ) -> dict:
+        """
+        Stores `file` as `folder/name`, replacing any previous file with that name
+        Returns:
+         - The index entry of the stored file
+        Raises:
+         - UploadTooLarge if the file is bigger than the configured max size
+        """
+        content_type = content_type or getattr(file, "content_type", None)
+        hasher = hashlib.sha256()
+        temp_path, size = await spool_upload(
+            file,
+            temp_dir=self.temp_dir,
+            chunk_size=self.chunk_size,
+            max_size=self.max_size,
+            hasher=hasher,
+        )
+        digest = hasher.hexdigest()
+
+        async with self._folder_locks[folder]:
+            index = self._folder_index(folder)
+            old = index.get(name)
+            try:
+                await asyncio.to_thread(
+                    self._commit, temp_path, digest, folder, name, old and old["etag"]
+                )
+            finally:
+                with suppress(FileNotFoundError):
+                    os.remove(temp_path)
+            entry = make_entry(name, size, time.time(), content_type, digest)
+            index[name] = entry
+            await self._journal(folder, {"put": entry})
+
+        return entry
+
+    async def delete_many(
+        self, folder: str, names: Iterable[str] = (), *, prefix: Optional[str] = None
+    ) -> dict[str, Optional[str]]:
+        """
+        Removes several files of a folder with a single trip off the event
+        loop and a single journal line
+        Params:
+         - names (Iterable[str]) : The files to remove
+         - prefix (str) : Also remove every indexed file starting with this
+        Returns:
+         - Every requested name mapped to None if it was removed, or why not
+        """
+        async with self._folder_locks[folder]:
+            index = self._folder_index(folder)
+            names = dict.fromkeys(names)
+            if prefix is not None:
+                names.update(dict.fromkeys(n for n in index if n.startswith(prefix)))
+
+            entries = {name: index.pop(name, None) for name in names}
+            results = await asyncio.to_thread(self._unlink_many, folder, entries)
+            if removed := [name for name, entry in entries.items() if entry]:
+                await self._journal(folder, {"delete": removed})
+        return results
+
+    async def get(self, folder: str, name: str) -> Optional[dict]:
+        return self._folder_index(folder).get(name)
+
+    async def open(
+        self, folder: str, name: str
+    ) -> Optional[tuple[dict, AsyncIterator[bytes]]]:
+        entry = await self.get(folder, name)
+        if entry is None:
+            return None
+        try:
+            f = await aiofiles.open(self.path(folder, name), "rb")
+        except FileNotFoundError:
+            return None
+
+        async def chunks():
+            try:
+                while chunk := await f.read(self.chunk_size):
+                    yield chunk
+            finally:
+                await f.close()
+
+        return entry, chunks()
+
+    async def list(
+        self,
+        folder: str,
+        *,
+        sort: str = "name",
+        reverse: bool = False,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+    ) -> tuple[list[dict], Optional[str]]:
+        index = self._folder_index(folder)
+        return paginate(index, sort=sort, reverse=reverse, cursor=cursor, limit=limit)
+
+    async def rebuild(self, folder: str) -> dict:
+        """
+        Rescans the folder on disk and rewrites its index from what is
+        actually there, adopting files that are not in the blob store yet
+        Returns:
+         - The new index
+        """
+        if not is_plain_name(folder):
+            return {}
+        async with self._folder_locks[folder]:
+            old = self._folder_index(folder)
+            index = await asyncio.to_thread(self._scan, folder, old)
+            self._index[folder] = index
+            await asyncio.to_thread(self._compact, folder, list(index.values()))
+        return index
+
+    # <-- Filesystem work, run off the event loop -->
+    def _commit(self, temp_path, digest, folder, name, old_digest):
+        blob = self.blob_path(digest)
+        target = self.path(folder, name)
+
+        with self._lock:
+            if os.path.exists(blob):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(temp_path, blob)
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self._link(blob, target)
+
+            if old_digest and old_digest != digest:
+                self._collect(old_digest)
+
+    def _link(self, blob, target):
+        # a name of its own, a link left behind by a crash or linked by another
+        # worker sharing the root would make os.link fail
+        name = f"{os.path.basename(blob)}.{secrets.token_hex(8)}.link"
+        link_path = os.path.join(self.temp_dir, name)
+        os.link(blob, link_path)
+        try:
+            os.replace(link_path, target)
+        finally:
+            # rename() is a no-op when both names already point to the same
+            # blob, and a failed one leaves the link behind
+            with suppress(FileNotFoundError):
+                os.remove(link_path)
+
+    def _unlink_many(self, folder, entries: dict) -> dict[str, Optional[str]]:
+        results = {}
+        digests = set()
+        with self._lock:
+            for name, entry in entries.items():
+                # without its digest the blob could never be collected, files
+                # the index does not know about wait for a rebuild instead
+                if entry is None:
+                    results[name] = "File does not exist"
+                    continue
+                try:
+                    os.remove(self.path(folder, name))
+                except FileNotFoundError:
+                    results[name] = "File does not exist"
+                    continue
+                results[name] = None
+                digests.add(entry["etag"])
+            for digest in digests:
+                self._collect(digest)
+        return results
+
+    def _collect(self, digest):
+        blob = self.blob_path(digest)
+        with suppress(FileNotFoundError):
+            if os.stat(blob).st_nlink <= 1:
+                os.remove(blob)
+
+    def _scan(self, folder, old) -> dict:
+        index = {}
+        if not is_plain_name(folder):
+            return index
+        folder_path = os.path.join(self.content_dir, folder)
+        if not os.path.isdir(folder_path):
+            os.makedirs(folder_path)
+
+        with os.scandir(folder_path) as it:
+            for item in it:
+                if not item.is_file():
+                    continue
+                digest = _hash_file(item.path, self.chunk_size)
+                blob = self.blob_path(digest)
+                with self._lock:
+                    if not os.path.exists(blob):
+                        os.makedirs(os.path.dirname(blob), exist_ok=True)
+                        os.link(item.path, blob)
+                    elif not os.path.samefile(blob, item.path):
+                        self._link(blob, item.path)
+
+                stat = os.stat(item.path)
+                previous = old.get(item.name)
+                if previous and previous["etag"] == digest:
+                    index[item.name] = previous
+                else:
+                    index[item.name] = make_entry(
+                        item.name, stat.st_size, stat.st_mtime, None, digest
+                    )
+
+        with self._lock:
+            for name, entry in old.items():
+                if name not in index or index[name]["etag"] != entry["etag"]:
+                    self._collect(entry["etag"])
+        return index
+
+    # <-- Index journals -->
+    def _folder_index(self, folder: str) -> dict:
+        if not is_plain_name(folder):
+            # never adopt or index anything outside the content dir
+            return {}
+        return self._index.setdefault(folder, {})
+
+    def _journal_path(self, folder: str) -> str:
+        return os.path.join(self.refs_dir, f"{folder}.log")
+
+    async def _journal(self, folder: str, record: dict):
+        """Appends `record` to the folder's journal, compacting it when due"""
+        index = self._index[folder]
+        if self._journal_lines.get(folder, 0) >= len(index) + COMPACT_SLACK:
+            await asyncio.to_thread(self._compact, folder, list(index.values()))
+        else:
+            await asyncio.to_thread(self._append, folder, JSON_ENCODER(record))
+
+    def _append(self, folder: str, line: str):
+        with open(self._journal_path(folder), "a") as f:
+            f.write(line + "\n")
+        self._journal_lines[folder] = self._journal_lines.get(folder, 0) + 1
+
+    def _compact(self, folder: str, entries: Iterable[dict]):
+        _write(
+            self._journal_path(folder),
+            "".join(JSON_ENCODER({"put": entry}) + "\n" for entry in entries),
+        )
+        self._journal_lines[folder] = len(entries)
+
+    def _replay(self, folder: str) -> dict:
+        index = {}
+        lines = 0
+        broken = False
+        with open(self._journal_path(folder), "r") as f:
+            for line in f:
+                try:
+                    record = JSON_DECODER(line)
+                except ValueError:
+                    # the last line of a write that was cut short
+                    broken = True
+                    continue
+                lines += 1
+                if entry := record.get("put"):
+                    index[entry["name"]] = entry
+                for name in record.get("delete", ()):
+                    index.pop(name, None)
+
+        if broken:
+            logger.warning(f"Skipped a broken line in the index of {folder}")
+            # appending after a line without its newline would break the next one
+            self._compact(folder, list(index.values()))
+        else:
+            self._journal_lines[folder] = lines
+        return index
+
+    def _load_all(self) -> dict[str, dict]:
+        indexes = {}
+        for item in os.scandir(self.refs_dir):
+            folder, extension = os.path.splitext(item.name)
+            if extension == ".log" and is_plain_name(folder):
+                indexes[folder] = self._replay(folder)
+
+        for item in os.scandir(self.refs_dir):
+            folder, extension = os.path.splitext(item.name)
+            if extension == ".json" and is_plain_name(folder):
+                # a whole-folder index from before the journals
+                if folder not in indexes:
+                    with open(item.path, "r") as f:
+                        indexes[folder] = JSON_DECODER(f.read())
+                    self._compact(folder, list(indexes[folder].values()))
+                os.remove(item.path)
+
+        for item in os.scandir(self.content_dir):
+            if item.is_dir() and is_plain_name(item.name) and item.name not in indexes:
+                logger.info(f"Indexing {item.name}, it predates the file index")
+                indexes[item.name] = self._scan(item.name, {})
+                self._compact(item.name, list(indexes[item.name].values()))
+        return indexes
+
+
+def _hash_file(path: str, chunk_size: int) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _write(path: str, data: str):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(data)
+    os.replace(temp_path, path)
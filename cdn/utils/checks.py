@@ -1,70 +1,49 @@
-from base64 import b64decode
-from json import loads as JSON_DECODER
+import os
+from typing import Optional
 
-from loguru import logger
+from shared.cache import MISSING, TTLCache
+from shared.sessions import verify_token
 
 from .database import db
 
+ADMIN_ID = "383287544336613385"
+
+# user id -> the user's db document (None if they are not in the database)
+user_cache = TTLCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("AUTH_CACHE_TTL", 60)),
+)
+
+
+async def get_cached_user(user_id: str) -> Optional[dict]:
+    user = user_cache.get(user_id)
+    if user is MISSING:
+        user = await db.users.get_by_id(user_id)
+        user_cache.set(user_id, user)
+    return user
+
+
+def invalidate_user(user_id: str):
+    user_cache.invalidate(user_id)
+
 
 async def isUserAuthorized(cookie: dict) -> bool:
-    user = cookie.get("user", None)
-    # logger.debug(f"Raw user: {user}")
-    if not user:
-        return False
-    decoded_user = b64decode(user.encode("utf-8")).decode("utf-8")
-    # logger.debug(f"Decoded user: {decoded_user}")
-    if isinstance(decoded_user, str):
-        try:
-            decoded_user = JSON_DECODER(decoded_user)
-        except Exception as e:
-            logger.error(e)
-            return False
-    if not isinstance(decoded_user, dict):
-        return False
-    if resp := await db.users.get_by_id(decoded_user.get("id", "abracadabra")):
-        # logger.debug(f"DB response: {resp}")
-        return True
-
-    return False
+    # the token only says who the user is, their access can be taken away at
+    # any time, so whether they still have it comes from the database
+    user_id = parse_user_form_cookie(cookie).get("id")
+    return user_id is not None and await get_cached_user(user_id) is not None
 
 
 def isMooshi(cookie: dict) -> bool:
-    user = cookie.get("user", None)
-    # logger.debug(f"Raw user: {user}")
-    if not user:
-        return False
-    decoded_user = b64decode(user.encode("utf-8")).decode("utf-8")
-    # logger.debug(f"Decoded user: {decoded_user}")
-    if isinstance(decoded_user, str):
-        try:
-            decoded_user = JSON_DECODER(decoded_user)
-        except Exception as e:
-            logger.error(e)
-            return False
-    if not isinstance(decoded_user, dict):
-        return False
-    if decoded_user.get("id") == "383287544336613385":
-        return True
-    return False
-
-
-def parse_user_form_cookie(cookie: str) -> dict:
-    user = cookie.get("user", None)
-    if not user:
-        return {}
+    return parse_user_form_cookie(cookie).get("role") == "admin"
 
-    decoded_user = b64decode(user.encode("utf-8")).decode("utf-8")
 
-    if isinstance(decoded_user, str):
-        try:
-            decoded_user = JSON_DECODER(decoded_user)
-        except Exception as e:
-            logger.error(e)
-            return {}
-    elif not isinstance(decoded_user, dict):
+def parse_user_form_cookie(cookie: dict) -> dict:
+    token = cookie.get("user", None)
+    if not token:
         return {}
 
-    return decoded_user
+    return verify_token(token) or {}
 
 
 async def isKeyAuthorized(user_id: str, key: str) -> bool:
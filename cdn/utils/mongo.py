@@ -1,7 +1,9 @@
 import collections
 import logging
+import warnings
 
 from loguru import logger
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
 
 """
 A helper file for using mongo db
@@ -29,46 +31,80 @@ class Document:
         """
         await self.update_by_id(dict)
 
-    async def get_by_id(self, id):
+    async def get_by_id(self, id, projection=None):
         """
         This is essentially find_by_id so point to that
         """
-        return await self.find_by_id(id)
+        return await self.find_by_id(id, projection)
 
-    async def find(self, id):
+    async def find(self, id, projection=None):
         """
         For simpler calls, points to self.find_by_id
         """
-        return await self.find_by_id(id)
+        return await self.find_by_id(id, projection)
 
     async def delete(self, id):
         """
-        For simpler calls, points to self.delete_by_id
+        For simpler calls, points to self.delete_one_by_id
         """
-        await self.delete_by_id(id)
+        return await self.delete_one_by_id(id)
 
     # <-- Actual Methods -->
-    async def find_by_id(self, id):
+    async def find_by_id(self, id, projection=None):
         """
         Returns the data found under `id`
         Params:
          -  id () : The id to search for
+         -  projection (dict/list) : Optional fields to include or exclude
         Returns:
          - None if nothing is found
          - If somethings found, return that
         """
-        return await self.db.find_one({"_id": id})
+        return await self.db.find_one({"_id": id}, projection)
+
+    async def get_many(self, ids, projection=None):
+        """
+        Returns the documents found under any of `ids` in one query
+        Params:
+         -  ids (Iterable) : The ids to search for
+         -  projection (dict/list) : Optional fields to include or exclude
+        Returns:
+         - A list of the documents that exist, in no particular order
+        """
+        cursor = self.db.find({"_id": {"$in": list(ids)}}, projection)
+        return await cursor.to_list(None)
 
     async def delete_by_id(self, id):
         """
         Deletes all items found with _id: `id`
+        Deprecated, use delete_one_by_id or find_and_delete
         Params:
          -  id () : The id to search for and delete
         """
-        if not await self.find_by_id(id):
-            return
+        _deprecated("delete_by_id", "delete_one_by_id")
+        await self.delete_one_by_id(id)
 
-        await self.db.delete_many({"_id": id})
+    async def delete_one_by_id(self, id):
+        """
+        Deletes the item found with _id: `id` in a single round trip
+        Params:
+         -  id () : The id to search for and delete
+        Returns:
+         - True if a document was deleted
+        """
+        result = await self.db.delete_one({"_id": id})
+        return result.deleted_count > 0
+
+    async def find_and_delete(self, id, projection=None):
+        """
+        Atomically deletes the item found with _id: `id` and returns it
+        Params:
+         -  id () : The id to search for and delete
+         -  projection (dict/list) : Optional fields to include or exclude
+        Returns:
+         - The deleted document, None if nothing matched
+        """
+        return await self.db.find_one_and_delete({"_id": id}, projection)
 
     async def insert(self, dict):
         """
@@ -86,6 +122,29 @@ class Document:
 
         await self.db.insert_one(dict)
 
+    async def insert_if_absent(self, dict):
+        """
+        Inserts `dict` unless a document with its _id already exists,
+        atomically and in a single round trip
+        Params:
+        - dict (Dictionary) : The Dictionary to insert
+        Returns:
+         - True if the document was inserted
+        """
+        # Check if its actually a Dictionary
+        if not isinstance(dict, collections.abc.Mapping):
+            raise TypeError("Expected Dictionary.")
+
+        # Always use your own _id
+        if "_id" not in dict.keys():
+            raise KeyError("_id not found in supplied dict.")
+
+        data = {k: v for k, v in dict.items() if k != "_id"}
+        result = await self.db.update_one(
+            {"_id": str(dict["_id"])}, {"$setOnInsert": data}, upsert=True
+        )
+        return result.upserted_id is not None
+
     async def upsert(self, dict):
         """
         Makes a new item in the document, if it already exists
@@ -124,10 +183,21 @@ class Document:
         """
         For when you want to remove a field from
         a pre-existing document in the collection
-        This function parses an input Dictionary to get
-        the relevant information needed to unset.
+        Deprecated, use unset_by_id
+        Params:
+         - dict (Dictionary) : Dictionary to parse for info
+        """
+        _deprecated("unset", "unset_by_id")
+        await self.unset_by_id(dict)
+
+    async def unset_by_id(self, dict):
+        """
+        Removes the fields in `dict` from the document found
+        under its _id in a single round trip
         Params:
          - dict (Dictionary) : Dictionary to parse for info
+        Returns:
+         - True if a document matched
         """
         # Check if its actually a Dictionary
         if not isinstance(dict, collections.abc.Mapping):
@@ -137,35 +207,105 @@ class Document:
         if "_id" not in dict.keys():
             raise KeyError("_id not found in supplied dict.")
 
-        if not await self.find_by_id(dict["_id"]):
-            return
-
-        id = dict["_id"]
-        dict.pop("_id")
-        await self.db.update_one({"_id": id}, {"$unset": dict})
+        data = {k: v for k, v in dict.items() if k != "_id"}
+        result = await self.db.update_one({"_id": dict["_id"]}, {"$unset": data})
+        return result.matched_count > 0
 
     async def increment(self, id, amount, field):
         """
         Increment a given `field` by `amount`
+        Deprecated, use increment_by_id
         Params:
         - id () : The id to search for
         - amount (int) : Amount to increment by
         - field () : field to increment
         """
-        if not await self.find_by_id(id):
-            return
+        _deprecated("increment", "increment_by_id")
+        await self.increment_by_id(id, amount, field)
 
-        await self.db.update_one({"_id": id}, {"$inc": {field: amount}})
+    async def increment_by_id(self, id, amount, field):
+        """
+        Atomically increment a given `field` by `amount`
+        on an existing document
+        Params:
+        - id () : The id to search for
+        - amount (int) : Amount to increment by
+        - field () : field to increment
+        Returns:
+         - The updated document, None if nothing matched
+        """
+        return await self.db.find_one_and_update(
+            {"_id": id},
+            {"$inc": {field: amount}},
+            return_document=ReturnDocument.AFTER,
+        )
 
-    async def get_all(self):
+    async def get_all(self, projection=None):
         """
         Returns a list of all data in the document
+        Prefer iter_all for collections that can grow large
         """
         data = []
-        async for document in self.db.find({}):
+        async for document in self.db.find({}, projection):
             data.append(document)
         return data
 
+    async def iter_all(self, batch_size=100, projection=None):
+        """
+        Async iterator over all data in the document, fetched from the
+        server `batch_size` documents at a time so the whole collection
+        is never held in memory
+        Params:
+         - batch_size (int) : Documents per round trip
+         - projection (dict/list) : Optional fields to include or exclude
+        """
+        async for document in self.db.find({}, projection, batch_size=batch_size):
+            yield document
+
+    async def bulk_upsert(self, dicts, ordered=False):
+        """
+        Upserts many dictionaries in a single bulk_write,
+        see upsert for the per item behaviour
+        Params:
+         - dicts (Iterable) : The dicts to insert, each with an `_id`
+         - ordered (bool) : Stop at the first failing write
+        Returns:
+         - The BulkWriteResult, or None if `dicts` was empty
+        """
+        requests = []
+        for dict in dicts:
+            # Check if its actually a Dictionary
+            if not isinstance(dict, collections.abc.Mapping):
+                raise TypeError("Expected Dictionary.")
+
+            # Always use your own _id
+            if "_id" not in dict.keys():
+                raise KeyError("_id not found in supplied dict.")
+
+            data = {k: v for k, v in dict.items() if k != "_id"}
+            requests.append(
+                UpdateOne({"_id": str(dict["_id"])}, {"$set": data}, upsert=True)
+            )
+
+        if not requests:
+            return None
+        return await self.db.bulk_write(requests, ordered=ordered)
+
+    async def bulk_delete(self, ids, ordered=False):
+        """
+        Deletes the items found with any of `ids` in a single bulk_write
+        Params:
+         - ids (Iterable) : The ids to delete
+         - ordered (bool) : Stop at the first failing delete
+        Returns:
+         - The number of deleted documents
+        """
+        requests = [DeleteOne({"_id": id}) for id in ids]
+        if not requests:
+            return 0
+        result = await self.db.bulk_write(requests, ordered=ordered)
+        return result.deleted_count
+
     async def custom_del_by_id(self, id):
         """
         Deletes all items found with _id: `id`
@@ -180,10 +320,22 @@ class Document:
         For when you want to replace the data in
         a mongodb entry with a completely different
         one by ID
+        Deprecated, use replace_if_exists
         Params:
          - dict (Dictionary) : The dict to insert
         """
+        _deprecated("replace_by_id", "replace_if_exists")
+        await self.replace_if_exists(dict)
 
+    async def replace_if_exists(self, dict):
+        """
+        Replaces the document found under the _id of `dict`
+        with `dict` in a single round trip, never inserting
+        Params:
+         - dict (Dictionary) : The dict to insert
+        Returns:
+         - True if a document matched
+        """
         if not isinstance(dict, collections.abc.Mapping):
             raise TypeError("Expected Dictionary.")
 
@@ -191,12 +343,9 @@ class Document:
         if "_id" not in dict.keys():
             raise KeyError("_id not found in supplied dict.")
 
-        if not await self.find_by_id(dict["_id"]):
-            return
-
-        id = dict["_id"]
-        dict.pop("_id")
-        await self.db.replace_one({"_id": str(id)}, dict)
+        data = {k: v for k, v in dict.items() if k != "_id"}
+        result = await self.db.replace_one({"_id": str(dict["_id"])}, data)
+        return result.matched_count > 0
 
     # <-- Private methods -->
     async def __get_raw(self, id):
@@ -205,3 +354,11 @@ class Document:
         within other methods which require the actual data
         """
         return await self.db.find_one({"_id": id})
+
+
+def _deprecated(name, replacement):
+    warnings.warn(
+        f"Document.{name} is deprecated, use Document.{replacement} instead",
+        DeprecationWarning,
+        stacklevel=3,
+    )
@@ -0,0 +1,179 @@
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+
+class ContentFileResponse(Response):
+    """
+    File responder for the /content hot path.
+
+    - strong ETag (the blob digest) with If-None-Match/If-Modified-Since -> 304
+    - single `Range: bytes=` requests -> 206 (honouring If-Range), 416 if unsatisfiable
+    - long lived Cache-Control since a blob never changes under its etag
+    - the body is handed to the server through the `http.response.zerocopysend`
+      (sendfile) or `http.response.pathsend` ASGI extensions when the server
+      offers them, and only falls back to reading chunks in a thread otherwise
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        etag: str,
+        media_type: str,
+        request_headers: Headers,
+        *,
+        cache_control: str,
+        method: str = "GET",
+    ):
+        self.path = path
+        self.etag = f'"{etag}"'
+        self.media_type = media_type
+        self.request_headers = request_headers
+        self.cache_control = cache_control
+        self.send_body = method != "HEAD"
+        self.status_code = 200
+        self.background = None
+        self.body = b""
+        self.init_headers()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            f = await anyio.to_thread.run_sync(open, self.path, "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            await Response(status_code=404)(scope, receive, send)
+            return
+
+        try:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            headers = {
+                "etag": self.etag,
+                "last-modified": formatdate(stat.st_mtime, usegmt=True),
+                "cache-control": self.cache_control,
+                "accept-ranges": "bytes",
+            }
+
+            if self._not_modified(stat.st_mtime):
+                await self._start(send, 304, headers)
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            start, end = 0, size - 1
+            status = 200
+            byte_range = self._range(size)
+            if byte_range == ():
+                headers["content-range"] = f"bytes */{size}"
+                headers["content-length"] = "0"
+                await self._start(send, 416, headers)
+                await send({"type": "http.response.body", "body": b""})
+                return
+            elif byte_range is not None:
+                start, end = byte_range
+                status = 206
+                headers["content-range"] = f"bytes {start}-{end}/{size}"
+
+            count = end - start + 1 if size else 0
+            headers["content-type"] = self.media_type
+            headers["content-length"] = str(count)
+            await self._start(send, status, headers)
+
+            if not self.send_body or not count:
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            extensions = scope.get("extensions") or {}
+            if "http.response.zerocopysend" in extensions:
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": start,
+                        "count": count,
+                    }
+                )
+            elif "http.response.pathsend" in extensions and status == 200:
+                await send({"type": "http.response.pathsend", "path": self.path})
+            else:
+                await self._send_chunks(send, f, start, count)
+        finally:
+            await anyio.to_thread.run_sync(f.close)
+
+    async def _start(self, send, status: int, headers: dict):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (key.encode("latin-1"), value.encode("latin-1"))
+                    for key, value in headers.items()
+                ],
+            }
+        )
+
+    async def _send_chunks(self, send, f, start: int, count: int):
+        await anyio.to_thread.run_sync(f.seek, start)
+        while count > 0:
+            chunk = await anyio.to_thread.run_sync(f.read, min(self.chunk_size, count))
+            if not chunk:
+                break
+            count -= len(chunk)
+            await send(
+                {"type": "http.response.body", "body": chunk, "more_body": count > 0}
+            )
+        if count > 0:
+            # file shrank while we were sending it, end the response anyway
+            await send({"type": "http.response.body", "body": b""})
+
+    def _not_modified(self, mtime: float) -> bool:
+        if if_none_match := self.request_headers.get("if-none-match"):
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags
+
+        if if_modified_since := self.request_headers.get("if-modified-since"):
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+
+        return False
+
+    def _range(self, size: int) -> Optional[tuple]:
+        """
+        Returns None to serve the whole file, () if the range can not be
+        satisfied and a (start, end) tuple otherwise
+        """
+        range_header = self.request_headers.get("range")
+        if not range_header or not self.send_body:
+            return None
+
+        if if_range := self.request_headers.get("if-range"):
+            if if_range.strip() != self.etag:
+                return None
+
+        unit, _, spec = range_header.partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            # multipart/byteranges responses are not worth it, send it all
+            return None
+
+        first, _, last = spec.strip().partition("-")
+        try:
+            if not first:
+                length = int(last)
+                if length <= 0:
+                    return ()
+                return max(0, size - length), size - 1
+            start = int(first)
+            end = int(last) if last else size - 1
+        except ValueError:
+            return None
+
+        if start >= size or end < start:
+            return ()
+        return start, min(end, size - 1)
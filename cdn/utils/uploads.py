@@ -0,0 +1,91 @@
+import os
+import tempfile
+from contextlib import suppress
+
+import aiofiles
+import aiofiles.os
+from fastapi.responses import JSONResponse
+
+from shared.uploads import UploadTooLarge
+
+
+async def spool_upload(
+    file,
+    *,
+    temp_dir: str,
+    chunk_size: int,
+    max_size: int,
+    hasher=None,
+) -> tuple[str, int]:
+    """
+    Copies `file` into a new temp file in `temp_dir` in `chunk_size`
+    pieces so memory use stays constant no matter how large the upload is.
+    The caller owns the returned temp file and is expected to rename it
+    into place, so readers never see a half written file.
+    Params:
+     - file : Anything with an async `read(size)`, like a MultipartFile
+     - temp_dir (str) : Folder used for in-progress uploads
+     - chunk_size (int) : Bytes read per iteration
+     - max_size (int) : Abort once more than this many bytes were read, 0 disables
+     - hasher (hashlib hash) : Optional hash object fed with every chunk
+    Returns:
+     - The temp file path and the number of bytes written
+    Raises:
+     - UploadTooLarge if the file is bigger than `max_size`
+    """
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix=".part")
+    os.close(fd)
+
+    written = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            while chunk := await file.read(chunk_size):
+                written += len(chunk)
+                if max_size and written > max_size:
+                    raise UploadTooLarge(max_size)
+                if hasher is not None:
+                    hasher.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            await aiofiles.os.remove(temp_path)
+        raise
+
+    return temp_path, written
+
+
+class UploadLimitMiddleware:
+    """
+    Rejects upload requests whose Content-Length is already over the limit
+    before the multipart body is read.
+    Chunked requests without a Content-Length are still capped by
+    `MultipartFile` while they are streamed to storage.
+    `overhead` leaves room for the multipart boundaries and headers.
+    """
+
+    def __init__(
+        self, app, max_size: int, paths: tuple = ("/upload",), overhead: int = 65536
+    ):
+        self.app = app
+        self.max_size = max_size
+        self.paths = paths
+        self.overhead = overhead
+
+    async def __call__(self, scope, receive, send):
+        if (
+            self.max_size
+            and scope["type"] == "http"
+            and scope["method"] == "POST"
+            and scope["path"] in self.paths
+        ):
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > self.max_size + self.overhead:
+                        response = JSONResponse(
+                            {"error": str(UploadTooLarge(self.max_size))}, 413
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+
+        await self.app(scope, receive, send)
@@ -0,0 +1,5 @@
+"""
+Modules used by more than one of the apps. cdn, website and api each run
+from their own directory and put the repository root on sys.path to import
+them, so a fix here reaches every app.
+"""
@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+import os
+import time
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from aiohttp import ClientResponse, ClientSession, ClientTimeout, TCPConnector
+from dotenv import load_dotenv
+from loguru import logger
+
+from .cache import MISSING, TTLCache
+
+load_dotenv()
+
+"""
+Discord's OAuth2 token exchange and `/users/@me`, shared by every login.
+One pooled session keeps connections to discord.com warm, identical
+requests that are already in flight are awaited instead of sent again, and
+profiles are remembered for a short while per access token. Rate limits
+are read from the X-RateLimit-* headers of every response so requests wait
+for a bucket to refill instead of running into a 429.
+"""
+
+API_ENDPOINT = "https://discord.com/api/v10"
+
+DISCORD_POOL_SIZE = int(os.getenv("DISCORD_POOL_SIZE", 20))
+DISCORD_KEEPALIVE_TIMEOUT = float(os.getenv("DISCORD_KEEPALIVE_TIMEOUT", 60))
+DISCORD_TIMEOUT = float(os.getenv("DISCORD_TIMEOUT", 10))
+DISCORD_PROFILE_CACHE_SIZE = int(os.getenv("DISCORD_PROFILE_CACHE_SIZE", 4096))
+DISCORD_PROFILE_CACHE_TTL = float(os.getenv("DISCORD_PROFILE_CACHE_TTL", 60))
+# longest a login waits for a rate limit before giving up
+DISCORD_MAX_RATE_LIMIT_WAIT = float(os.getenv("DISCORD_MAX_RATE_LIMIT_WAIT", 5))
+
+
+class DiscordRateLimited(Exception):
+    """Raised when a request would have to wait longer than allowed"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited by Discord for {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    __slots__ = ("limit", "remaining", "reset")
+
+    def __init__(self):
+        self.limit = 1
+        self.remaining = 1
+        self.reset = 0.0
+
+
+class RateLimiter:
+    """
+    Discord groups routes into buckets, named by the X-RateLimit-Bucket
+    header, and tells us how many requests are left until the bucket
+    refills. Every request for a route takes one from its bucket and waits
+    for the refill once it is empty. A 429 with X-RateLimit-Global holds
+    back every request.
+
+    Params:
+     - max_wait (float) : Longest `acquire` sleeps before raising
+       `DiscordRateLimited`
+    """
+
+    def __init__(self, max_wait: float = DISCORD_MAX_RATE_LIMIT_WAIT):
+        self.max_wait = max_wait
+        self.waits = 0
+        self.limited = 0
+        self._global_reset = 0.0
+        # route name -> bucket name, filled in by the responses
+        self._routes: dict[str, str] = {}
+        # per token routes create a bucket per user, so let idle ones expire
+        self._buckets = TTLCache(maxsize=10_000, ttl=60 * 60)
+
+    async def acquire(self, route: tuple):
+        while True:
+            now = time.monotonic()
+            wait = self._global_reset - now
+            bucket = self._bucket(route)
+            if bucket is not None:
+                if bucket.reset <= now:
+                    bucket.remaining = bucket.limit
+                elif bucket.remaining <= 0:
+                    wait = max(wait, bucket.reset - now)
+
+            if wait <= 0:
+                break
+            if wait > self.max_wait:
+                raise DiscordRateLimited(wait)
+            self.waits += 1
+            logger.debug(f"Waiting {wait:.2f}s for Discord rate limit on {route}")
+            await asyncio.sleep(wait)
+
+        if bucket is not None:
+            bucket.remaining -= 1
+
+    def update(self, route: tuple, response: ClientResponse, data: dict):
+        """Applies the rate limit headers (and a 429's body) of a response"""
+        headers = response.headers
+        now = time.monotonic()
+
+        if name := headers.get("X-RateLimit-Bucket"):
+            self._routes[route[0]] = name
+            key = (name, route[1])
+            bucket = self._buckets.get(key, None)
+            if bucket is None:
+                bucket = _Bucket()
+                self._buckets.set(key, bucket)
+            try:
+                bucket.limit = int(headers.get("X-RateLimit-Limit", bucket.limit))
+                remaining = int(headers.get("X-RateLimit-Remaining", 1))
+                reset_after = float(headers.get("X-RateLimit-Reset-After", 0))
+            except ValueError:
+                pass
+            else:
+                # responses can come back out of order, never hand out more
+                # requests than we already counted as taken
+                if bucket.reset > now:
+                    remaining = min(remaining, bucket.remaining)
+                bucket.remaining = remaining
+                bucket.reset = now + reset_after
+
+        if response.status != 429:
+            return
+
+        self.limited += 1
+        try:
+            retry_after = float(
+                data.get("retry_after") or headers.get("Retry-After") or 1
+            )
+        except ValueError:
+            retry_after = 1.0
+        if data.get("global") or headers.get("X-RateLimit-Global"):
+            self._global_reset = max(self._global_reset, now + retry_after)
+            logger.warning(f"Hit Discord's global rate limit for {retry_after}s")
+        elif bucket := self._bucket(route):
+            bucket.remaining = 0
+            bucket.reset = max(bucket.reset, now + retry_after)
+        else:
+            # no bucket header (e.g. a Cloudflare ban), hold back everything
+            self._global_reset = max(self._global_reset, now + retry_after)
+
+    def _bucket(self, route: tuple) -> Optional[_Bucket]:
+        name = self._routes.get(route[0])
+        if name is None:
+            return None
+        return self._buckets.get((name, route[1]), None)
+
+
+class DiscordClient:
+    """
+    Params:
+     - client_id (str) : The OAuth2 application's id
+     - client_secret (str) : The OAuth2 application's secret
+     - redirect_uri (str) : Must match the one the code was issued for
+     - pool_size (int) : Most connections open to Discord at once
+     - profile_ttl (float) : Seconds a `/users/@me` response is reused
+    """
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        redirect_uri: str,
+        *,
+        pool_size: int = DISCORD_POOL_SIZE,
+        keepalive_timeout: float = DISCORD_KEEPALIVE_TIMEOUT,
+        timeout: float = DISCORD_TIMEOUT,
+        profile_cache_size: int = DISCORD_PROFILE_CACHE_SIZE,
+        profile_ttl: float = DISCORD_PROFILE_CACHE_TTL,
+        max_rate_limit_wait: float = DISCORD_MAX_RATE_LIMIT_WAIT,
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+
+        self.session = ClientSession(
+            connector=TCPConnector(
+                limit=pool_size,
+                limit_per_host=pool_size,
+                ttl_dns_cache=300,
+                keepalive_timeout=keepalive_timeout,
+            ),
+            timeout=ClientTimeout(total=timeout, connect=min(timeout, 5)),
+        )
+        self.profiles = TTLCache(maxsize=profile_cache_size, ttl=profile_ttl)
+        self.rate_limits = RateLimiter(max_rate_limit_wait)
+        self.coalesced = 0
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+
+    async def close(self):
+        await self.session.close()
+
+    async def exchange_code(self, code: str) -> Optional[str]:
+        """
+        Trades an authorization code for an access token. A code can only be
+        used once, so a double submitted login shares the first exchange
+        Returns:
+         - The access token, None if Discord refused the code
+        Raises:
+         - DiscordRateLimited
+        """
+        data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": self.redirect_uri,
+            "scope": "identify",
+        }
+
+        async def exchange():
+            # the token endpoint is limited per application, not per user
+            _, body = await self._request(
+                "POST", "/oauth2/token", ("oauth2/token", None), data=data
+            )
+            return body
+
+        response = await self._single_flight(("token", code), exchange)
+        if response.get("error") or response.get("message"):
+            logger.error(response)
+            return None
+        return response.get("access_token")
+
+    async def get_user(self, access_token: Optional[str]) -> dict:
+        """
+        Returns:
+         - The user behind `access_token` as sent by `/users/@me`, or Discord's
+           error message
+        Raises:
+         - DiscordRateLimited
+        """
+        # keep raw tokens out of the cache keys
+        key = hashlib.sha256(str(access_token).encode()).digest()
+        user = self.profiles.get(key)
+        if user is MISSING:
+
+            async def fetch():
+                status, data = await self._request(
+                    "GET",
+                    "/users/@me",
+                    ("users/@me", key),
+                    headers={"Authorization": f"Bearer {access_token}"},
+                )
+                if status == 200 and "id" in data:
+                    self.profiles.set(key, data)
+                return data
+
+            user = await self._single_flight(("user", key), fetch)
+        # callers add their own fields, leave the cached profile alone
+        return dict(user)
+
+    async def _single_flight(
+        self, key: Hashable, fetch: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        # fetch runs in a task of its own, a caller that gets cancelled (e.g.
+        # the client went away) does not take the result from everyone else
+        if task := self._in_flight.get(key):
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fetch())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._landed(key, task))
+        return await asyncio.shield(task)
+
+    def _landed(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # nobody may be waiting on it
+            task.exception()
+
+    async def _request(
+        self, method: str, path: str, route: tuple, *, retries: int = 2, **kwargs
+    ) -> tuple[int, dict]:
+        """
+        Params:
+         - route (tuple) : (route name, major parameter), Discord counts
+           requests per bucket and major parameter, e.g. per access token
+        Returns:
+         - The status and json body of the response
+        """
+        for attempt in range(retries + 1):
+            await self.rate_limits.acquire(route)
+            async with self.session.request(
+                method, f"{API_ENDPOINT}{path}", **kwargs
+            ) as response:
+                try:
+                    data = await response.json(content_type=None)
+                except ValueError:
+                    data = {}
+                if not isinstance(data, dict):
+                    data = {"message": data}
+                self.rate_limits.update(route, response, data)
+
+            if response.status != 429:
+                break
+        return response.status, data
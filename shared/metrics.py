@@ -0,0 +1,216 @@
+import os
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable
+
+from starlette.routing import Mount
+
+"""
+Request metrics exported in the Prometheus text format.
+Every route's ASGI app is wrapped once at startup with a closure bound to
+that route's counters, so a request costs a handful of integer updates and
+no lookups. Everything runs on the event loop thread, which is what makes
+the plain `+=` updates safe without any locking.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# the route label of requests no route matched, so paths can not blow up the labels
+UNMATCHED_ROUTE = "unmatched"
+
+
+class RouteStats:
+    __slots__ = (
+        "route",
+        "in_flight",
+        "responses",
+        "buckets",
+        "latency_sum",
+        "bytes_in",
+        "bytes_out",
+    )
+
+    def __init__(self, route: str):
+        self.route = route
+        self.in_flight = 0
+        # (method, status) -> count
+        self.responses: dict[tuple[str, int], int] = {}
+        # the last bucket is +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def observe(self, method: str, status: int, elapsed: float):
+        key = (method, status)
+        self.responses[key] = self.responses.get(key, 0) + 1
+        self.buckets[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        self.latency_sum += elapsed
+
+
+class Metrics:
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.routes: list[RouteStats] = []
+        self._collectors: list[tuple[str, str, str, Callable]] = []
+
+    def add_collector(self, name: str, kind: str, help: str, func: Callable):
+        """
+        Registers an extra metric read when /metrics is rendered
+        Params:
+         - name (str) : Metric name, prefixed with the namespace
+         - kind (str) : counter or gauge
+         - help (str) : The HELP line
+         - func (Callable) : Returns a number, or a list of (labels dict, number)
+        """
+        self._collectors.append((name, kind, help, func))
+
+    def instrument(self, app, exclude: tuple = ("/metrics",)):
+        """
+        Wraps every route of `app` (routes and mounts) with counters for that
+        route, and the router's fallback with the counters of UNMATCHED_ROUTE.
+        Call it once all routes have been added
+        """
+        stats = RouteStats(UNMATCHED_ROUTE)
+        self.routes.append(stats)
+        app.router.default = _instrumented(app.router.default, stats)
+
+        for route in app.router.routes:
+            path = getattr(route, "path", None)
+            if path is None or path in exclude or not hasattr(route, "app"):
+                continue
+            if isinstance(route, Mount):
+                path = f"{path}/{{path}}"
+            stats = RouteStats(path)
+            self.routes.append(stats)
+            route.app = _instrumented(route.app, stats)
+
+    def render(self) -> str:
+        ns = self.namespace
+        lines = [
+            f"# HELP {ns}_http_requests_total Requests handled by route, method and status",
+            f"# TYPE {ns}_http_requests_total counter",
+        ]
+        for stats in self.routes:
+            for (method, status), count in stats.responses.items():
+                lines.append(
+                    f'{ns}_http_requests_total{{route="{stats.route}",method="{method}",status="{status}"}} {count}'
+                )
+
+        lines += [
+            f"# HELP {ns}_http_requests_in_flight Requests currently being handled",
+            f"# TYPE {ns}_http_requests_in_flight gauge",
+        ]
+        for stats in self.routes:
+            lines.append(
+                f'{ns}_http_requests_in_flight{{route="{stats.route}"}} {stats.in_flight}'
+            )
+
+        lines += [
+            f"# HELP {ns}_http_request_duration_seconds Request latency",
+            f"# TYPE {ns}_http_request_duration_seconds histogram",
+        ]
+        for stats in self.routes:
+            label = f'route="{stats.route}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(
+                    f'{ns}_http_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}'
+                )
+            cumulative += stats.buckets[-1]
+            lines += [
+                f'{ns}_http_request_duration_seconds_bucket{{{label},le="+Inf"}} {cumulative}',
+                f"{ns}_http_request_duration_seconds_sum{{{label}}} {stats.latency_sum}",
+                f"{ns}_http_request_duration_seconds_count{{{label}}} {cumulative}",
+            ]
+
+        for name, attr, help in (
+            ("http_request_bytes_total", "bytes_in", "Request body bytes received"),
+            ("http_response_bytes_total", "bytes_out", "Response body bytes sent"),
+        ):
+            lines += [f"# HELP {ns}_{name} {help}", f"# TYPE {ns}_{name} counter"]
+            for stats in self.routes:
+                lines.append(
+                    f'{ns}_{name}{{route="{stats.route}"}} {getattr(stats, attr)}'
+                )
+
+        for name, kind, help, func in self._collectors:
+            lines += [f"# HELP {ns}_{name} {help}", f"# TYPE {ns}_{name} {kind}"]
+            value = func()
+            if isinstance(value, list):
+                for labels, sample in value:
+                    label = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{ns}_{name}{{{label}}} {sample}")
+            else:
+                lines.append(f"{ns}_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _instrumented(asgi_app, stats: RouteStats):
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            # websockets only count towards the in-flight gauge
+            stats.in_flight += 1
+            try:
+                await asgi_app(scope, receive, send)
+            finally:
+                stats.in_flight -= 1
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                if value.isdigit():
+                    stats.bytes_in += int(value)
+                break
+
+        status = None
+        length = 0
+
+        async def counting_send(message):
+            nonlocal status, length
+            kind = message["type"]
+            if kind == "http.response.body":
+                # only what is actually sent, HEAD responses declare a length
+                # but send no body
+                stats.bytes_out += len(message.get("body", b""))
+            elif kind == "http.response.start":
+                status = message["status"]
+                for name, value in message["headers"]:
+                    if name == b"content-length":
+                        length = int(value) if value.isdigit() else 0
+                        break
+            elif kind == "http.response.pathsend":
+                # the server sends the file itself, all of it
+                stats.bytes_out += length
+            elif kind == "http.response.zerocopysend":
+                stats.bytes_out += _zerocopy_count(message)
+            await send(message)
+
+        stats.in_flight += 1
+        start = perf_counter()
+        try:
+            await asgi_app(scope, receive, counting_send)
+        except Exception as e:
+            # an HTTPException (e.g. the router's 404) becomes a response
+            # further out, anything else a 500
+            if status is None:
+                status = getattr(e, "status_code", 500)
+            raise
+        finally:
+            stats.in_flight -= 1
+            stats.observe(scope["method"], status or 500, perf_counter() - start)
+
+    return app
+
+
+def _zerocopy_count(message: dict) -> int:
+    """The bytes a zerocopysend message has the server send from its file"""
+    if (count := message.get("count")) is not None:
+        return count
+    fd = message["file"].fileno()
+    # no offset means the file's current position
+    offset = message.get("offset")
+    if offset is None:
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+    return max(os.fstat(fd).st_size - offset, 0)
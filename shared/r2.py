@@ -0,0 +1,51 @@
+import os
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import AioSession
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+ACCOUNT_ID = os.getenv("AWS_ACCOUNT_ID")
+
+# point this at a local S3 stand-in (moto_server, minio, ...) to benchmark offline
+S3_ENDPOINT_URL = os.getenv(
+    "S3_ENDPOINT_URL", f"https://{ACCOUNT_ID}.r2.cloudflarestorage.com"
+)
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+S3_KEEPALIVE_TIMEOUT = float(os.getenv("S3_KEEPALIVE_TIMEOUT", 60))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", 5))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", 60))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 3))
+
+# files up to one part go up in a single PUT, bigger ones as a multipart upload
+# S3 requires every part but the last to be at least 5 MiB
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", 4))
+
+S3_CONFIG = AioConfig(
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    connect_timeout=S3_CONNECT_TIMEOUT,
+    read_timeout=S3_READ_TIMEOUT,
+    retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"},
+    tcp_keepalive=True,
+    connector_args={"keepalive_timeout": S3_KEEPALIVE_TIMEOUT},
+)
+
+
+def create_s3_client(session: AioSession):
+    """
+    Returns the client context manager for our R2 bucket. The client owns
+    a connection pool, so create it once and share it rather than per request
+    """
+    return session.create_client(
+        "s3",
+        region_name="auto",
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        config=S3_CONFIG,
+    )
@@ -0,0 +1,102 @@
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from json import dumps as JSON_ENCODER
+from json import loads as JSON_DECODER
+from typing import Optional
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from shared.cache import MISSING, TTLCache
+
+load_dotenv()
+
+"""
+Signed session tokens for the `user` cookie.
+A token is `<payload>.<signature>`, both urlsafe base64 without padding,
+where the signature is an HMAC-SHA256 of the encoded payload. The payload
+carries the discord profile plus `role`, `jti`, `iat` and `exp`, so finding
+out who sent a request needs no database access at all. A token says nothing
+about whether its user may still use the app: the apps look that up per
+request (the cdn through its authorization cache), so taking access away
+does not wait for the user's tokens to expire. Logging out revokes the
+token by its `jti`; the revoked ids live in this process only and are
+forgotten once the tokens would have expired anyway.
+"""
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", 24 * 60 * 60))
+_SESSION_SECRET = os.getenv("SESSION_SECRET")
+if not _SESSION_SECRET:
+    logger.warning(
+        "SESSION_SECRET is not set, sessions will not survive a restart "
+        "and will not be shared between workers"
+    )
+    _SESSION_SECRET = secrets.token_hex(32)
+_SESSION_KEY = _SESSION_SECRET.encode("utf-8")
+
+REVOKED_TOKENS_SIZE = int(os.getenv("REVOKED_TOKENS_SIZE", 100_000))
+
+_PROFILE_FIELDS = ("id", "username", "discriminator", "avatar")
+
+# revoked jtis, an entry outlasts its token unless the set overflows
+_revoked = TTLCache(maxsize=REVOKED_TOKENS_SIZE, ttl=SESSION_TTL)
+
+
+def _b64encode(data: bytes) -> str:
+    return urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(
+        hmac.new(_SESSION_KEY, payload.encode("utf-8"), hashlib.sha256).digest()
+    )
+
+
+def issue_token(user: dict, *, role: str) -> str:
+    now = time.time()
+    claims = {key: user.get(key) for key in _PROFILE_FIELDS}
+    claims |= {
+        "role": role,
+        "jti": secrets.token_hex(16),
+        "iat": now,
+        "exp": now + SESSION_TTL,
+    }
+    payload = _b64encode(JSON_ENCODER(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: str) -> Optional[dict]:
+    """
+    Returns the token's claims if the signature is valid and it has neither
+    expired nor been revoked, None otherwise
+    """
+    payload, _, signature = token.partition(".")
+    expected = _sign(payload).encode("ascii")
+    if not signature or not hmac.compare_digest(signature.encode("utf-8"), expected):
+        return None
+
+    try:
+        claims = JSON_DECODER(_b64decode(payload))
+    except Exception as e:
+        logger.error(e)
+        return None
+
+    if claims.get("exp", 0) < time.time():
+        return None
+    if _revoked.get(claims.get("jti")) is not MISSING:
+        return None
+    return claims
+
+
+def revoke_token(token: Optional[str]):
+    """Makes `verify_token` reject a valid token from now on, e.g. on logout"""
+    if token and (claims := verify_token(token)) and claims.get("jti"):
+        _revoked.set(claims["jti"], True)
@@ -0,0 +1,972 @@
+import asyncio
+import hashlib
+import inspect
+import mimetypes
+import os
+import tempfile
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_left, bisect_right, insort
+from contextlib import suppress
+from json import dumps as JSON_ENCODER
+from json import loads as JSON_DECODER
+from typing import AsyncIterator, Iterable, Optional
+from urllib.parse import urlencode
+
+import aiofiles
+import aiofiles.os
+from loguru import logger
+
+"""
+Storage backends shared by the cdn and the website.
+Files are addressed by the folder of their owner and their name, and are
+described by entries of {name, size, mtime, content_type, etag}. Uploads
+and downloads are streamed in chunks, so no backend ever holds a whole
+file in memory.
+
+ - LocalStorage keeps files as plain files under a directory
+ - S3Storage keeps them in a bucket (R2 in production) through an
+   aiobotocore client
+ - FakeS3Client is an in-memory stand-in for that client, so the S3 code
+   path can be run and benchmarked without any network
+"""
+
+SORT_FIELDS = ("name", "size", "mtime")
+
+# the most keys a single delete_objects call accepts
+S3_DELETE_BATCH = 1000
+# the most parts a multipart upload may have
+S3_MAX_PARTS = 10000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Storage:
+    chunk_size = 1024 * 1024
+
+    async def put(
+        self, folder: str, name: str, file, *, content_type: Optional[str] = None
+    ) -> dict:
+        """
+        Stores everything `file.read(size)` returns as `folder/name`,
+        replacing any previous file with that name
+        Params:
+         - file : Anything with an async `read(size)`, like an UploadFile
+         - content_type (str) : Defaults to `file.content_type` if it has one
+        Returns:
+         - The entry of the stored file
+        """
+        raise NotImplementedError
+
+    async def get(self, folder: str, name: str) -> Optional[dict]:
+        """Returns the entry of `folder/name`, None if it does not exist"""
+        raise NotImplementedError
+
+    async def open(
+        self, folder: str, name: str
+    ) -> Optional[tuple[dict, AsyncIterator[bytes]]]:
+        """
+        Returns the entry of `folder/name` and an iterator over its content,
+        None if it does not exist
+        """
+        raise NotImplementedError
+
+    def path(self, folder: str, name: str) -> Optional[str]:
+        """
+        Returns where `folder/name` lives on the local disk, None for remote
+        backends. Lets the apps hand local files to the server as they are
+        """
+        return None
+
+    async def list(
+        self,
+        folder: str,
+        *,
+        sort: str = "name",
+        reverse: bool = False,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+    ) -> tuple[list[dict], Optional[str]]:
+        """
+        Returns one page of the folder's entries
+        Params:
+         - sort (str) : One of SORT_FIELDS
+         - reverse (bool) : Sort descending
+         - cursor (str) : The `next_cursor` of the previous page
+         - limit (int) : Max entries in the page
+        Returns:
+         - The entries and the cursor of the next page, None on the last page
+        Raises:
+         - InvalidCursor if `cursor` can not be decoded
+        """
+        raise NotImplementedError
+
+    async def delete_many(
+        self, folder: str, names: Iterable[str] = (), *, prefix: Optional[str] = None
+    ) -> dict[str, Optional[str]]:
+        """
+        Removes several files of a folder in one go
+        Params:
+         - names (Iterable[str]) : The files to remove
+         - prefix (str) : Also remove every file starting with this
+        Returns:
+         - Every file mapped to None if it was removed, or why it was not
+        """
+        raise NotImplementedError
+
+    def walk(self) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Yields (folder, entry) of every stored file, ordered by "folder/name"
+        as compared by Python (and by S3 and mongo, which compare the utf-8
+        bytes the same way)
+        """
+        raise NotImplementedError
+
+    async def delete(self, folder: str, name: str) -> bool:
+        """
+        Removes `folder/name`
+        Returns:
+         - False if it could not be removed, e.g. because it does not exist
+        """
+        return (await self.delete_many(folder, [name]))[name] is None
+
+
+class LocalStorage(Storage):
+    """Plain files in `{root}/{folder}/{name}`"""
+
+    def __init__(self, root: str, *, chunk_size: int = 1024 * 1024):
+        self.root = root
+        self.temp_dir = os.path.join(root, ".tmp")
+        self.chunk_size = chunk_size
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def path(self, folder: str, name: str) -> str:
+        """
+        Raises:
+         - ValueError if either part could escape the folder
+        """
+        if not is_plain_name(folder) or not is_plain_name(name):
+            raise ValueError(f"Invalid file name: {folder}/{name}")
+        return os.path.join(self.root, folder, name)
+
+    async def put(
+        self, folder: str, name: str, file, *, content_type: Optional[str] = None
+    ) -> dict:
+        target = self.path(folder, name)
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir)
+        os.close(fd)
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                while chunk := await file.read(self.chunk_size):
+                    await f.write(chunk)
+            await aiofiles.os.makedirs(os.path.dirname(target), exist_ok=True)
+            await aiofiles.os.replace(temp_path, target)
+        finally:
+            with suppress(FileNotFoundError):
+                await aiofiles.os.remove(temp_path)
+
+        return _stat_entry(
+            name,
+            await aiofiles.os.stat(target),
+            content_type or getattr(file, "content_type", None),
+        )
+
+    async def get(self, folder: str, name: str) -> Optional[dict]:
+        try:
+            return _stat_entry(name, await aiofiles.os.stat(self.path(folder, name)))
+        except (ValueError, FileNotFoundError, NotADirectoryError):
+            return None
+
+    async def open(
+        self, folder: str, name: str
+    ) -> Optional[tuple[dict, AsyncIterator[bytes]]]:
+        try:
+            path = self.path(folder, name)
+            f = await aiofiles.open(path, "rb")
+        except (ValueError, FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+        entry = _stat_entry(name, await aiofiles.os.stat(path))
+
+        async def chunks():
+            try:
+                while chunk := await f.read(self.chunk_size):
+                    yield chunk
+            finally:
+                await f.close()
+
+        return entry, chunks()
+
+    async def list(
+        self,
+        folder: str,
+        *,
+        sort: str = "name",
+        reverse: bool = False,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+    ) -> tuple[list[dict], Optional[str]]:
+        index = await asyncio.to_thread(self._scan, folder)
+        return paginate(index, sort=sort, reverse=reverse, cursor=cursor, limit=limit)
+
+    async def delete_many(
+        self, folder: str, names: Iterable[str] = (), *, prefix: Optional[str] = None
+    ) -> dict[str, Optional[str]]:
+        return await asyncio.to_thread(self._remove_many, folder, list(names), prefix)
+
+    async def walk(self) -> AsyncIterator[tuple[str, dict]]:
+        folders = await asyncio.to_thread(
+            lambda: [
+                entry.name
+                for entry in os.scandir(self.root)
+                if entry.is_dir() and is_plain_name(entry.name) and entry.name != ".tmp"
+            ]
+        )
+        # "a/..." sorts after "a-b/..." as keys, so compare the folders as prefixes
+        for folder in sorted(folders, key=lambda folder: f"{folder}/"):
+            index = await asyncio.to_thread(self._scan, folder)
+            for name in sorted(index):
+                yield folder, index[name]
+
+    def _scan(self, folder: str) -> dict[str, dict]:
+        index = {}
+        if not is_plain_name(folder):
+            return index
+        with suppress(FileNotFoundError):
+            with os.scandir(os.path.join(self.root, folder)) as it:
+                for item in it:
+                    if item.is_file():
+                        index[item.name] = _stat_entry(item.name, item.stat())
+        return index
+
+    def _remove_many(self, folder, names, prefix) -> dict[str, Optional[str]]:
+        names = dict.fromkeys(names)
+        if prefix is not None and is_plain_name(folder):
+            with suppress(FileNotFoundError):
+                names.update(
+                    dict.fromkeys(
+                        name
+                        for name in os.listdir(os.path.join(self.root, folder))
+                        if name.startswith(prefix)
+                    )
+                )
+
+        results = {}
+        for name in names:
+            try:
+                os.remove(self.path(folder, name))
+                results[name] = None
+            except FileNotFoundError:
+                results[name] = "File does not exist"
+            except (ValueError, OSError) as e:
+                results[name] = str(e)
+        return results
+
+
+class S3Storage(Storage):
+    """
+    Objects `{folder}/{name}` in a bucket
+    Params:
+     - client : An aiobotocore S3 client, or a FakeS3Client
+     - bucket (str) : The bucket name
+     - part_size (int) : Files bigger than this go up as multipart uploads
+     - concurrency (int) : Parts of one multipart upload in flight at once
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        *,
+        part_size: int = 8 * 1024 * 1024,
+        concurrency: int = 4,
+        chunk_size: int = 1024 * 1024,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+
+    async def put(
+        self, folder: str, name: str, file, *, content_type: Optional[str] = None
+    ) -> dict:
+        # buckets store objects without one as binary/octet-stream
+        content_type = (
+            content_type
+            or getattr(file, "content_type", None)
+            or mimetypes.guess_type(name)[0]
+        )
+        size, etag = await self._upload(f"{folder}/{name}", file, content_type)
+        return make_entry(name, size, time.time(), content_type, etag)
+
+    async def get(self, folder: str, name: str) -> Optional[dict]:
+        try:
+            response = await self.client.head_object(
+                Bucket=self.bucket, Key=f"{folder}/{name}"
+            )
+        except Exception as e:
+            if _is_not_found(e):
+                return None
+            raise
+        return _response_entry(name, response)
+
+    async def open(
+        self, folder: str, name: str
+    ) -> Optional[tuple[dict, AsyncIterator[bytes]]]:
+        try:
+            response = await self.client.get_object(
+                Bucket=self.bucket, Key=f"{folder}/{name}"
+            )
+        except Exception as e:
+            if _is_not_found(e):
+                return None
+            raise
+        body = response["Body"]
+
+        async def chunks():
+            async with body:
+                while chunk := await body.read(self.chunk_size):
+                    yield chunk
+
+        return _response_entry(name, response), chunks()
+
+    async def list(
+        self,
+        folder: str,
+        *,
+        sort: str = "name",
+        reverse: bool = False,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+    ) -> tuple[list[dict], Optional[str]]:
+        prefix = f"{folder}/"
+        if sort != "name" or reverse:
+            # buckets only list in ascending key order, anything else needs
+            # the whole folder
+            index = {}
+            async for obj in self.iter_objects(prefix):
+                entry = _object_entry(obj, prefix)
+                index[entry["name"]] = entry
+            return paginate(
+                index, sort=sort, reverse=reverse, cursor=cursor, limit=limit
+            )
+
+        start_after = None
+        if cursor:
+            _, name = decode_cursor(cursor, sort)
+            start_after = prefix + name
+
+        entries = []
+        async for obj in self.iter_objects(
+            prefix, start_after=start_after, page_size=min(limit + 1, 1000)
+        ):
+            entries.append(_object_entry(obj, prefix))
+            if len(entries) > limit:
+                break
+
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            last = entries[-1]["name"]
+            next_cursor = encode_cursor((last, last), sort)
+        return entries, next_cursor
+
+    async def delete_many(
+        self, folder: str, names: Iterable[str] = (), *, prefix: Optional[str] = None
+    ) -> dict[str, Optional[str]]:
+        keys = [f"{folder}/{name}" for name in names]
+        if prefix is not None:
+            async for obj in self.iter_objects(f"{folder}/{prefix}"):
+                keys.append(obj["Key"])
+
+        results = await self.delete_keys(keys)
+        return {key.removeprefix(f"{folder}/"): error for key, error in results.items()}
+
+    async def presign_upload(
+        self,
+        folder: str,
+        name: str,
+        size: int,
+        *,
+        content_type: Optional[str] = None,
+        expires: int = 3600,
+    ) -> dict:
+        """
+        Lets a client upload `folder/name` straight to the bucket. Files up
+        to one part get a single presigned PUT url, bigger ones a multipart
+        upload with a presigned url per part. Either way nothing but the
+        signatures is computed here, the bytes never pass through us
+        Params:
+         - size (int) : The file size in bytes
+         - expires (int) : Seconds the urls stay valid
+        Returns:
+         - {"url", "headers"} for a single PUT, or
+           {"upload_id", "part_size", "headers", "parts": [{"part_number", "url"}]}
+           where every part but the last is exactly `part_size` bytes
+        """
+        key = f"{folder}/{name}"
+        content_type = (
+            content_type or mimetypes.guess_type(name)[0] or "application/octet-stream"
+        )
+        headers = {"Content-Type": content_type}
+
+        if size <= self.part_size:
+            params = {"Bucket": self.bucket, "Key": key, "ContentType": content_type}
+            url = await self._presign("put_object", params, expires)
+            return {"url": url, "headers": headers}
+
+        part_size = max(self.part_size, -(-size // S3_MAX_PARTS))
+        upload = await self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, ContentType=content_type
+        )
+        upload_id = upload["UploadId"]
+        numbers = range(1, -(-size // part_size) + 1)
+        urls = await asyncio.gather(
+            *(
+                self._presign(
+                    "upload_part",
+                    {
+                        "Bucket": self.bucket,
+                        "Key": key,
+                        "UploadId": upload_id,
+                        "PartNumber": number,
+                    },
+                    expires,
+                )
+                for number in numbers
+            )
+        )
+        return {
+            "upload_id": upload_id,
+            "part_size": part_size,
+            # parts are sent without a Content-Type, it was set on creation
+            "headers": {},
+            "parts": [
+                {"part_number": number, "url": url}
+                for number, url in zip(numbers, urls)
+            ],
+        }
+
+    async def complete_upload(
+        self,
+        folder: str,
+        name: str,
+        upload_id: Optional[str] = None,
+        parts: Iterable[dict] = (),
+    ) -> Optional[dict]:
+        """
+        Finishes a presigned upload
+        Params:
+         - upload_id (str) : The multipart upload, None for a single PUT
+         - parts (Iterable[dict]) : {"part_number", "etag"} of every uploaded part
+        Returns:
+         - The entry of the uploaded file, None if it never arrived
+        """
+        if upload_id:
+            await self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=f"{folder}/{name}",
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"ETag": part["etag"], "PartNumber": part["part_number"]}
+                        for part in sorted(parts, key=lambda part: part["part_number"])
+                    ]
+                },
+            )
+        return await self.get(folder, name)
+
+    async def abort_upload(self, folder: str, name: str, upload_id: str):
+        """Drops the parts of a presigned multipart upload that will not finish"""
+        await self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=f"{folder}/{name}", UploadId=upload_id
+        )
+
+    async def _presign(self, operation: str, params: dict, expires: int) -> str:
+        url = self.client.generate_presigned_url(
+            operation, Params=params, ExpiresIn=expires
+        )
+        # a coroutine with aiobotocore, a plain string with botocore
+        if inspect.isawaitable(url):
+            url = await url
+        return url
+
+    async def walk(self) -> AsyncIterator[tuple[str, dict]]:
+        async for obj in self.iter_objects(""):
+            folder, separator, _ = obj["Key"].partition("/")
+            if separator:
+                yield folder, _object_entry(obj, f"{folder}/")
+
+    async def iter_objects(
+        self, prefix: str, *, start_after: Optional[str] = None, page_size: int = 1000
+    ) -> AsyncIterator[dict]:
+        """
+        Yields every object under `prefix`, following continuation tokens so
+        listings are never cut off at the 1000 keys a single call returns
+        """
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix, "MaxKeys": page_size}
+        if start_after:
+            kwargs["StartAfter"] = start_after
+
+        while True:
+            response = await self.client.list_objects_v2(**kwargs)
+            for obj in response.get("Contents", []):
+                yield obj
+            if not response.get("IsTruncated"):
+                return
+            kwargs.pop("StartAfter", None)
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    async def delete_keys(self, keys: Iterable[str]) -> dict[str, Optional[str]]:
+        """
+        Deletes `keys` with one delete_objects call per 1000 keys, the
+        batches running concurrently
+        Returns:
+         - Every key mapped to None if it was deleted, or the error message
+        """
+        results: dict[str, Optional[str]] = dict.fromkeys(keys)
+
+        async def delete_batch(batch: list[str]):
+            try:
+                response = await self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+                )
+            except Exception as e:
+                logger.error(e)
+                for key in batch:
+                    results[key] = str(e)
+                return
+            # quiet mode only reports the keys that failed
+            for error in response.get("Errors", []):
+                results[error["Key"]] = error.get("Message") or error.get("Code")
+
+        keys = list(results)
+        await asyncio.gather(
+            *(
+                delete_batch(keys[i : i + S3_DELETE_BATCH])
+                for i in range(0, len(keys), S3_DELETE_BATCH)
+            )
+        )
+        return results
+
+    async def _upload(
+        self, key: str, file, content_type: Optional[str]
+    ) -> tuple[int, Optional[str]]:
+        """
+        Small files are sent with a single put_object, anything bigger than
+        one part as a multipart upload with up to `concurrency` parts in
+        flight, which also bounds the memory used to about
+        (concurrency + 1) * part_size. A failed multipart upload is aborted
+        so no orphaned parts are left behind
+        Returns:
+         - The number of bytes uploaded and the object's etag
+        """
+        extra = {"ContentType": content_type} if content_type else {}
+
+        chunk = await file.read(self.part_size)
+        if len(chunk) < self.part_size:
+            response = await self.client.put_object(
+                Bucket=self.bucket, Key=key, Body=chunk, **extra
+            )
+            return len(chunk), _strip_etag(response.get("ETag"))
+
+        upload = await self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, **extra
+        )
+        upload_id = upload["UploadId"]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        etags: dict[int, str] = {}
+        errors: list[BaseException] = []
+        tasks: list[asyncio.Task] = []
+
+        async def send_part(number: int, body: bytes):
+            try:
+                response = await self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=body,
+                )
+                etags[number] = response["ETag"]
+            except Exception as e:
+                errors.append(e)
+            finally:
+                semaphore.release()
+
+        size = 0
+        try:
+            number = 1
+            while chunk:
+                await semaphore.acquire()
+                if errors:
+                    raise errors[0]
+                size += len(chunk)
+                tasks.append(asyncio.create_task(send_part(number, chunk)))
+                number += 1
+                chunk = await file.read(self.part_size)
+
+            await asyncio.gather(*tasks)
+            if errors:
+                raise errors[0]
+
+            response = await self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"ETag": etags[number], "PartNumber": number}
+                        for number in sorted(etags)
+                    ]
+                },
+            )
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await asyncio.shield(
+                    self.client.abort_multipart_upload(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id
+                    )
+                )
+            except Exception as e:
+                logger.error(f"Failed to abort multipart upload of {key}: {e}")
+            raise
+
+        return size, _strip_etag(response.get("ETag"))
+
+
+class FakeS3Error(Exception):
+    """Shaped like botocore's ClientError so callers can treat both alike"""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(f"{code}: {message}")
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class _FakeBody:
+    def __init__(self, data: bytes):
+        self._data = memoryview(data)
+        self._position = 0
+
+    async def read(self, size: int = -1) -> bytes:
+        end = len(self._data) if size < 0 else self._position + size
+        chunk = bytes(self._data[self._position : end])
+        self._position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+class FakeS3Client:
+    """
+    An in-memory S3 bucket speaking the subset of the aiobotocore client
+    API used by S3Storage, for tests and offline benchmarks. Every call
+    yields to the event loop once, like a real request would
+    Params:
+     - latency (float) : Seconds every call is delayed by, to mimic a network
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls = 0
+        # bucket -> key -> object, and every bucket's keys in order
+        self._buckets: dict[str, dict[str, dict]] = {}
+        self._keys: dict[str, list[str]] = {}
+        self._uploads: dict[str, dict] = {}
+
+    async def _call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    def _bucket(self, bucket: str) -> dict[str, dict]:
+        if bucket not in self._buckets:
+            self._buckets[bucket] = {}
+            self._keys[bucket] = []
+        return self._buckets[bucket]
+
+    def _remove(self, bucket: str, key: str):
+        if self._bucket(bucket).pop(key, None) is not None:
+            keys = self._keys[bucket]
+            del keys[bisect_left(keys, key)]
+
+    def _object(self, bucket: str, key: str) -> dict:
+        obj = self._bucket(bucket).get(key)
+        if obj is None:
+            raise FakeS3Error("NoSuchKey", "The specified key does not exist.")
+        return obj
+
+    def _store(self, bucket: str, key: str, data: bytes, content_type, etag=None):
+        if key not in self._bucket(bucket):
+            insort(self._keys[bucket], key)
+        self._bucket(bucket)[key] = {
+            "data": data,
+            "ContentType": content_type or "binary/octet-stream",
+            "ETag": etag or f'"{hashlib.md5(data).hexdigest()}"',
+            "LastModified": time.time(),
+        }
+        return self._bucket(bucket)[key]
+
+    async def create_bucket(self, Bucket: str, **kwargs) -> dict:
+        await self._call()
+        self._bucket(Bucket)
+        return {}
+
+    async def put_object(
+        self, Bucket: str, Key: str, Body: bytes = b"", ContentType=None, **kwargs
+    ) -> dict:
+        await self._call()
+        obj = self._store(Bucket, Key, bytes(Body), ContentType)
+        return {"ETag": obj["ETag"]}
+
+    async def head_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        await self._call()
+        obj = self._object(Bucket, Key)
+        return _fake_head(obj)
+
+    async def get_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        await self._call()
+        obj = self._object(Bucket, Key)
+        return _fake_head(obj) | {"Body": _FakeBody(obj["data"])}
+
+    async def delete_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        await self._call()
+        self._remove(Bucket, Key)
+        return {}
+
+    async def delete_objects(self, Bucket: str, Delete: dict, **kwargs) -> dict:
+        await self._call()
+        objects = Delete["Objects"]
+        if len(objects) > S3_DELETE_BATCH:
+            raise FakeS3Error("MalformedXML", "Too many keys")
+        for obj in objects:
+            self._remove(Bucket, obj["Key"])
+        if Delete.get("Quiet"):
+            return {}
+        return {"Deleted": [{"Key": obj["Key"]} for obj in objects]}
+
+    async def list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str = "",
+        MaxKeys: int = 1000,
+        StartAfter: str = "",
+        ContinuationToken: str = "",
+        **kwargs,
+    ) -> dict:
+        await self._call()
+        after = ContinuationToken or StartAfter
+        bucket = self._bucket(Bucket)
+        keys = self._keys[Bucket]
+        if after > Prefix:
+            start = bisect_right(keys, after)
+        else:
+            start = bisect_left(keys, Prefix)
+
+        page = []
+        for key in keys[start : start + min(MaxKeys, 1000) + 1]:
+            if not key.startswith(Prefix):
+                break
+            page.append(key)
+        truncated = len(page) > min(MaxKeys, 1000)
+        page = page[: min(MaxKeys, 1000)]
+
+        response = {
+            "IsTruncated": truncated,
+            "KeyCount": len(page),
+            "Contents": [
+                {
+                    "Key": key,
+                    "Size": len(bucket[key]["data"]),
+                    "LastModified": bucket[key]["LastModified"],
+                    "ETag": bucket[key]["ETag"],
+                }
+                for key in page
+            ],
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    async def create_multipart_upload(
+        self, Bucket: str, Key: str, ContentType=None, **kwargs
+    ) -> dict:
+        await self._call()
+        upload_id = os.urandom(8).hex()
+        self._uploads[upload_id] = {"ContentType": ContentType, "parts": {}}
+        return {"UploadId": upload_id}
+
+    async def upload_part(
+        self,
+        Bucket: str,
+        Key: str,
+        UploadId: str,
+        PartNumber: int,
+        Body: bytes,
+        **kwargs,
+    ) -> dict:
+        await self._call()
+        if UploadId not in self._uploads:
+            raise FakeS3Error("NoSuchUpload", "The upload does not exist.")
+        etag = f'"{hashlib.md5(Body).hexdigest()}"'
+        self._uploads[UploadId]["parts"][PartNumber] = (etag, bytes(Body))
+        return {"ETag": etag}
+
+    async def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict, **kwargs
+    ) -> dict:
+        await self._call()
+        upload = self._uploads.pop(UploadId, None)
+        if upload is None:
+            raise FakeS3Error("NoSuchUpload", "The upload does not exist.")
+        data = []
+        for part in MultipartUpload["Parts"]:
+            etag, body = upload["parts"][part["PartNumber"]]
+            if etag != part["ETag"]:
+                raise FakeS3Error("InvalidPart", f"Part {part['PartNumber']}")
+            data.append(body)
+        etag = f'"{hashlib.md5(b"".join(data)).hexdigest()}-{len(data)}"'
+        self._store(Bucket, Key, b"".join(data), upload["ContentType"], etag)
+        return {"ETag": etag}
+
+    async def abort_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, **kwargs
+    ) -> dict:
+        await self._call()
+        self._uploads.pop(UploadId, None)
+        return {}
+
+    async def generate_presigned_url(
+        self, ClientMethod: str, Params: dict, ExpiresIn: int = 3600, **kwargs
+    ) -> str:
+        # signing is local, it does not count as a call
+        query = {k: v for k, v in Params.items() if k not in ("Bucket", "Key")}
+        query |= {"X-Amz-Expires": ExpiresIn, "method": ClientMethod}
+        return f"memory://{Params['Bucket']}/{Params['Key']}?{urlencode(query)}"
+
+
+def paginate(
+    index: dict[str, dict],
+    *,
+    sort: str,
+    reverse: bool,
+    cursor: Optional[str],
+    limit: int,
+) -> tuple[list[dict], Optional[str]]:
+    """Pages through a {name: entry} index the way `Storage.list` describes"""
+    keys = sorted((entry[sort], name) for name, entry in index.items())
+    position = decode_cursor(cursor, sort) if cursor else None
+
+    if reverse:
+        end = bisect_left(keys, position) if position else len(keys)
+        start = max(0, end - limit)
+        page = keys[start:end][::-1]
+        has_more = start > 0
+    else:
+        start = bisect_right(keys, position) if position else 0
+        page = keys[start : start + limit]
+        has_more = start + limit < len(keys)
+
+    next_cursor = encode_cursor(page[-1], sort) if page and has_more else None
+    return [index[name] for _, name in page], next_cursor
+
+
+def encode_cursor(key: tuple, sort: str) -> str:
+    raw = JSON_ENCODER([sort, *key]).encode("utf-8")
+    return urlsafe_b64encode(raw).decode("utf-8")
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        raw = urlsafe_b64decode(cursor.encode("utf-8"))
+        cursor_sort, value, name = JSON_DECODER(raw)
+    except Exception:
+        raise InvalidCursor(cursor)
+    if cursor_sort != sort:
+        raise InvalidCursor(cursor)
+    return value, name
+
+
+def make_entry(name, size, mtime, content_type, etag) -> dict:
+    return {
+        "name": name,
+        "size": size,
+        "mtime": mtime,
+        "content_type": content_type
+        or mimetypes.guess_type(name)[0]
+        or "application/octet-stream",
+        "etag": etag,
+    }
+
+
+def is_plain_name(part: str) -> bool:
+    """Whether `part` is a single path component that stays where it is put"""
+    return bool(part) and part not in (".", "..") and not any(
+        c in part for c in ("/", "\\", "\0")
+    )
+
+
+def _stat_entry(name: str, stat: os.stat_result, content_type=None) -> dict:
+    return make_entry(
+        name,
+        stat.st_size,
+        stat.st_mtime,
+        content_type,
+        f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+    )
+
+
+def _object_entry(obj: dict, prefix: str) -> dict:
+    return make_entry(
+        obj["Key"].removeprefix(prefix),
+        obj["Size"],
+        _timestamp(obj["LastModified"]),
+        None,
+        _strip_etag(obj.get("ETag")),
+    )
+
+
+def _response_entry(name: str, response: dict) -> dict:
+    return make_entry(
+        name,
+        response["ContentLength"],
+        _timestamp(response["LastModified"]),
+        response.get("ContentType"),
+        _strip_etag(response.get("ETag")),
+    )
+
+
+def _fake_head(obj: dict) -> dict:
+    return {
+        "ContentLength": len(obj["data"]),
+        "ContentType": obj["ContentType"],
+        "ETag": obj["ETag"],
+        "LastModified": obj["LastModified"],
+    }
+
+
+def _timestamp(value) -> float:
+    # aiobotocore returns datetimes, the fake plain timestamps
+    return value.timestamp() if hasattr(value, "timestamp") else value
+
+
+def _strip_etag(etag: Optional[str]) -> Optional[str]:
+    return etag.strip('"') if etag else etag
+
+
+def _is_not_found(e: Exception) -> bool:
+    code = getattr(e, "response", {}).get("Error", {}).get("Code")
+    return code in ("NoSuchKey", "NotFound", "404")
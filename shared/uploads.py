@@ -0,0 +1,172 @@
+from typing import AsyncIterator, Optional
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+"""
+Uploads read straight off the request body.
+FastAPI's UploadFile is only handed to a route once Starlette copied the
+whole part into a temp file, which the storage backends then copy a second
+time. `MultipartFile` instead parses the multipart body as it is read, so
+every chunk goes from the socket to its destination in one pass.
+"""
+
+# where the parser is in the request body
+_SEARCHING = 0
+_IN_FILE = 1
+_DONE = 2
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        super().__init__(f"File exceeds the maximum upload size of {max_size} bytes")
+
+
+class MultipartFile:
+    """
+    The content of one file field of a multipart/form-data request. Reads
+    pull the request body through the parser only as far as they need, so
+    at most one body chunk is held in memory. Parts before the field are
+    skipped, parts after it are never read.
+    Use `await MultipartFile.open(request)` rather than the constructor.
+    """
+
+    def __init__(
+        self,
+        stream: AsyncIterator[bytes],
+        boundary: bytes,
+        field: str,
+        max_size: int,
+    ):
+        self.field = field
+        self.max_size = max_size
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+        # bytes of the file parsed so far
+        self.size = 0
+
+        self._stream = stream
+        self._state = _SEARCHING
+        self._buffer = bytearray()
+        self._headers: dict[bytes, bytes] = {}
+        self._header_field = bytearray()
+        self._header_value = bytearray()
+        self._parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+            },
+        )
+
+    @classmethod
+    async def open(
+        cls, request, field: str = "file", *, max_size: int = 0
+    ) -> Optional["MultipartFile"]:
+        """
+        Reads the request body up to where the file's content starts
+        Params:
+         - request (Request) : A request whose body was not read yet
+         - field (str) : The form field holding the file
+         - max_size (int) : Raise UploadTooLarge past this many bytes, 0 disables
+        Returns:
+         - The file, filename and content_type filled in, or None if the
+           request is not multipart or has no such file field
+        Raises:
+         - ValueError if the body is not valid multipart
+        """
+        content_type, options = parse_options_header(
+            request.headers.get("content-type", "")
+        )
+        boundary = options.get(b"boundary")
+        if content_type != b"multipart/form-data" or not boundary:
+            return None
+
+        file = cls(request.stream(), boundary, field, max_size)
+        while file._state == _SEARCHING and await file._feed():
+            pass
+        if file._state == _SEARCHING:
+            return None
+        return file
+
+    async def read(self, size: int = -1) -> bytes:
+        """
+        Returns:
+         - Up to `size` bytes of the file, all that is left if `size` is
+           negative, b"" once the file ended
+        Raises:
+         - UploadTooLarge
+         - ValueError if the body ends before the file does
+        """
+        while self._state == _IN_FILE and (size < 0 or len(self._buffer) < size):
+            if not await self._feed():
+                raise ValueError("The request body ended in the middle of the file")
+
+        if size < 0 or size >= len(self._buffer):
+            chunk = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            chunk = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return chunk
+
+    async def _feed(self) -> bool:
+        """Parses the next chunk of the body, False once there is none"""
+        try:
+            chunk = await self._stream.__anext__()
+        except StopAsyncIteration:
+            return False
+        if chunk:
+            self._parser.write(chunk)
+        return True
+
+    # <-- Parser callbacks -->
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[bytes(self._header_field).lower()] = bytes(self._header_value)
+        self._header_field.clear()
+        self._header_value.clear()
+
+    def _on_headers_finished(self):
+        if self._state != _SEARCHING:
+            return
+        _, options = parse_options_header(
+            self._headers.get(b"content-disposition", b"")
+        )
+        if (
+            options.get(b"name", b"").decode("utf-8", "replace") != self.field
+            or b"filename" not in options
+        ):
+            return
+        self.filename = options[b"filename"].decode("utf-8", "replace")
+        if content_type := self._headers.get(b"content-type"):
+            self.content_type = content_type.decode("latin-1")
+        self._state = _IN_FILE
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._state != _IN_FILE:
+            return
+        self.size += end - start
+        if self.max_size and self.size > self.max_size:
+            raise UploadTooLarge(self.max_size)
+        self._buffer += data[start:end]
+
+    def _on_part_end(self):
+        if self._state == _IN_FILE:
+            self._state = _DONE
@@ -0,0 +1,74 @@
+"""
+Compares a client per request (the old behaviour) with one shared client.
+Point S3_ENDPOINT_URL at a local S3 stand-in to run it offline, e.g.
+
+    moto_server -p 5000
+    S3_ENDPOINT_URL=http://127.0.0.1:5000 AWS_BUCKET_NAME=bench python bench.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+from aiobotocore.session import get_session
+
+# the apps share the modules in ../shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.r2 import BUCKET_NAME, S3_ENDPOINT_URL, create_s3_client
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+
+async def client_per_request(session):
+    async def one():
+        async with create_s3_client(session) as client:
+            await client.list_objects_v2(Bucket=BUCKET_NAME, MaxKeys=1)
+
+    await run(one)
+
+
+async def shared_client(session):
+    async with create_s3_client(session) as client:
+
+        async def one():
+            await client.list_objects_v2(Bucket=BUCKET_NAME, MaxKeys=1)
+
+        await run(one)
+
+
+async def run(request):
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def limited():
+        async with semaphore:
+            await request()
+
+    await asyncio.gather(*(limited() for _ in range(REQUESTS)))
+
+
+async def main():
+    session = get_session()
+    print(f"{REQUESTS} requests, {CONCURRENCY} concurrent, against {S3_ENDPOINT_URL}")
+
+    start = time.perf_counter()
+    async with create_s3_client(session) as client:
+        construction = time.perf_counter() - start
+        try:
+            await client.create_bucket(Bucket=BUCKET_NAME)
+        except Exception:
+            pass
+    print(f"client construction: {construction * 1000:.1f}ms")
+
+    for bench in (client_per_request, shared_client):
+        start = time.perf_counter()
+        await bench(session)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{bench.__name__:>20}: {elapsed:.2f}s "
+            f"({REQUESTS / elapsed:.0f} req/s, {elapsed / REQUESTS * 1000:.2f}ms/req)"
+        )
+
+
+asyncio.run(main())
@@ -1,33 +1,92 @@
+import asyncio
+import hmac
+import math
 import os
-from base64 import b64encode
-from json import dumps as JSON_ENCODER
+import sys
+import time
+from contextlib import AsyncExitStack
 from typing import Optional
 
 import uvicorn
 from aiobotocore.session import get_session
-from aiohttp import ClientSession
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, Request, Response, UploadFile
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from loguru import logger
 
+# the apps share the modules in ../shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.cache import MISSING
+from shared.discord import DiscordClient, DiscordRateLimited
+from shared.metrics import Metrics
+from shared.r2 import (
+    BUCKET_NAME,
+    S3_PART_SIZE,
+    S3_UPLOAD_CONCURRENCY,
+    create_s3_client,
+)
+from shared.sessions import SESSION_TTL, issue_token, revoke_token
+from shared.storage import (
+    FakeS3Client,
+    LocalStorage,
+    S3Storage,
+    Storage,
+    is_plain_name,
+)
+from shared.uploads import MultipartFile, UploadTooLarge
+from utils.cache import ListingCache
 from utils.checks import isUserAuthorized, parse_user_form_cookie
+from utils.database import InvalidCatalogCursor, db
+from utils.diskcache import CachedFileResponse, DiskCache, UploadCopy
+from utils.jobs import UploadJob, UploadQueue
 
 load_dotenv()
 
 _PORT = int(os.getenv("PORT"))
 _HOST = os.getenv("HOST")
 
-API_ENDPOINT = "https://discord.com/api/v10"
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
-BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-ACCOUNT_ID = os.getenv("AWS_ACCOUNT_ID")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# s3 (R2, the default), local (files under STORAGE_DIR) or memory (an
+# in-process fake of S3, for load tests)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+STORAGE_DIR = os.getenv("STORAGE_DIR", "content")
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", 1024))
+LISTING_CACHE_TTL = float(os.getenv("LISTING_CACHE_TTL", 30))
+MAX_BATCH_DELETE = int(os.getenv("MAX_BATCH_DELETE", 1000))
+
+# /content reads from remote backends are only cached if DISK_CACHE_DIR is set
+DISK_CACHE_DIR = os.getenv("DISK_CACHE_DIR")
+DISK_CACHE_MAX_BYTES = int(os.getenv("DISK_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+CONTENT_CACHE_CONTROL = os.getenv("CONTENT_CACHE_CONTROL", "public, max-age=86400")
+
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 100 * 1024 * 1024))
+
+# /upload?background=true spools the body here and returns 202 right away
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", "spool")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 4))
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", 5))
+UPLOAD_RETRY_BACKOFF = float(os.getenv("UPLOAD_RETRY_BACKOFF", 1))
+
+# seconds between runs of the job repairing drift between the object
+# catalog and the storage backend, 0 disables it
+CATALOG_RECONCILE_INTERVAL = float(os.getenv("CATALOG_RECONCILE_INTERVAL", 3600))
+
+# seconds the urls handed out by /upload/presign stay valid
+PRESIGN_EXPIRES = int(os.getenv("PRESIGN_EXPIRES", 3600))
 
 if os.name == "nt":
     _HOST = "192.168.0.11"
@@ -45,57 +104,190 @@ class APIWrapper(FastAPI):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.session: ClientSession = None
+        self.discord: DiscordClient = None
         self.boto_session = get_session()
+        self.s3 = None
+        self.storage: Storage = None
+        self._exit_stack = AsyncExitStack()
+        self.disk_cache: Optional[DiskCache] = None
+        if DISK_CACHE_DIR:
+            self.disk_cache = DiskCache(DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES)
+        self.uploads: UploadQueue = None
+        self.reconciler: asyncio.Task = None
+        self.catalog_repairs = {"added": 0, "updated": 0, "removed": 0}
 
 
 app = APIWrapper()
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="static/templates")
+metrics = Metrics("website")
+listing_cache = ListingCache(maxsize=LISTING_CACHE_SIZE, ttl=LISTING_CACHE_TTL)
+
+metrics.add_collector(
+    "catalog_repairs_total",
+    "counter",
+    "Object catalog entries fixed by the reconciler",
+    lambda: [({"kind": kind}, count) for kind, count in app.catalog_repairs.items()],
+)
+metrics.add_collector(
+    "upload_jobs_pending",
+    "gauge",
+    "Background uploads queued or in progress",
+    lambda: app.uploads.pending() if app.uploads else 0,
+)
+metrics.add_collector(
+    "discord_profile_cache_lookups_total",
+    "counter",
+    "Discord profile cache lookups by result",
+    lambda: [
+        ({"result": "hit"}, app.discord.profiles.hits),
+        ({"result": "miss"}, app.discord.profiles.misses),
+    ],
+)
+metrics.add_collector(
+    "discord_coalesced_requests_total",
+    "counter",
+    "Discord requests that joined one already in flight",
+    lambda: app.discord.coalesced,
+)
+metrics.add_collector(
+    "discord_rate_limit_waits_total",
+    "counter",
+    "Discord requests held back to stay inside a rate limit",
+    lambda: app.discord.rate_limits.waits,
+)
+metrics.add_collector(
+    "discord_rate_limited_total",
+    "counter",
+    "429 responses from Discord",
+    lambda: app.discord.rate_limits.limited,
+)
+
+if app.disk_cache is not None:
+    metrics.add_collector(
+        "disk_cache_lookups_total",
+        "counter",
+        "Disk cache lookups by result",
+        lambda: [
+            ({"result": "hit"}, app.disk_cache.hits),
+            ({"result": "miss"}, app.disk_cache.misses),
+        ],
+    )
+    metrics.add_collector(
+        "disk_cache_evictions_total",
+        "counter",
+        "Objects evicted from the disk cache",
+        lambda: app.disk_cache.evictions,
+    )
+    metrics.add_collector(
+        "disk_cache_bytes",
+        "gauge",
+        "Bytes held by the disk cache",
+        lambda: app.disk_cache.size,
+    )
 
 
 @app.on_event("startup")
 async def app_startup():
-    app.session = ClientSession()
+    app.discord = DiscordClient(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
     logger.info("Started session")
 
+    app.storage = await open_storage()
+    logger.info(f"Using {type(app.storage).__name__} for {STORAGE_BACKEND} storage")
+
+    if app.disk_cache is not None:
+        await app.disk_cache.load()
+
+    app.uploads = UploadQueue(
+        UPLOAD_SPOOL_DIR,
+        push_spooled_upload,
+        workers=UPLOAD_WORKERS,
+        max_attempts=UPLOAD_MAX_ATTEMPTS,
+        backoff=UPLOAD_RETRY_BACKOFF,
+    )
+    await app.uploads.start()
+
+    await db.create_catalog_indexes()
+    if CATALOG_RECONCILE_INTERVAL > 0:
+        app.reconciler = asyncio.create_task(reconcile_catalog_forever())
+
 
 @app.on_event("shutdown")
 async def app_shutdown():
-    await app.session.close()
+    await app.discord.close()
     logger.info("Closed session")
+    if app.reconciler is not None:
+        app.reconciler.cancel()
+    await app.uploads.stop()
+    logger.info(f"Stopped upload workers, {app.uploads.pending()} uploads left spooled")
+    await app._exit_stack.aclose()
+    logger.info("Closed storage")
+
+
+async def open_storage() -> Storage:
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(STORAGE_DIR)
+    if STORAGE_BACKEND == "memory":
+        return S3Storage(FakeS3Client(), BUCKET_NAME or "memory")
+    if STORAGE_BACKEND != "s3":
+        raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+
+    start = time.perf_counter()
+    app.s3 = await app._exit_stack.enter_async_context(
+        create_s3_client(app.boto_session)
+    )
+    logger.info(f"Created S3 client in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return S3Storage(
+        app.s3,
+        BUCKET_NAME,
+        part_size=S3_PART_SIZE,
+        concurrency=S3_UPLOAD_CONCURRENCY,
+    )
 
 
-async def exchange_code(code: str) -> Optional[str]:
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type": "authorization_code",
-        "code": code,
-        "redirect_uri": REDIRECT_URI,
-        "scope": "identify",
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-
-    async with app.session.post(
-        "https://discord.com/api/oauth2/token", data=data, headers=headers
-    ) as response:
-        data = await response.json()
-        logger.debug(f"Got response from discord: {data}")
-        if data.get("error") or data.get("message"):
-            logger.error(data)
-            return None
-        return data.get("access_token", data)
-
-
-async def get_user(access_token):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with app.session.get(
-        f"{API_ENDPOINT}/users/@me", headers=headers
-    ) as response:
-        data = await response.json()
-        return data
+async def reconcile_catalog_forever():
+    """
+    Repairs the object catalog against the storage backend once at startup
+    and then every CATALOG_RECONCILE_INTERVAL seconds, fixing whatever
+    failed catalog writes or changes made outside this app left behind
+    """
+    while True:
+        start = time.perf_counter()
+        try:
+            counts = await db.reconcile_objects(app.storage.walk())
+        except NotImplementedError:
+            logger.warning(f"{type(app.storage).__name__} can not be reconciled")
+            return
+        except Exception as e:
+            logger.error(f"Catalog reconciliation failed: {e}")
+        else:
+            for kind, count in counts.items():
+                app.catalog_repairs[kind] += count
+            listing_cache.pages.clear()
+            logger.info(
+                f"Reconciled the object catalog in {time.perf_counter() - start:.1f}s: "
+                f"{counts['added']} added, {counts['updated']} updated, "
+                f"{counts['removed']} removed"
+            )
+        await asyncio.sleep(CATALOG_RECONCILE_INTERVAL)
+
+
+async def record_upload(folder: str, entry: dict):
+    """Adds a stored file to the catalog"""
+    listing_cache.invalidate(folder)
+    try:
+        await db.upsert_object(folder, entry)
+    except Exception as e:
+        # the file is stored, the reconciler adds it later
+        logger.error(f"Failed to catalog {folder}/{entry['name']}: {e}")
+
+
+def file_url(folder: str, filename: str) -> str:
+    if STORAGE_BACKEND == "s3":
+        return f"https://cdn.mooshi.ml/{folder}/{filename}"
+    # nothing but this app can serve the other backends
+    return f"{BASE_URL}/content/{folder}/{filename}"
 
 
 @app.get("/auth/login")
@@ -110,6 +302,7 @@ async def login(request: Request, response: Response) -> None:
 async def logout(request: Request, response: Response) -> None:
     if not isUserAuthorized(request.cookies):
         return Response("You do not have access to this page", 403)
+    revoke_token(request.cookies.get("user"))
     response = RedirectResponse("/", 303)
     response.delete_cookie("user")
     return response
@@ -122,21 +315,32 @@ async def index(request: Request, response: Response) -> None:
         return templates.TemplateResponse("login.html", {"request": request})
     else:
         response = templates.TemplateResponse("index.html", {"request": request})
-        response.set_cookie("user", request.cookies.get("user"))
         return response
 
 
 @app.get("/clear_cookies")
 async def cookie_clear(request: Request):
+    revoke_token(request.cookies.get("user"))
     response = RedirectResponse("/", 303)
     response.delete_cookie("user")
     return response
 
 
+def rate_limited_login(error: DiscordRateLimited) -> Response:
+    return Response(
+        "Discord is busy, try logging in again in a moment",
+        503,
+        headers={"Retry-After": str(math.ceil(error.retry_after))},
+    )
+
+
 @app.get("/auth/handshake")
 async def handshake(request: Request, response: Response):
     if code := request.query_params.get("code"):
-        access_token = await exchange_code(code)
+        try:
+            access_token = await app.discord.exchange_code(code)
+        except DiscordRateLimited as e:
+            return rate_limited_login(e)
         print(access_token)
     else:  # gon be evil and keep redirecting them to discord's oauth2 page until they approve ;)
         return RedirectResponse(
@@ -144,80 +348,155 @@ async def handshake(request: Request, response: Response):
             303,
         )
 
-    user = await get_user(access_token)
+    try:
+        user = await app.discord.get_user(access_token)
+    except DiscordRateLimited as e:
+        return rate_limited_login(e)
     print(user)
     response = RedirectResponse("/", 303)
     response.set_cookie(
         "user",
-        b64encode(JSON_ENCODER(user).encode("utf-8")).decode("utf-8"),
+        issue_token(user, role="user"),
+        max_age=SESSION_TTL,
         httponly=True,
     )
     return response
 
 
-async def upload_file_to_cdn(folder: str, file: File) -> str:
+async def upload_file_to_cdn(folder: str, filename: str, file) -> str:
+    """
+    Stores an upload read straight off the request
+    Raises:
+     - UploadTooLarge
+     - ValueError : The multipart body is malformed
+    """
     try:
-        async with app.boto_session.create_client(
-            "s3",
-            region_name="auto",
-            endpoint_url=f"https://{ACCOUNT_ID}.r2.cloudflarestorage.com",
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-        ) as client:
-            await client.put_object(
-                Bucket=BUCKET_NAME,
-                Key=f"{folder}/{file.filename}",
-                Body=await file.read(),
-            )
-            return "https://cdn.mooshi.ml/" + f"{folder}/{file.filename}"
+        await store_upload(folder, filename, file, file.content_type)
+        return file_url(folder, filename)
+    except (UploadTooLarge, ValueError):
+        raise
     except Exception as e:
         logger.error(e)
         return f"Something went wrong!: {e}"
 
 
-async def delete_file_from_cdn(folder: str, filename: str) -> str | bool:
+async def store_upload(
+    folder: str, filename: str, file, content_type: Optional[str]
+) -> dict:
+    """
+    Puts an upload into storage and records it. With the disk cache enabled
+    the upload is copied as storage reads it, then kept as the cached object
+    Returns:
+     - The stored object's entry
+    """
+    copy = None
+    if app.disk_cache is not None and not app.storage.path(folder, filename):
+        copy = file = app.disk_cache.copy_of(file)
     try:
-        async with app.boto_session.create_client(
-            "s3",
-            region_name="auto",
-            endpoint_url=f"https://{ACCOUNT_ID}.r2.cloudflarestorage.com",
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-        ) as client:
-            await client.delete_object(
-                Bucket=BUCKET_NAME,
-                Key=f"{folder}/{filename}",
-            )
-            return True
+        entry = await app.storage.put(folder, filename, file, content_type=content_type)
+        await record_upload(folder, entry)
+        if copy is not None:
+            await warm_disk_cache(folder, filename, copy, entry)
+        return entry
+    finally:
+        if copy is not None:
+            await copy.close()
+
+
+async def warm_disk_cache(folder: str, filename: str, copy: UploadCopy, entry: dict):
+    """
+    Keeps the copy of a fresh upload as its cached object. A copy of an older
+    upload of the same name is dropped even when the new one can not be cached
+    """
+    if not (key := DiskCache.key(folder, filename)):
+        return
+    if entry["size"] > app.disk_cache.max_bytes:
+        await app.disk_cache.discard(key)
+        return
+    try:
+        if await app.disk_cache.keep(key, copy, entry["content_type"]) is None:
+            await app.disk_cache.discard(key)
     except Exception as e:
-        logger.error(e)
-        return f"Something went wrong!: {e}"
-
-
-async def get_stored_files(folder: str) -> list[str] | None:
+        # the upload itself succeeded, the next read fills the cache instead
+        logger.error(f"Failed to cache {key}: {e}")
+        await app.disk_cache.discard(key)
+
+
+async def push_spooled_upload(job: UploadJob, file) -> str:
+    """Pushes a spooled background upload, called by the upload workers"""
+    await store_upload(job.folder, job.filename, file, job.content_type)
+    return file_url(job.folder, job.filename)
+
+
+async def delete_files_from_cdn(
+    folder: str, filenames: list[str], prefix: Optional[str] = None
+) -> dict[str, Optional[str]]:
+    """
+    Deletes the given files, plus every file starting with `prefix`
+    Returns:
+     - Every filename mapped to None if it was deleted, or the error message
+    """
+    results = await app.storage.delete_many(
+        folder, (os.path.basename(name) for name in filenames), prefix=prefix
+    )
+    listing_cache.invalidate(folder)
     try:
-        async with app.boto_session.create_client(
-            "s3",
-            region_name="auto",
-            endpoint_url=f"https://{ACCOUNT_ID}.r2.cloudflarestorage.com",
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-        ) as client:
-            response = await client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=folder)
-            if response.get("Contents"):
-                return [
-                    f"https://cdn.mooshi.ml/{obj.get('Key')}"
-                    for obj in response.get("Contents")
-                ]
-            else:
-                return None
+        await db.delete_objects(
+            folder, [name for name, error in results.items() if error is None]
+        )
     except Exception as e:
-        logger.error(e)
-        return None
+        # the reconciler removes them later
+        logger.error(f"Failed to remove deleted files from the catalog: {e}")
+    if app.disk_cache is not None:
+        for name in results:
+            if key := DiskCache.key(folder, name):
+                await app.disk_cache.discard(key)
+    return results
+
+
+async def get_stored_files(
+    folder: str,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    prefix: Optional[str] = None,
+    content_type: Optional[str] = None,
+) -> tuple[list[dict], Optional[str]]:
+    """
+    Returns one page of the folder's files from the object catalog, newest
+    first, and the cursor of the next page (None on the last one). Pages
+    are cached until the folder changes
+    """
+    page = listing_cache.get(folder, cursor, limit, prefix, content_type)
+    if page is not MISSING:
+        return page
+
+    documents, next_cursor = await db.list_objects(
+        folder, cursor=cursor, limit=limit, prefix=prefix, content_type=content_type
+    )
+    files = [
+        {
+            "name": document["name"],
+            "size": document["size"],
+            "content_type": document["content_type"],
+            "checksum": document["checksum"],
+            "uploaded_at": document["uploaded_at"].isoformat(),
+            "url": file_url(folder, document["name"]),
+        }
+        for document in documents
+    ]
+    page = files, next_cursor
+    listing_cache.set(folder, cursor, limit, prefix, content_type, value=page)
+    return page
+
+
+def upload_filename(file) -> Optional[str]:
+    """Returns the name to store an uploaded file as, None if it is unsafe"""
+    filename = os.path.basename(file.filename or "")
+    return filename if is_plain_name(filename) else None
 
 
 @app.post("/upload")
-async def upload(request: Request, file: UploadFile) -> None:
+async def upload(request: Request, background: bool = False) -> None:
 
     if not request.cookies.get("user"):
         return Response("This endpoint requires valid authentication", 401)
@@ -229,15 +508,172 @@ async def upload(request: Request, file: UploadFile) -> None:
     if not folder:
         return Response("You do not have access to this page", 401)
 
+    # the body is read straight off the request instead of a temp file first
+    try:
+        file = await MultipartFile.open(request, max_size=MAX_UPLOAD_SIZE)
+    except UploadTooLarge as e:
+        return Response(str(e), 413)
+    except ValueError:
+        return Response("Invalid multipart body", 400)
     if not file:
         return Response("No file param was provided", 400)
+    if not (filename := upload_filename(file)):
+        return Response("Invalid filename", 400)
+
+    if background:
+        try:
+            job = await app.uploads.submit(folder, filename, file)
+        except UploadTooLarge as e:
+            return Response(str(e), 413)
+        except ValueError:
+            return Response("Invalid multipart body", 400)
+        return JSONResponse(
+            {
+                "message": "Upload queued",
+                "job": job.status(),
+                "status": f"/uploads/{job.id}",
+            },
+            202,
+        )
 
-    resp = await upload_file_to_cdn(folder, file)
+    try:
+        resp = await upload_file_to_cdn(folder, filename, file)
+    except UploadTooLarge as e:
+        return Response(str(e), 413)
+    except ValueError:
+        return Response("Invalid multipart body", 400)
     return {"message": resp}
 
 
+@app.post("/upload/presign")
+async def presign_upload(
+    request: Request, filename: str, size: int, content_type: Optional[str] = None
+) -> None:
+    if not request.cookies.get("user"):
+        return Response("This endpoint requires valid authentication", 401)
+    if not isUserAuthorized(request.cookies):
+        return Response("You do not have access to this page", 401)
+
+    user = parse_user_form_cookie(request.cookies)
+    folder = user.get("id")
+    if not folder:
+        return Response("You do not have access to this page", 401)
+
+    if not isinstance(app.storage, S3Storage):
+        return Response("Direct uploads need the s3 storage backend", 400)
+    filename = os.path.basename(filename)
+    if not is_plain_name(filename):
+        return Response("Invalid filename", 400)
+    if size < 0:
+        return Response("size can not be negative", 400)
+    if size > MAX_UPLOAD_SIZE:
+        return Response(str(UploadTooLarge(MAX_UPLOAD_SIZE)), 413)
+
+    try:
+        upload = await app.storage.presign_upload(
+            folder, filename, size, content_type=content_type, expires=PRESIGN_EXPIRES
+        )
+    except Exception as e:
+        logger.error(e)
+        return {"error": f"Something went wrong!: {e}"}
+    return {"filename": filename} | upload
+
+
+@app.post("/upload/complete")
+async def complete_upload(request: Request) -> None:
+    """
+    Records an upload sent to /upload/presign's urls. The body is
+    {"filename", "upload_id", "parts": [{"part_number", "etag"}]}, where
+    upload_id and parts are only needed for multipart uploads
+    """
+    if not request.cookies.get("user"):
+        return Response("This endpoint requires valid authentication", 401)
+    if not isUserAuthorized(request.cookies):
+        return Response("You do not have access to this page", 401)
+
+    user = parse_user_form_cookie(request.cookies)
+    folder = user.get("id")
+    if not folder:
+        return Response("You do not have access to this page", 401)
+
+    if not isinstance(app.storage, S3Storage):
+        return Response("Direct uploads need the s3 storage backend", 400)
+
+    try:
+        body = await request.json()
+        filename = os.path.basename(body["filename"])
+        upload_id = body.get("upload_id")
+        parts = [
+            {"part_number": int(part["part_number"]), "etag": str(part["etag"])}
+            for part in body.get("parts") or []
+        ]
+    except Exception:
+        return Response("Invalid upload description", 400)
+    if not is_plain_name(filename) or (upload_id and not parts):
+        return Response("Invalid upload description", 400)
+
+    try:
+        entry = await app.storage.complete_upload(folder, filename, upload_id, parts)
+    except Exception as e:
+        logger.error(e)
+        return Response(f"Could not complete the upload: {e}", 400)
+    if entry is None:
+        return Response("The file was never uploaded", 404)
+
+    await record_upload(folder, entry)
+    if app.disk_cache is not None:
+        await app.disk_cache.discard(DiskCache.key(folder, filename))
+    return {"message": file_url(folder, filename), "file": entry}
+
+
+@app.post("/upload/abort")
+async def abort_upload(request: Request, filename: str, upload_id: str) -> None:
+    if not request.cookies.get("user"):
+        return Response("This endpoint requires valid authentication", 401)
+    if not isUserAuthorized(request.cookies):
+        return Response("You do not have access to this page", 401)
+
+    user = parse_user_form_cookie(request.cookies)
+    folder = user.get("id")
+    if not folder:
+        return Response("You do not have access to this page", 401)
+
+    if not isinstance(app.storage, S3Storage):
+        return Response("Direct uploads need the s3 storage backend", 400)
+
+    try:
+        await app.storage.abort_upload(folder, os.path.basename(filename), upload_id)
+    except Exception as e:
+        logger.error(e)
+        return Response(f"Could not abort the upload: {e}", 400)
+    return {"message": "Upload aborted"}
+
+
+@app.get("/uploads/{job_id}")
+async def upload_status(request: Request, job_id: str) -> None:
+    if not request.cookies.get("user"):
+        return Response("This endpoint requires valid authentication", 401)
+    if not isUserAuthorized(request.cookies):
+        return Response("You do not have access to this page", 401)
+
+    user = parse_user_form_cookie(request.cookies)
+    folder = user.get("id")
+    if not folder:
+        return Response("You do not have access to this page", 401)
+
+    job = app.uploads.get(job_id)
+    # other users' jobs are reported as missing rather than forbidden
+    if job is None or job.folder != folder:
+        return Response("Upload not found", 404)
+    return job.status()
+
+
 @app.delete("/delete")
-async def delete(request: Request, filename: str) -> None:
+async def delete(
+    request: Request,
+    filename: Optional[list[str]] = Query(None),
+    prefix: Optional[str] = None,
+) -> None:
     if not request.cookies.get("user"):
         return Response("This endpoint requires valid authentication", 401)
     if not isUserAuthorized(request.cookies):
@@ -248,17 +684,37 @@ async def delete(request: Request, filename: str) -> None:
     if not folder:
         return Response("You do not have access to this page", 401)
 
-    if not filename:
-        return Response("No file param was provided", 400)
+    if not filename and prefix is None:
+        return Response("No filename or prefix param was provided", 400)
+    if len(filename or ()) > MAX_BATCH_DELETE:
+        return Response(f"At most {MAX_BATCH_DELETE} filenames per request", 400)
+
+    try:
+        errors = await delete_files_from_cdn(folder, filename or [], prefix)
+    except Exception as e:
+        logger.error(e)
+        return {"error": f"Something went wrong!: {e}"}
 
-    resp = await delete_file_from_cdn(folder, filename)
-    if not isinstance(resp, str):
-        return {"message": "File deleted successfully"}
-    return {"error": resp}
+    results = {name: error or "deleted" for name, error in errors.items()}
+    failed = sum(error is not None for error in errors.values())
+    if failed:
+        return {
+            "error": f"Failed to delete {failed} of {len(results)} files",
+            "results": results,
+        }
+    if len(results) == 1:
+        return {"message": "File deleted successfully", "results": results}
+    return {"message": f"Deleted {len(results)} files", "results": results}
 
 
 @app.get("/files")
-async def get_files(request: Request) -> None:
+async def get_files(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    prefix: Optional[str] = None,
+    content_type: Optional[str] = None,
+) -> None:
     if not request.cookies.get("user"):
         return Response("This endpoint requires valid authentication", 401)
     if not isUserAuthorized(request.cookies):
@@ -269,12 +725,74 @@ async def get_files(request: Request) -> None:
     if not folder:
         return Response("You do not have access to this page", 401)
 
+    if not 1 <= limit <= 1000:
+        return Response("limit must be between 1 and 1000", 400)
+
     folder_url = f"{BASE_URL}/{folder}"
     try:
-        return {"message": folder_url, "files": await get_stored_files(folder)}
+        files, next_cursor = await get_stored_files(
+            folder, cursor, limit, prefix, content_type
+        )
+        return {"message": folder_url, "files": files, "next_cursor": next_cursor}
+    except InvalidCatalogCursor:
+        return Response("Invalid cursor", 400)
     except Exception as e:
+        logger.error(e)
         return {"message": f"Something went wrong!: {e}"}
 
 
+@app.api_route("/content/{folder}/{name}", methods=["GET", "HEAD"])
+async def get_content(request: Request, folder: str, name: str):
+    if not is_plain_name(folder) or not is_plain_name(name):
+        return Response("Not Found", 404)
+
+    headers = {"Cache-Control": CONTENT_CACHE_CONTROL}
+    if path := app.storage.path(folder, name):
+        if not os.path.isfile(path):
+            return Response("Not Found", 404)
+        return FileResponse(path, headers=headers)
+
+    cache = app.disk_cache
+    key = DiskCache.key(folder, name)
+    try:
+        if request.method == "HEAD" and (cache is None or key not in cache):
+            # answer from the metadata instead of downloading the object
+            entry = await app.storage.get(folder, name)
+            opened = entry and (entry, None)
+        elif cache is None:
+            opened = await app.storage.open(folder, name)
+        else:
+            opened = await cache.fetch(key, lambda: app.storage.open(folder, name))
+    except Exception as e:
+        logger.error(e)
+        return Response("Something went wrong!", 502)
+    if opened is None:
+        return Response("Not Found", 404)
+
+    entry, body = opened
+    if isinstance(body, str):
+        return CachedFileResponse(
+            cache, key, body, headers=headers, media_type=entry["content_type"]
+        )
+    headers["Content-Length"] = str(entry["size"])
+    if body is None:
+        return Response(headers=headers, media_type=entry["content_type"])
+    return StreamingResponse(body, headers=headers, media_type=entry["content_type"])
+
+
+@app.get("/metrics")
+async def get_metrics(request: Request) -> None:
+    auth = request.headers.get("Authorization", "")
+    if not METRICS_TOKEN or not hmac.compare_digest(
+        auth.encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8")
+    ):
+        return Response("You do not have access to this page", 401)
+
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+metrics.instrument(app)
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host=_HOST, port=_PORT, reload=True)
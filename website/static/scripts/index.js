@@ -14,17 +14,90 @@ btn_upload.addEventListener("click", () => {
     alert("Please select a file to upload");
     return;
   }
+  upload_direct(file)
+    .catch((err) => {
+      // e.g. not running on the s3 backend, send it through us instead
+      console.log(err);
+      return upload_through_server(file);
+    })
+    .then(() => window.location.replace(`${base_url}/`))
+    .catch((err) => console.log(err));
+});
+
+function upload_through_server(file) {
   const formData = new FormData();
   formData.append("file", file);
 
-  fetch(`${base_url}/upload`, {
+  return fetch(`${base_url}/upload`, {
     method: "POST",
     body: formData,
-  })
-    .then((res) => res.json())
-    .then((data) => window.location.replace(`${base_url}/`))
-    .catch((err) => console.log(err));
-});
+  }).then((res) => res.json());
+}
+
+async function upload_direct(file) {
+  const query = new URLSearchParams({
+    filename: file.name,
+    size: file.size,
+    content_type: file.type || "application/octet-stream",
+  });
+  const res = await fetch(`${base_url}/upload/presign?${query}`, {
+    method: "POST",
+  });
+  if (!res.ok) {
+    throw new Error(await res.text());
+  }
+  const upload = await res.json();
+  if (upload.error) {
+    throw new Error(upload.error);
+  }
+
+  const complete = { filename: upload.filename };
+  if (upload.url) {
+    const put = await fetch(upload.url, {
+      method: "PUT",
+      headers: upload.headers,
+      body: file,
+    });
+    if (!put.ok) {
+      throw new Error(`Upload failed with ${put.status}`);
+    }
+  } else {
+    try {
+      complete.upload_id = upload.upload_id;
+      complete.parts = await Promise.all(
+        upload.parts.map(async (part) => {
+          const start = (part.part_number - 1) * upload.part_size;
+          const put = await fetch(part.url, {
+            method: "PUT",
+            body: file.slice(start, start + upload.part_size),
+          });
+          if (!put.ok) {
+            throw new Error(`Part ${part.part_number} failed with ${put.status}`);
+          }
+          // the bucket's CORS rules have to expose the ETag header
+          return { part_number: part.part_number, etag: put.headers.get("ETag") };
+        })
+      );
+    } catch (err) {
+      const abort = new URLSearchParams({
+        filename: upload.filename,
+        upload_id: upload.upload_id,
+      });
+      await fetch(`${base_url}/upload/abort?${abort}`, { method: "POST" });
+      throw err;
+    }
+  }
+
+  const done = await fetch(`${base_url}/upload/complete`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(complete),
+  });
+  if (!done.ok) {
+    throw new Error(await done.text());
+  }
+  return done.json();
+}
 
 const upload_span = document.getElementById("file-input-select");
 const file_input = document.getElementById("file-input");
@@ -36,62 +109,75 @@ file_input.onchange = function () {
   }
 };
 
-fetch(`${base_url}/files`)
-  .then((res) => res.json())
-  .then((data) => {
-    console.log(data);
-
-    const files_ul = document.getElementById("files_ul");
-
-    if (data.files != null) {
-      data.files.forEach((file_url) => {
-        const filename = file_url.split("/").slice(-1)[0];
-
-        const li = document.createElement("li");
-        const a = document.createElement("a");
-        const img_btn = document.createElement("button");
-
-        const del_btn = document.createElement("button");
-
-        del_btn.style.background = "url('/static/assets/delete.svg')";
-        del_btn.style.backgroundSize = "cover";
-        del_btn.style.backgroundRepeat = "no-repeat";
-        del_btn.style.backgroundPosition = "center";
-
-        del_btn.style.verticalAlign = "middle";
-
-        del_btn.style.width = "15px";
-        del_btn.style.height = "15px";
-        del_btn.style.border = "none";
-        del_btn.style.marginRight = "5px";
-        del_btn.style.marginLeft = "6px";
-        del_btn.style.cursor = "pointer";
-
-        del_btn.addEventListener("click", () => {
-          var choice = confirm("Are you sure you want to delete this file?");
-          if (choice == true) {
-            fetch(`${base_url}/delete?filename=${filename}`, {
-              method: "DELETE",
-            })
-              .then((res) => res.json())
-              .then((data) => window.location.replace(`${base_url}/`))
-              .catch((err) => console.log(err));
-          }
-        });
+function fetch_files(cursor = null) {
+  let url = `${base_url}/files`;
+  if (cursor != null) {
+    url += `?cursor=${encodeURIComponent(cursor)}`;
+  }
+  fetch(url)
+    .then((res) => res.json())
+    .then((data) => {
+      console.log(data);
 
-        img_btn.classList.add("btnV");
+      const files_ul = document.getElementById("files_ul");
 
-        a.href = file_url;
-        a.target = "_blank";
-        a.innerText = filename;
+      if (data.files != null) {
+        data.files.forEach((file) => {
+          const file_url = file.url;
+          const filename = file.name;
 
-        img_btn.appendChild(a);
+          const li = document.createElement("li");
+          const a = document.createElement("a");
+          const img_btn = document.createElement("button");
 
-        li.appendChild(del_btn);
-        li.appendChild(img_btn);
+          const del_btn = document.createElement("button");
 
-        files_ul.appendChild(li);
-      });
-    }
-  })
-  .catch((err) => console.log(err));
+          del_btn.style.background = "url('/static/assets/delete.svg')";
+          del_btn.style.backgroundSize = "cover";
+          del_btn.style.backgroundRepeat = "no-repeat";
+          del_btn.style.backgroundPosition = "center";
+
+          del_btn.style.verticalAlign = "middle";
+
+          del_btn.style.width = "15px";
+          del_btn.style.height = "15px";
+          del_btn.style.border = "none";
+          del_btn.style.marginRight = "5px";
+          del_btn.style.marginLeft = "6px";
+          del_btn.style.cursor = "pointer";
+
+          del_btn.addEventListener("click", () => {
+            var choice = confirm("Are you sure you want to delete this file?");
+            if (choice == true) {
+              fetch(`${base_url}/delete?filename=${filename}`, {
+                method: "DELETE",
+              })
+                .then((res) => res.json())
+                .then((data) => window.location.replace(`${base_url}/`))
+                .catch((err) => console.log(err));
+            }
+          });
+
+          img_btn.classList.add("btnV");
+
+          a.href = file_url;
+          a.target = "_blank";
+          a.innerText = filename;
+
+          img_btn.appendChild(a);
+
+          li.appendChild(del_btn);
+          li.appendChild(img_btn);
+
+          files_ul.appendChild(li);
+        });
+      }
+
+      if (data.next_cursor != null) {
+        fetch_files(data.next_cursor);
+      }
+    })
+    .catch((err) => console.log(err));
+}
+
+fetch_files();
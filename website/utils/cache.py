@@ -0,0 +1,45 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from shared.cache import TTLCache
+
+
+class ListingCache:
+    """
+    Caches listing pages per prefix. Every prefix has a version that is part
+    of the cache key, so invalidating a prefix only hands it a new version
+    and its stale pages simply age out of the underlying TTLCache.
+
+    Only the `maxsize` most recently used versions are kept. Prefixes without
+    one share a floor version, which is raised past every version dropped,
+    so pages cached before a forgotten invalidation can not come back.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30):
+        self.pages = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.maxsize = maxsize
+        self._versions: OrderedDict[str, int] = OrderedDict()
+        # versions come from one counter, so a new one is above every old one
+        self._generation = 0
+        self._floor = 0
+
+    def get(self, prefix: str, *key: Hashable) -> Any:
+        return self.pages.get((prefix, self._version(prefix), *key))
+
+    def set(self, prefix: str, *key: Hashable, value: Any):
+        self.pages.set((prefix, self._version(prefix), *key), value)
+
+    def invalidate(self, prefix: str):
+        self._generation += 1
+        self._versions[prefix] = self._generation
+        self._versions.move_to_end(prefix)
+        while len(self._versions) > self.maxsize:
+            _, version = self._versions.popitem(last=False)
+            self._floor = max(self._floor, version)
+
+    def _version(self, prefix: str) -> int:
+        version = self._versions.get(prefix)
+        if version is None:
+            return self._floor
+        self._versions.move_to_end(prefix)
+        return version
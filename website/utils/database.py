@@ -1,6 +1,13 @@
 import os
+import re
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timezone
+from json import dumps as JSON_ENCODER
+from json import loads as JSON_DECODER
+from typing import AsyncIterator, Iterable, Optional
 
 from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, DeleteOne, UpdateOne
 
 load_dotenv()
 
@@ -13,6 +20,13 @@ import motor.motor_asyncio as motor
 
 client = motor.AsyncIOMotorClient(mongo_url)
 
+# catalog writes are sent in bulk_write batches of this size
+CATALOG_BATCH = 1000
+
+
+class InvalidCatalogCursor(ValueError):
+    pass
+
 
 class MongoDB:
     def __init__(self, client):
@@ -37,5 +51,197 @@ class MongoDB:
     async def delete_user(self, id: str):
         return await self.db.users.delete_one({"id": id})
 
+    # <-- Object catalog -->
+    # one document per stored file: _id is the bucket key "{user}/{name}"
+    # and user, name, size, content_type, checksum and uploaded_at are kept
+    # next to it, so listing a folder never has to touch the bucket
+
+    async def create_catalog_indexes(self):
+        await self.db.objects.create_index(
+            [("user", ASCENDING), ("uploaded_at", DESCENDING), ("_id", DESCENDING)]
+        )
+
+    async def upsert_object(self, user: str, entry: dict):
+        """
+        Records a stored file
+        Params:
+         - user (str) : The folder the file lives in
+         - entry (dict) : The storage entry of the file
+        """
+        key = f"{user}/{entry['name']}"
+        return await self.db.objects.update_one(
+            {"_id": key}, {"$set": _catalog_fields(user, entry)}, upsert=True
+        )
+
+    async def delete_objects(self, user: str, names: Iterable[str]) -> int:
+        """
+        Returns:
+         - The number of catalog entries removed
+        """
+        keys = [f"{user}/{name}" for name in names]
+        if not keys:
+            return 0
+        result = await self.db.objects.delete_many({"_id": {"$in": keys}})
+        return result.deleted_count
+
+    async def list_objects(
+        self,
+        user: str,
+        *,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        prefix: Optional[str] = None,
+        content_type: Optional[str] = None,
+    ) -> tuple[list[dict], Optional[str]]:
+        """
+        Returns one page of the user's files, newest first
+        Params:
+         - cursor (str) : The `next_cursor` of the previous page
+         - limit (int) : Max files in the page
+         - prefix (str) : Only files whose name starts with this
+         - content_type (str) : Only files whose content type starts with
+           this, e.g. "image/" or "application/pdf"
+        Returns:
+         - The files and the cursor of the next page, None on the last page
+        Raises:
+         - InvalidCatalogCursor if `cursor` can not be decoded
+        """
+        query = {"user": user}
+        if prefix:
+            query["name"] = {"$regex": f"^{re.escape(prefix)}"}
+        if content_type:
+            query["content_type"] = {"$regex": f"^{re.escape(content_type)}"}
+        if cursor:
+            uploaded_at, key = _decode_catalog_cursor(cursor)
+            query["$or"] = [
+                {"uploaded_at": {"$lt": uploaded_at}},
+                {"uploaded_at": uploaded_at, "_id": {"$lt": key}},
+            ]
+
+        documents = (
+            await self.db.objects.find(query)
+            .sort([("uploaded_at", DESCENDING), ("_id", DESCENDING)])
+            .limit(limit + 1)
+            .to_list(length=limit + 1)
+        )
+
+        next_cursor = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            last = documents[-1]
+            next_cursor = _encode_catalog_cursor(last["uploaded_at"], last["_id"])
+        return documents, next_cursor
+
+    async def reconcile_objects(
+        self, stored: AsyncIterator[tuple[str, dict]]
+    ) -> dict[str, int]:
+        """
+        Makes the catalog match what is actually stored. Both sides are walked
+        in key order and merged, so memory use does not grow with the number
+        of files. Entries uploaded after the walk started are left alone, the
+        walk may have passed their key before they were stored
+        Params:
+         - stored (AsyncIterator) : (user, entry) of every stored file in key order
+        Returns:
+         - How many entries were added, updated and removed
+        """
+        started = datetime.now(timezone.utc)
+        counts = {"added": 0, "updated": 0, "removed": 0}
+        operations = []
+
+        def recent(document: dict) -> bool:
+            uploaded_at = document.get("uploaded_at")
+            return (
+                uploaded_at is not None
+                and uploaded_at.replace(tzinfo=timezone.utc) >= started
+            )
+
+        async def flush():
+            if operations:
+                await self.db.objects.bulk_write(operations, ordered=False)
+                operations.clear()
+
+        async def catalogued():
+            async for document in self.db.objects.find(
+                {},
+                {"size": 1, "checksum": 1, "uploaded_at": 1},
+                sort=[("_id", ASCENDING)],
+            ):
+                yield document
+
+        catalog = catalogued()
+        document = await anext(catalog, None)
+
+        async for user, entry in stored:
+            key = f"{user}/{entry['name']}"
+            # catalog entries sorting before this key are no longer stored
+            while document is not None and document["_id"] < key:
+                if not recent(document):
+                    operations.append(DeleteOne({"_id": document["_id"]}))
+                    counts["removed"] += 1
+                document = await anext(catalog, None)
+
+            if document is not None and document["_id"] == key:
+                if not recent(document) and (
+                    document.get("size"),
+                    document.get("checksum"),
+                ) != (
+                    entry["size"],
+                    entry["etag"],
+                ):
+                    operations.append(
+                        UpdateOne({"_id": key}, {"$set": _catalog_fields(user, entry)})
+                    )
+                    counts["updated"] += 1
+                document = await anext(catalog, None)
+            else:
+                operations.append(
+                    UpdateOne(
+                        {"_id": key},
+                        {"$set": _catalog_fields(user, entry)},
+                        upsert=True,
+                    )
+                )
+                counts["added"] += 1
+
+            if len(operations) >= CATALOG_BATCH:
+                await flush()
+
+        while document is not None:
+            if not recent(document):
+                operations.append(DeleteOne({"_id": document["_id"]}))
+                counts["removed"] += 1
+            document = await anext(catalog, None)
+            if len(operations) >= CATALOG_BATCH:
+                await flush()
+
+        await flush()
+        return counts
+
 
 db = MongoDB(client)
+
+
+def _catalog_fields(user: str, entry: dict) -> dict:
+    return {
+        "user": user,
+        "name": entry["name"],
+        "size": entry["size"],
+        "content_type": entry["content_type"],
+        "checksum": entry["etag"],
+        "uploaded_at": datetime.fromtimestamp(entry["mtime"], timezone.utc),
+    }
+
+
+def _encode_catalog_cursor(uploaded_at: datetime, key: str) -> str:
+    # mongo stores milliseconds, which survive the round trip through a float
+    raw = JSON_ENCODER([uploaded_at.replace(tzinfo=timezone.utc).timestamp(), key])
+    return urlsafe_b64encode(raw.encode("utf-8")).decode("utf-8")
+
+
+def _decode_catalog_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        timestamp, key = JSON_DECODER(urlsafe_b64decode(cursor.encode("utf-8")))
+        return datetime.fromtimestamp(timestamp, timezone.utc), str(key)
+    except Exception:
+        raise InvalidCatalogCursor(cursor)
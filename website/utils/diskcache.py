@@ -0,0 +1,335 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import suppress
+from typing import AsyncIterator, Awaitable, Callable, Optional, Union
+
+import aiofiles
+import aiofiles.os
+from fastapi.responses import FileResponse
+from loguru import logger
+
+# what a fill resolves to when it failed, waiting misses read the object themselves
+_FAILED = object()
+
+
+class DiskCache:
+    """
+    A read-through cache of bucket objects on local disk, bounded by the
+    total number of bytes it holds. `{folder}/{name}` is stored as
+    `{root}/objects/{folder}/{name}`; least recently used objects are
+    removed first once the cache grows past `max_bytes`.
+
+    The recency order lives in memory only. On startup `load` rebuilds it
+    from the files' access times, so a restart keeps a warm cache.
+    Concurrent misses of the same key share a single download. Objects being
+    served are pinned, evicting or discarding one only removes its file once
+    the last reader released it.
+    """
+
+    def __init__(self, root: str, max_bytes: int, *, chunk_size: int = 1024 * 1024):
+        self.objects_dir = os.path.join(root, "objects")
+        self.temp_dir = os.path.join(root, "tmp")
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        # content types of the objects filled by this run
+        self._content_types: dict[str, Optional[str]] = {}
+        self._filling: dict[str, asyncio.Future] = {}
+        # key -> number of responses still reading its file
+        self._readers: dict[str, int] = {}
+        # removed from the cache while pinned, deleted by the last release
+        self._doomed: set[str] = set()
+
+    @staticmethod
+    def key(folder: str, name: str) -> Optional[str]:
+        """
+        Returns the cache key of `folder/name`, or None if either part is not
+        a plain file name and could escape the cache directory
+        """
+        for part in (folder, name):
+            if not part or part in (".", "..") or os.path.basename(part) != part:
+                return None
+            if "\\" in part or "\0" in part:
+                return None
+        return f"{folder}/{name}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.objects_dir, *key.split("/"))
+
+    async def load(self):
+        """Picks up whatever an earlier run left in the cache directory"""
+        entries = await asyncio.to_thread(self._scan)
+        self._entries = OrderedDict(entries)
+        self.size = sum(self._entries.values())
+        await self._evict()
+        logger.info(
+            f"Disk cache holds {len(self._entries)} objects, {self.size} bytes"
+        )
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def release(self, key: str):
+        readers = self._readers.pop(key) - 1
+        if readers:
+            self._readers[key] = readers
+        elif key in self._doomed:
+            self._doomed.discard(key)
+            # unless it was cached again in the meantime
+            if key not in self._entries:
+                _remove_all([self.path(key)])
+
+    async def fetch(
+        self,
+        key: str,
+        open_object: Callable[
+            [], Awaitable[Optional[tuple[dict, AsyncIterator[bytes]]]]
+        ],
+    ) -> Optional[tuple[dict, Union[str, AsyncIterator[bytes]]]]:
+        """
+        Reads `key` through the cache. On a miss `open_object` downloads it,
+        once for every concurrent miss of the key: the others wait for that
+        fill rather than opening the object themselves
+        Params:
+         - open_object : Opens the object like Storage.open
+        Returns:
+         - None if the object does not exist
+         - Its entry and the path of the cached copy, pinned until `release(key)`
+         - Its entry and an iterator over its content if it could not be
+           cached, the caller has to exhaust or `aclose` it
+        """
+        if key in self._entries:
+            self.hits += 1
+            return self._cached_entry(key), self._pin(key)
+        self.misses += 1
+
+        if pending := self._filling.get(key):
+            entry = await asyncio.shield(pending)
+            if entry is None:
+                return None
+            if entry is not _FAILED and key in self._entries:
+                return entry, self._pin(key)
+            # too big, or the fill failed
+            return await open_object()
+
+        future = asyncio.get_running_loop().create_future()
+        self._filling[key] = future
+        result = _FAILED
+        try:
+            opened = await open_object()
+            if opened is None:
+                result = None
+                return None
+
+            entry, chunks = opened
+            if entry["size"] > self.max_bytes:
+                # too big to cache without evicting everything else
+                result = entry
+                return entry, chunks
+            try:
+                path = await self._write(key, chunks, entry["content_type"])
+            finally:
+                await chunks.aclose()
+            if path is None:
+                # it grew past the cache since it was opened
+                return await open_object()
+            result = entry
+            return entry, self._pin(key)
+        finally:
+            del self._filling[key]
+            future.set_result(result)
+
+    def copy_of(self, file) -> "UploadCopy":
+        """Wraps an upload so that storing it also copies it for `keep`"""
+        return UploadCopy(self, file)
+
+    async def keep(
+        self, key: str, copy: "UploadCopy", content_type: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Caches what `copy` read as `key`, once the upload was stored
+        Returns:
+         - The path of the cached object, None if it is bigger than the cache
+        """
+        try:
+            if (temp_path := await copy.finish()) is None:
+                return None
+            return await self._insert(key, temp_path, copy.size, content_type)
+        finally:
+            await copy.close()
+
+    async def discard(self, key: str):
+        self.size -= self._entries.pop(key, 0)
+        self._content_types.pop(key, None)
+        if key in self._readers:
+            self._doomed.add(key)
+            return
+        with suppress(FileNotFoundError):
+            await aiofiles.os.remove(self.path(key))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "objects": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _pin(self, key: str) -> str:
+        self._entries.move_to_end(key)
+        self._readers[key] = self._readers.get(key, 0) + 1
+        return self.path(key)
+
+    def _cached_entry(self, key: str) -> dict:
+        return {
+            "size": self._entries[key],
+            "content_type": self._content_types.get(key),
+        }
+
+    async def _write(
+        self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str]
+    ) -> Optional[str]:
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir)
+        os.close(fd)
+        written = 0
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                async for chunk in chunks:
+                    written += len(chunk)
+                    if written > self.max_bytes:
+                        return None
+                    await f.write(chunk)
+            return await self._insert(key, temp_path, written, content_type)
+        finally:
+            with suppress(FileNotFoundError):
+                await aiofiles.os.remove(temp_path)
+
+    async def _insert(
+        self, key: str, temp_path: str, size: int, content_type: Optional[str]
+    ) -> str:
+        """Moves a complete temp file in place as `key`"""
+        path = self.path(key)
+        await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+        await aiofiles.os.replace(temp_path, path)
+
+        self.size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self._content_types[key] = content_type
+        await self._evict()
+        return path
+
+    async def _evict(self):
+        victims = []
+        while self.size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._content_types.pop(key, None)
+            self.size -= size
+            self.evictions += 1
+            if key in self._readers:
+                self._doomed.add(key)
+            else:
+                victims.append(self.path(key))
+        if victims:
+            await asyncio.to_thread(_remove_all, victims)
+
+    def _scan(self) -> list[tuple[str, int]]:
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        found = []
+        for folder in os.scandir(self.objects_dir):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.is_file():
+                    stat = entry.stat()
+                    found.append(
+                        (stat.st_atime, f"{folder.name}/{entry.name}", stat.st_size)
+                    )
+        found.sort()
+        return [(key, size) for _, key, size in found]
+
+
+def _remove_all(paths: list[str]):
+    for path in paths:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+
+class UploadCopy:
+    """
+    Reads an upload that can only be read once, like a MultipartFile, and
+    writes what was read to the cache's temp dir. Copying stops once the
+    upload is bigger than the cache. `close` drops the copy
+    """
+
+    def __init__(self, cache: DiskCache, file):
+        self.file = file
+        self.filename = getattr(file, "filename", None)
+        self.content_type = getattr(file, "content_type", None)
+        self.max_bytes = cache.max_bytes
+        self.size = 0
+
+        fd, self.path = tempfile.mkstemp(dir=cache.temp_dir)
+        os.close(fd)
+        self._out = None
+
+    async def read(self, size: int = -1) -> bytes:
+        chunk = await self.file.read(size)
+        if self.path is not None and chunk:
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                await self.close()
+            else:
+                if self._out is None:
+                    self._out = await aiofiles.open(self.path, "wb")
+                await self._out.write(chunk)
+        return chunk
+
+    async def finish(self) -> Optional[str]:
+        """
+        Returns:
+         - The path of the complete copy, None if copying stopped
+        """
+        if self._out is not None:
+            await self._out.close()
+            self._out = None
+        return self.path
+
+    async def close(self):
+        await self.finish()
+        if self.path is not None:
+            with suppress(FileNotFoundError):
+                await aiofiles.os.remove(self.path)
+            self.path = None
+
+
+class CachedFileResponse(FileResponse):
+    """
+    Serves an object pinned by `DiskCache.fetch`, releasing it
+    once the response was sent or the client went away
+    """
+
+    def __init__(self, cache: DiskCache, key: str, path: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self.cache = cache
+        self.key = key
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.cache.release(self.key)
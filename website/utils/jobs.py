@@ -0,0 +1,323 @@
+import asyncio
+import os
+import random
+import secrets
+import tempfile
+import time
+from contextlib import suppress
+from json import dumps as JSON_ENCODER
+from json import loads as JSON_DECODER
+from typing import Awaitable, Callable, Optional
+
+import aiofiles
+import aiofiles.os
+from loguru import logger
+
+from shared.cache import TTLCache
+
+"""
+Background uploads.
+`UploadQueue.submit` copies the request body into `{spool_dir}/{job_id}.data`
+and writes `{job_id}.json` next to it once the copy is complete, so a job
+without its json was never accepted and is simply discarded. Workers push
+spooled files to the bucket, retrying with exponential backoff, and remove
+both files once the job finished. Anything still in the spool when the
+process starts again is queued once more.
+"""
+
+QUEUED = "queued"
+UPLOADING = "uploading"
+RETRYING = "retrying"
+DONE = "done"
+FAILED = "failed"
+
+
+class UploadJob:
+    __slots__ = (
+        "id",
+        "folder",
+        "filename",
+        "content_type",
+        "size",
+        "created",
+        "state",
+        "sent",
+        "attempts",
+        "error",
+        "url",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        folder: str,
+        filename: str,
+        content_type: Optional[str],
+        size: int,
+        created: float,
+    ):
+        self.id = id
+        self.folder = folder
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.created = created
+        self.state = QUEUED
+        # bytes handed to the bucket during the current attempt
+        self.sent = 0
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.url: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.folder}/{self.filename}"
+
+    def spooled(self) -> dict:
+        return {
+            "id": self.id,
+            "folder": self.folder,
+            "filename": self.filename,
+            "content_type": self.content_type,
+            "size": self.size,
+            "created": self.created,
+        }
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "state": self.state,
+            "size": self.size,
+            "sent": self.sent,
+            "attempts": self.attempts,
+            "error": self.error,
+            "url": self.url,
+        }
+
+
+class _ProgressReader:
+    """Counts the bytes read from a spooled file into `job.sent`"""
+
+    def __init__(self, file, job: UploadJob):
+        self.file = file
+        self.job = job
+
+    async def read(self, size: int = -1) -> bytes:
+        chunk = await self.file.read(size)
+        # the upload callback may read the file a second time, e.g. to cache it
+        self.job.sent = min(self.job.size, self.job.sent + len(chunk))
+        return chunk
+
+    async def seek(self, offset: int):
+        await self.file.seek(offset)
+
+
+class UploadQueue:
+    """
+    Params:
+     - spool_dir (str) : Where request bodies wait for their upload
+     - upload (Callable) : `await upload(job, file)` pushes one spooled file,
+       `file` having an async `read(size)` and `seek(offset)`
+     - workers (int) : Uploads running at the same time
+     - max_attempts (int) : Tries per job before it is marked failed
+     - backoff (float) : Seconds before the first retry, doubled every retry
+     - max_backoff (float) : Upper bound of the retry delay
+     - chunk_size (int) : Bytes copied per read while spooling
+     - keep_finished (float) : Seconds the status of finished jobs stays around
+    """
+
+    def __init__(
+        self,
+        spool_dir: str,
+        upload: Callable[[UploadJob, object], Awaitable[Optional[str]]],
+        *,
+        workers: int = 4,
+        max_attempts: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        chunk_size: int = 1024 * 1024,
+        keep_finished: float = 60 * 60,
+    ):
+        self.spool_dir = spool_dir
+        self.upload = upload
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.chunk_size = chunk_size
+
+        self.jobs: dict[str, UploadJob] = {}
+        self.finished = TTLCache(maxsize=10_000, ttl=keep_finished)
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._retries: set[asyncio.TimerHandle] = set()
+
+    async def start(self):
+        """Queues whatever is left in the spool and starts the workers"""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        for job in await asyncio.to_thread(self._scan):
+            self.jobs[job.id] = job
+            self._queue.put_nowait(job.id)
+        if self.jobs:
+            logger.info(f"Resuming {len(self.jobs)} spooled uploads")
+
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        """
+        Stops the workers. Jobs that did not finish stay in the spool and
+        are picked up by the next `start`
+        """
+        for handle in self._retries:
+            handle.cancel()
+        self._retries.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, folder: str, filename: str, file) -> UploadJob:
+        """
+        Spools `file` and queues its upload
+        Params:
+         - file : Has an async `read(size)` and a `content_type`, e.g. a
+           MultipartFile read straight off the request
+        Returns:
+         - The queued job
+        Raises:
+         - Whatever reading `file` raises, nothing is queued then
+        """
+        job_id = secrets.token_hex(16)
+        data_path = self._path(job_id, "data")
+
+        fd, temp_path = tempfile.mkstemp(dir=self.spool_dir, suffix=".part")
+        os.close(fd)
+        size = 0
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                while chunk := await file.read(self.chunk_size):
+                    size += len(chunk)
+                    await f.write(chunk)
+            await aiofiles.os.replace(temp_path, data_path)
+        finally:
+            with suppress(FileNotFoundError):
+                await aiofiles.os.remove(temp_path)
+
+        job = UploadJob(
+            job_id, folder, filename, file.content_type, size, time.time()
+        )
+        await asyncio.to_thread(
+            _write, self._path(job_id, "json"), JSON_ENCODER(job.spooled())
+        )
+
+        self.jobs[job_id] = job
+        self._queue.put_nowait(job_id)
+        return job
+
+    def get(self, job_id: str) -> Optional[UploadJob]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = self.finished.get(job_id, None)
+        return job
+
+    def pending(self) -> int:
+        return len(self.jobs)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self.jobs.get(job_id)
+            if job is not None:
+                await self._run(job)
+
+    async def _run(self, job: UploadJob):
+        job.state = UPLOADING
+        job.attempts += 1
+        job.sent = 0
+        try:
+            async with aiofiles.open(self._path(job.id, "data"), "rb") as f:
+                job.url = await self.upload(job, _ProgressReader(f, job))
+        except asyncio.CancelledError:
+            job.state = QUEUED
+            raise
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            if job.attempts >= self.max_attempts:
+                logger.error(f"Giving up on upload {job.id} ({job.key}): {e}")
+                await self._finish(job, FAILED)
+                return
+
+            delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+            # jitter keeps retries of jobs that failed together apart
+            delay *= random.uniform(0.5, 1.0)
+            logger.warning(
+                f"Upload {job.id} ({job.key}) failed, retrying in {delay:.1f}s: {e}"
+            )
+            job.state = RETRYING
+            self._retry_later(job.id, delay)
+            return
+
+        job.error = None
+        await self._finish(job, DONE)
+
+    def _retry_later(self, job_id: str, delay: float):
+        def requeue():
+            self._retries.discard(handle)
+            self._queue.put_nowait(job_id)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retries.add(handle)
+
+    async def _finish(self, job: UploadJob, state: str):
+        job.state = state
+        del self.jobs[job.id]
+        self.finished.set(job.id, job)
+        for extension in ("json", "data"):
+            with suppress(FileNotFoundError):
+                await aiofiles.os.remove(self._path(job.id, extension))
+
+    def _path(self, job_id: str, extension: str) -> str:
+        return os.path.join(self.spool_dir, f"{job_id}.{extension}")
+
+    def _scan(self) -> list[UploadJob]:
+        jobs = []
+        for entry in list(os.scandir(self.spool_dir)):
+            name, _, extension = entry.name.rpartition(".")
+            if extension != "json":
+                # .part and .tmp files of requests that died half way, and
+                # .data files whose json was never written
+                if extension != "data" or not os.path.exists(self._path(name, "json")):
+                    _discard(entry.path)
+                continue
+
+            try:
+                with open(entry.path, "r") as f:
+                    job = UploadJob(**JSON_DECODER(f.read()))
+            except Exception as e:
+                logger.error(f"Dropping unreadable spooled upload {name}: {e}")
+                _discard(entry.path)
+                _discard(self._path(name, "data"))
+                continue
+
+            if os.path.exists(self._path(job.id, "data")):
+                jobs.append(job)
+            else:
+                _discard(entry.path)
+
+        jobs.sort(key=lambda job: job.created)
+        return jobs
+
+
+def _discard(path: str):
+    with suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def _write(path: str, data: str):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(data)
+    os.replace(temp_path, path)